@@ -328,5 +328,204 @@ abi = [
     "payable": False,
     "stateMutability": "view",
     "type": "function"
+  },
+  {
+    "anonymous": False,
+    "inputs": [
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "orgId",
+        "type": "bytes32"
+      },
+      {
+        "indexed": True,
+        "internalType": "address",
+        "name": "owner",
+        "type": "address"
+      }
+    ],
+    "name": "OrganizationCreated",
+    "type": "event"
+  },
+  {
+    "anonymous": False,
+    "inputs": [
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "parentOrgId",
+        "type": "bytes32"
+      },
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "unitOrgId",
+        "type": "bytes32"
+      },
+      {
+        "indexed": True,
+        "internalType": "address",
+        "name": "director",
+        "type": "address"
+      }
+    ],
+    "name": "UnitCreated",
+    "type": "event"
+  },
+  {
+    "anonymous": False,
+    "inputs": [
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "orgId",
+        "type": "bytes32"
+      },
+      {
+        "indexed": False,
+        "internalType": "bool",
+        "name": "previousState",
+        "type": "bool"
+      },
+      {
+        "indexed": False,
+        "internalType": "bool",
+        "name": "newState",
+        "type": "bool"
+      }
+    ],
+    "name": "OrganizationActiveStateChanged",
+    "type": "event"
+  },
+  {
+    "anonymous": False,
+    "inputs": [
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "orgId",
+        "type": "bytes32"
+      },
+      {
+        "indexed": True,
+        "internalType": "address",
+        "name": "director",
+        "type": "address"
+      }
+    ],
+    "name": "DirectorshipAccepted",
+    "type": "event"
+  },
+  {
+    "anonymous": False,
+    "inputs": [
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "orgId",
+        "type": "bytes32"
+      },
+      {
+        "indexed": True,
+        "internalType": "address",
+        "name": "previousDirector",
+        "type": "address"
+      },
+      {
+        "indexed": True,
+        "internalType": "address",
+        "name": "newDirector",
+        "type": "address"
+      }
+    ],
+    "name": "DirectorshipTransferred",
+    "type": "event"
+  },
+  {
+    "anonymous": False,
+    "inputs": [
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "orgId",
+        "type": "bytes32"
+      },
+      {
+        "indexed": True,
+        "internalType": "address",
+        "name": "previousOwner",
+        "type": "address"
+      },
+      {
+        "indexed": True,
+        "internalType": "address",
+        "name": "newOwner",
+        "type": "address"
+      }
+    ],
+    "name": "OrganizationOwnershipTransferred",
+    "type": "event"
+  },
+  {
+    "anonymous": False,
+    "inputs": [
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "orgId",
+        "type": "bytes32"
+      },
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "previousOrgJsonHash",
+        "type": "bytes32"
+      },
+      {
+        "indexed": False,
+        "internalType": "string",
+        "name": "previousOrgJsonUri",
+        "type": "string"
+      },
+      {
+        "indexed": False,
+        "internalType": "string",
+        "name": "previousOrgJsonUriBackup1",
+        "type": "string"
+      },
+      {
+        "indexed": False,
+        "internalType": "string",
+        "name": "previousOrgJsonUriBackup2",
+        "type": "string"
+      },
+      {
+        "indexed": True,
+        "internalType": "bytes32",
+        "name": "newOrgJsonHash",
+        "type": "bytes32"
+      },
+      {
+        "indexed": False,
+        "internalType": "string",
+        "name": "newOrgJsonUri",
+        "type": "string"
+      },
+      {
+        "indexed": False,
+        "internalType": "string",
+        "name": "newOrgJsonUriBackup1",
+        "type": "string"
+      },
+      {
+        "indexed": False,
+        "internalType": "string",
+        "name": "newOrgJsonUriBackup2",
+        "type": "string"
+      }
+    ],
+    "name": "OrgJsonChanged",
+    "type": "event"
   }
 ]
@@ -14,4 +14,42 @@ app.config.from_pyfile('settings.py')
 app.logger.setLevel(level=logging.INFO)
 app.config['WTF_CSRF_ENABLED'] = True
 
-from simard import routes
+from simard import routes, commands
+
+# Provision the database indexes before serving requests
+from simard.settings import MONGO_ENSURE_INDEXES
+from simard.index_manager import IndexManager
+if MONGO_ENSURE_INDEXES:
+    try:
+        provisioned = IndexManager.ensure_indexes()
+        app.logger.info('Indexes: %i provisioned' % len(provisioned))
+
+    # The conflicting indexes are reported by flask indexes verify
+    except Exception as e:
+        app.logger.error('Index provisioning failed: %s' % str(e))
+
+# Populate the DID cache before serving requests
+from simard.settings import CACHE_WARM_UP_ENABLED
+from simard.cache_warmer import CacheWarmer
+if CACHE_WARM_UP_ENABLED:
+    try:
+        cached, resolved, failed = CacheWarmer.warm_up()
+        app.logger.info('Cache warm-up: %i cached, %i resolved, %i failed' % (cached, resolved, failed))
+
+    # The cache is populated by the requests otherwise
+    except Exception as e:
+        app.logger.error('Cache warm-up failed: %s' % str(e))
+
+# Invalidate the cached DIDs when the organizations change
+from simard.settings import ORGID_WATCHER_ENABLED
+from simard.orgid_watcher import OrgIdWatcher
+orgid_watcher = OrgIdWatcher()
+if ORGID_WATCHER_ENABLED:
+    orgid_watcher.start()
+
+# Release the expired guarantees in the background
+from simard.settings import GUARANTEE_SWEEPER_ENABLED
+from simard.guarantee_sweeper import GuaranteeSweeper
+guarantee_sweeper = GuaranteeSweeper()
+if GUARANTEE_SWEEPER_ENABLED:
+    guarantee_sweeper.start()
@@ -4,7 +4,12 @@ Define a class to manage the balance object
 from decimal import Decimal
 from model.exception import SimardException
 from simard.db import db
+from simard.ledger_checkpoint import LedgerCheckpoint
+from simard.index_manager import IndexManager
+from simard.settings import MATERIALIZED_BALANCES_ENABLED, MATERIALIZED_BALANCES_WRITES_ENABLED
 from bson.decimal128 import Decimal128
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from enum import Enum
 
 
@@ -19,14 +24,80 @@ class BalanceException(SimardException):
     pass
 
 
+# Guarantees holding a reservation
+# Those stored before the statuses are active until claimed, see Guarantee.migrate_statuses
+ACTIVE_GUARANTEE_FILTERS = {'$or': [
+    {'status': 'active'},
+    {'status': {'$exists': False}, 'claimed': False},
+]}
+
+
+class BalanceSnapshot(object):
+    """
+    Stores the totals of a balance computed at a given point in time
+    """
+    def __init__(
+        self,
+        orgid,
+        currency,
+        credit=Decimal(),
+        debit=Decimal(),
+        reserved=Decimal(),
+        claimable=Decimal()
+    ):
+        self.orgid = orgid
+        self.currency = currency
+        self.credit = credit
+        self.debit = debit
+        self.reserved = reserved
+        self.claimable = claimable
+
+    @property
+    def total(self):
+        """
+        Retrieve the total amount on the balance
+        """
+        return self.credit - self.debit
+
+    @property
+    def available(self):
+        """
+        Retrieve the total amount minus the reserved amount
+        """
+        return self.total - self.reserved
+
+
 class Balance(object):
     """
     Stores the balance of a given ORG.ID in a given currency
     """
+    # Fields of the materialized balance documents
+    _MATERIALIZED_FIELDS = {
+        BalanceFilter.CREDITED: 'credit',
+        BalanceFilter.DEBITED: 'debit',
+        BalanceFilter.RESERVED: 'reserved',
+        BalanceFilter.CLAIMABLE: 'claimable',
+    }
+
+    # Attempts to reserve an amount when the balance is updated concurrently
+    _RESERVE_ATTEMPTS = 5
+
+    # The database on which the balance indexes were provisioned
+    _indexed_database = None
+
     def __init__(self, orgid, currency):
         self.orgid = orgid
         self.currency = currency
 
+    @staticmethod
+    def to_decimal(total):
+        """
+        Convert an aggregated total to a Decimal
+        """
+        if type(total) is Decimal128:
+            return total.to_decimal()
+        return Decimal(total)
+
     @staticmethod
     def aggregate_with_filters(collection, filters):
         """
@@ -55,10 +126,7 @@ class Balance(object):
         for doc in result:
             total = doc['total']
             currency = doc['_id']
-            if type(total) is Decimal128:
-                totals[currency] = total.to_decimal()
-            else:
-                totals[currency] = Decimal(total)
+            totals[currency] = Balance.to_decimal(total)
 
         # Return either zero, a single object or a dict
         nb_currencies = len(totals.keys())
@@ -81,13 +149,26 @@ class Balance(object):
         else:
             raise BalanceException('Unsupported balance filter', 500)
 
+        filters = {
+            'currency': self.currency,
+            prop: self.orgid
+        }
+
+        # Only aggregate the settlements after the checkpoint
+        checkpoint = LedgerCheckpoint.from_storage(self.orgid, self.currency)
+        if checkpoint is None:
+            offset = Decimal()
+        else:
+            filters.update(checkpoint.settlement_filters)
+            if balance_filter == BalanceFilter.CREDITED:
+                offset = checkpoint.credit
+            else:
+                offset = checkpoint.debit
+
         # Execute the aggregate
-        return Balance.aggregate_with_filters(
+        return offset + Balance.aggregate_with_filters(
             collection=db.settlements,
-            filters={
-                'currency': self.currency,
-                prop: self.orgid
-            }
+            filters=filters
         )
 
     def aggregate_guarantees(self, balance_filter: BalanceFilter):
@@ -105,18 +186,120 @@ class Balance(object):
         # Execute the aggregate
         return Balance.aggregate_with_filters(
             collection=db.guarantees,
-            filters={
+            filters=dict(ACTIVE_GUARANTEE_FILTERS, **{
                 'currency': self.currency,
                 prop: self.orgid,
-                'claimed': False,
-            }
+            })
         )
 
+    def snapshot(self):
+        """
+        Retrieve credit, debit, reserved and claimable amounts in a single call
+        """
+        if MATERIALIZED_BALANCES_ENABLED:
+            return self.materialized_snapshot()
+        return self.ledger_snapshot()
+
+    def materialized_snapshot(self):
+        """
+        Retrieve the totals from the materialized balance document
+        """
+        return self.materialized_snapshot_from(db.balances.find_one({
+            'orgid': self.orgid,
+            'currency': self.currency
+        }))
+
+    def materialized_snapshot_from(self, result):
+        """
+        Create a snapshot from a materialized balance document
+        """
+        # A missing document means no operation was recorded
+        totals = {}
+        if result is not None:
+            for field in Balance._MATERIALIZED_FIELDS.values():
+                if field in result:
+                    totals[field] = Balance.to_decimal(result[field])
+
+        return BalanceSnapshot(self.orgid, self.currency, **totals)
+
+    def ledger_snapshot(self):
+        """
+        Compute the totals from the settlements and guarantees
+        """
+        # Sum of the amounts of a facet
+        def facet_total(side, prop):
+            return [
+                {'$match': {'_side': side, prop: self.orgid}},
+                {'$group': {'_id': None, 'total': {'$sum': '$amount'}}},
+            ]
+
+        # Only aggregate the settlements after the checkpoint
+        settlement_filters = {
+            'currency': self.currency,
+            '$or': [{'beneficiary': self.orgid}, {'initiator': self.orgid}],
+        }
+        checkpoint = LedgerCheckpoint.from_storage(self.orgid, self.currency)
+        if checkpoint is not None:
+            settlement_filters.update(checkpoint.settlement_filters)
+
+        # Settlements and active guarantees are processed in one pipeline
+        result = db.settlements.aggregate([
+            {
+                '$match': settlement_filters
+            },
+            {
+                '$addFields': {'_side': 'settlement'}
+            },
+            {
+                '$unionWith': {
+                    'coll': 'guarantees',
+                    'pipeline': [
+                        {
+                            '$match': {
+                                'currency': self.currency,
+                                '$and': [
+                                    ACTIVE_GUARANTEE_FILTERS,
+                                    {'$or': [{'beneficiary': self.orgid}, {'initiator': self.orgid}]},
+                                ],
+                            }
+                        },
+                        {
+                            '$addFields': {'_side': 'guarantee'}
+                        },
+                    ]
+                }
+            },
+            {
+                '$facet': {
+                    'credit': facet_total('settlement', 'beneficiary'),
+                    'debit': facet_total('settlement', 'initiator'),
+                    'reserved': facet_total('guarantee', 'initiator'),
+                    'claimable': facet_total('guarantee', 'beneficiary'),
+                }
+            },
+        ])
+
+        # The facet stage always returns a single document
+        snapshot = BalanceSnapshot(self.orgid, self.currency)
+        for doc in result:
+            for key, values in doc.items():
+                if values:
+                    setattr(snapshot, key, Balance.to_decimal(values[0]['total']))
+
+        # Add the checkpointed settlements
+        if checkpoint is not None:
+            snapshot.credit += checkpoint.credit
+            snapshot.debit += checkpoint.debit
+
+        return snapshot
+
     @property
     def credit(self):
         """
         Retrieve the total credited amount on the balance
         """
+        if MATERIALIZED_BALANCES_ENABLED:
+            return self.materialized_snapshot().credit
         return self.aggregate_settlements(BalanceFilter.CREDITED)
 
     @property
@@ -124,6 +307,8 @@ class Balance(object):
         """
         Retrieve the total debited amount on the balance
         """
+        if MATERIALIZED_BALANCES_ENABLED:
+            return self.materialized_snapshot().debit
         return self.aggregate_settlements(BalanceFilter.DEBITED)
 
     @property
@@ -131,6 +316,8 @@ class Balance(object):
         """
         Retrieve the total amount on the balance
         """
+        if MATERIALIZED_BALANCES_ENABLED:
+            return self.materialized_snapshot().total
         return self.credit - self.debit
 
     @property
@@ -138,6 +325,8 @@ class Balance(object):
         """
         Retrieve the reserved amount
         """
+        if MATERIALIZED_BALANCES_ENABLED:
+            return self.materialized_snapshot().reserved
         return self.aggregate_guarantees(BalanceFilter.RESERVED)
 
     @property
@@ -145,6 +334,8 @@ class Balance(object):
         """
         Retrieve the amount that can be claimed
         """
+        if MATERIALIZED_BALANCES_ENABLED:
+            return self.materialized_snapshot().claimable
         return self.aggregate_guarantees(BalanceFilter.CLAIMABLE)
 
     def guarantee_claimed(self, guarantee_uuid):
@@ -166,9 +357,312 @@ class Balance(object):
         Allows to retrieve the available amount
         Total amount minus reserved amount
         """
-        # TODO: The aggregated query needs to be optimized
-        # Current implementation makes 3 aggregate calls to the DB for this
-        return self.total - self.reserved
+        return self.snapshot().available
+
+    def reserve(self, amount, store, release):
+        """
+        Atomically reserve an amount if it is available
+        :param store: Called to record the reservation once the amount is secured
+        :param release: Called to revert the reservation on a concurrent update
+        :return: False if the available amount is insufficient
+        """
+        amount = Decimal(amount)
+        Balance.ensure_indexes()
+
+        # Materialized balances are checked and reserved in a single update
+        if MATERIALIZED_BALANCES_ENABLED:
+            def field(name):
+                return {'$ifNull': ['$%s' % name, Decimal128('0')]}
+
+            result = db.balances.find_one_and_update(
+                {
+                    'orgid': self.orgid,
+                    'currency': self.currency,
+                    '$expr': {
+                        '$gte': [
+                            {'$subtract': [{'$subtract': [field('credit'), field('debit')]}, field('reserved')]},
+                            Decimal128(amount)
+                        ]
+                    }
+                }, {
+                    '$inc': {'reserved': Decimal128(amount)}
+                }
+            )
+            if result is None:
+                return False
+
+            try:
+                store()
+            except Exception:
+                Balance.increment(self.currency, [(self.orgid, BalanceFilter.RESERVED, -amount)])
+                raise
+            return True
+
+        # Otherwise use optimistic concurrency on the balance version
+        # A concurrent update is detected by the unique orgid/currency index
+        for attempt in range(Balance._RESERVE_ATTEMPTS):
+            result = db.balances.find_one(
+                {'orgid': self.orgid, 'currency': self.currency},
+                {'version': 1}
+            )
+            version = None if result is None else result.get('version')
+
+            if self.available < amount:
+                return False
+            store()
+            Balance.increment(self.currency, [(self.orgid, BalanceFilter.RESERVED, amount)])
+
+            # The reservation is valid only if no other one was made meanwhile
+            try:
+                db.balances.update_one(
+                    {'orgid': self.orgid, 'currency': self.currency, 'version': version},
+                    {'$set': {'version': (version or 0) + 1}},
+                    upsert=True
+                )
+                return True
+            except DuplicateKeyError:
+                release()
+
+        raise BalanceException('Too many concurrent reservations, please retry', 409)
+
+    @staticmethod
+    def ensure_indexes():
+        """
+        Provision once the unique orgid/currency index the reservations and increments rely on
+        Without it, a concurrent update would insert a second balance instead of failing
+        """
+        if Balance._indexed_database is not db._database:
+            IndexManager.ensure_collection_indexes('balances', strict=True)
+            Balance._indexed_database = db._database
+
+    @staticmethod
+    def increment(currency, increments):
+        """
+        Atomically increment the totals of the materialized balances
+        :param increments: A list of (orgid, BalanceFilter, amount) tuples
+        """
+        # The totals read are maintained by the operations
+        if not MATERIALIZED_BALANCES_WRITES_ENABLED and not MATERIALIZED_BALANCES_ENABLED:
+            return None
+        Balance.ensure_indexes()
+
+        operations = []
+        for orgid, balance_filter, amount in increments:
+            field = Balance._MATERIALIZED_FIELDS[balance_filter]
+            operations.append(UpdateOne(
+                {'orgid': orgid, 'currency': currency},
+                {'$inc': {field: Decimal128(Decimal(amount))}},
+                upsert=True
+            ))
+
+        return db.balances.bulk_write(operations, ordered=False)
+
+    @staticmethod
+    def ledger_totals():
+        """
+        Compute the totals of all balances from the settlements and guarantees
+        """
+        aggregates = [
+            (db.settlements, BalanceFilter.CREDITED, 'beneficiary', {}),
+            (db.settlements, BalanceFilter.DEBITED, 'initiator', {}),
+            (db.guarantees, BalanceFilter.RESERVED, 'initiator', ACTIVE_GUARANTEE_FILTERS),
+            (db.guarantees, BalanceFilter.CLAIMABLE, 'beneficiary', ACTIVE_GUARANTEE_FILTERS),
+        ]
+
+        # Group each side of the ledger by orgid and currency
+        totals = {}
+        for collection, balance_filter, prop, filters in aggregates:
+            result = collection.aggregate([
+                {
+                    '$match': filters
+                },
+                {
+                    '$group': {
+                        '_id': {'orgid': '$%s' % prop, 'currency': '$currency'},
+                        'total': {'$sum': '$amount'},
+                    }
+                },
+            ])
+
+            field = Balance._MATERIALIZED_FIELDS[balance_filter]
+            for doc in result:
+                key = (doc['_id']['orgid'], doc['_id']['currency'])
+                if key not in totals:
+                    totals[key] = BalanceSnapshot(*key)
+                setattr(totals[key], field, Balance.to_decimal(doc['total']))
+
+        return totals
+
+    @staticmethod
+    def rebuild(dry_run=False):
+        """
+        Recompute the materialized balances from the ledger
+        The settlements and guarantees must not be written meanwhile, as the ledger and the
+        totals are not updated atomically. A total changed during the rebuild is not corrected.
+        Returns the list of (orgid, currency, field, drift) found
+        """
+        totals = Balance.ledger_totals()
+
+        # Add the balances only known from the materialized documents
+        materialized = {}
+        for doc in db.balances.find({}):
+            key = (doc['orgid'], doc['currency'])
+            materialized[key] = doc
+            if key not in totals:
+                totals[key] = BalanceSnapshot(*key)
+
+        # Compare each total and correct the drift with an increment
+        drifts = []
+        operations = []
+        for key, snapshot in totals.items():
+            doc = materialized.get(key, {})
+            increments = {}
+            for field in Balance._MATERIALIZED_FIELDS.values():
+                stored = Balance.to_decimal(doc.get(field, 0))
+                drift = getattr(snapshot, field) - stored
+                if drift != Decimal('0'):
+                    drifts.append((key[0], key[1], field, drift))
+                    increments[field] = Decimal128(drift)
+
+            # Only correct the totals which were not updated since they were read
+            if increments:
+                filters = {'orgid': key[0], 'currency': key[1]}
+                for field in Balance._MATERIALIZED_FIELDS.values():
+                    filters[field] = doc[field] if field in doc else {'$exists': False}
+                operations.append(UpdateOne(
+                    filters,
+                    {'$inc': increments},
+                    upsert=key not in materialized
+                ))
+
+        if operations and not dry_run:
+            try:
+                result = db.balances.bulk_write(operations, ordered=False).bulk_api_result
+            except BulkWriteError as e:
+                result = e.details
+
+            changed = len(operations) - result['nMatched'] - result['nUpserted']
+            if changed > 0:
+                raise BalanceException(
+                    '%i balance(s) changed during the rebuild, pause the writes and run it again' % changed,
+                    409
+                )
+
+        return drifts
+
+    @staticmethod
+    def snapshot_all(orgid):
+        """
+        Retrieve the snapshots of all the balances of an ORG.ID in a single call
+        A balance is returned if there is at least one settlement received
+        """
+        if MATERIALIZED_BALANCES_ENABLED:
+            result = db.balances.find({
+                'orgid': orgid,
+                'credit': {'$exists': True}
+            })
+            snapshots = []
+            for doc in result:
+                snapshot = Balance(orgid, doc['currency']).materialized_snapshot_from(doc)
+                snapshots.append(snapshot)
+            return snapshots
+
+        # Conditional sum of the amounts of a side
+        def side_total(side, prop, value='$amount'):
+            return {
+                '$sum': {
+                    '$cond': [
+                        {'$and': [
+                            {'$eq': ['$_side', side]},
+                            {'$eq': ['$%s' % prop, orgid]},
+                        ]},
+                        value,
+                        0
+                    ]
+                }
+            }
+
+        # Exclude the settlements included in the checkpoints
+        settlement_filters = {
+            '$or': [{'beneficiary': orgid}, {'initiator': orgid}],
+        }
+        checkpoints = LedgerCheckpoint.from_storage_all(orgid)
+        if checkpoints:
+            settlement_filters['$nor'] = [
+                {'currency': currency, '_id': {'$lt': checkpoint.until}}
+                for currency, checkpoint in checkpoints.items()
+            ]
+
+        # Settlements and active guarantees are grouped by currency
+        result = db.settlements.aggregate([
+            {
+                '$match': settlement_filters
+            },
+            {
+                '$addFields': {'_side': 'settlement'}
+            },
+            {
+                '$unionWith': {
+                    'coll': 'guarantees',
+                    'pipeline': [
+                        {
+                            '$match': {
+                                '$and': [
+                                    ACTIVE_GUARANTEE_FILTERS,
+                                    {'$or': [{'beneficiary': orgid}, {'initiator': orgid}]},
+                                ],
+                            }
+                        },
+                        {
+                            '$addFields': {'_side': 'guarantee'}
+                        },
+                    ]
+                }
+            },
+            {
+                '$group': {
+                    '_id': '$currency',
+                    'received': side_total('settlement', 'beneficiary', 1),
+                    'credit': side_total('settlement', 'beneficiary'),
+                    'debit': side_total('settlement', 'initiator'),
+                    'reserved': side_total('guarantee', 'initiator'),
+                    'claimable': side_total('guarantee', 'beneficiary'),
+                }
+            },
+        ])
+
+        # Add the checkpointed settlements to the recent ones
+        snapshots = []
+        for doc in result:
+            snapshot = BalanceSnapshot(
+                orgid=orgid,
+                currency=doc['_id'],
+                credit=Balance.to_decimal(doc['credit']),
+                debit=Balance.to_decimal(doc['debit']),
+                reserved=Balance.to_decimal(doc['reserved']),
+                claimable=Balance.to_decimal(doc['claimable']),
+            )
+            received = doc['received']
+            checkpoint = checkpoints.pop(snapshot.currency, None)
+            if checkpoint is not None:
+                snapshot.credit += checkpoint.credit
+                snapshot.debit += checkpoint.debit
+                received += checkpoint.received
+
+            if received > 0:
+                snapshots.append(snapshot)
+
+        # Add the balances without any recent operation
+        for currency, checkpoint in checkpoints.items():
+            if checkpoint.received > 0:
+                snapshots.append(BalanceSnapshot(
+                    orgid=orgid,
+                    currency=currency,
+                    credit=checkpoint.credit,
+                    debit=checkpoint.debit,
+                ))
+
+        return snapshots
 
     @classmethod
     def retrieve_all(cls, orgid):
@@ -3,7 +3,7 @@ Define a manager class to manage balance objects
 """
 from simard.balance import Balance
 from simard.settlement import Settlement
-from simard.guarantee import Guarantee
+from simard.guarantee import Guarantee, GuaranteeStatus
 from simard.account_manager import AccountManager, AccountManagerException
 from model.exception import SimardException
 from simard.settings import VIRTUAL_CARD_ORGID, SIMARD_ORGID
@@ -23,6 +23,11 @@ class BalanceManagerGuaranteeNotFoundException(SimardException):
     pass
 
 class BalanceManager(object):
+    # Maximum number of guarantees created in a single request
+    _MAX_GUARANTEES = 100
+
+    # Maximum number of settlements in a statement page
+    _MAX_STATEMENT_LIMIT = 1000
 
     @staticmethod
     def format_amount(amount, currency):
@@ -34,7 +39,7 @@ class BalanceManager(object):
         # Verify format
         parsed_orgid = Parser.parse_orgid(orgid)
 
-        return Balance.retrieve_all(parsed_orgid)
+        return Balance.snapshot_all(parsed_orgid)
 
     @staticmethod
     def get_balance(orgid, currency):
@@ -47,6 +52,40 @@ class BalanceManager(object):
             currency=parsed_currency
         )
 
+    @staticmethod
+    def get_statement(orgid, currency=None, start=None, end=None, cursor=None, limit=None):
+        """
+        Retrieve the settlements of an ORG.ID, after the cursor if provided
+        """
+        # Verify format before iterating
+        return Settlement.from_statement(
+            orgid=Parser.parse_orgid(orgid),
+            currency=None if currency is None else Parser.parse_currency(currency),
+            start=None if start is None else Parser.parse_date(start),
+            end=None if end is None else Parser.parse_date(end),
+            after=None if cursor is None else Parser.parse_cursor(cursor),
+            limit=None if limit is None else Parser.parse_integer(limit),
+        )
+
+    @staticmethod
+    def get_statement_page(orgid, currency=None, start=None, end=None, cursor=None, limit=100):
+        """
+        Retrieve a page of the settlements of an ORG.ID
+        Returns the settlements and the cursor of the next page if any
+        """
+        limit = Parser.parse_integer(limit)
+        if limit > BalanceManager._MAX_STATEMENT_LIMIT:
+            raise BalanceManagerException(
+                'Limit must not be greater than %i' % BalanceManager._MAX_STATEMENT_LIMIT,
+                400)
+
+        # Read one more settlement to know if there is a next page
+        settlements = list(BalanceManager.get_statement(orgid, currency, start, end, cursor, limit + 1))
+        if len(settlements) > limit:
+            return settlements[:limit], str(settlements[limit - 1]._id)
+
+        return settlements, None
+
     @staticmethod
     def execute_settlement(settlement: Settlement):
         try:
@@ -141,22 +180,28 @@ class BalanceManager(object):
                 400)
 
         try:
-            # Retrieve the initiating balance
-            balance = BalanceManager.get_balance(initiating_orgid, currency)
-            if(balance.available < amount_decimal):
-                raise BalanceManagerException(
-                    "Insufficient balance to create guarantee",
-                    400)
-
             # Make the guarantee
-            return Guarantee(
+            guarantee = Guarantee(
                 initiator=initiating_orgid,
                 beneficiary=receiving_orgid,
                 amount=amount_decimal,
                 currency=currency,
                 expiration=expiration_datetime,
                 agent=initiating_agent
-            ).store().uuid
+            )
+
+            # Reserve the amount on the initiating balance and store it
+            balance = BalanceManager.get_balance(initiating_orgid, currency)
+            if not balance.reserve(
+                amount_decimal,
+                store=lambda: guarantee.store(reserved=True),
+                release=guarantee.discard
+            ):
+                raise BalanceManagerException(
+                    "Insufficient balance to create guarantee",
+                    400)
+
+            return guarantee.uuid
 
         # Re-throw the exception if it is from Simard
         except SimardException as e:
@@ -167,6 +212,83 @@ class BalanceManager(object):
             raise BalanceManagerException('Could not create guarantee [%s|%s|%s]' % (str(e), currency, amount), 500) \
                 from e
 
+    @staticmethod
+    def add_guarantees(
+        initiating_orgid,
+        initiating_agent,
+        guarantees
+    ):
+        """
+        Adds several guarantees on the balances, all or none of them are created
+        """
+        # Verify format
+        initiating_orgid = Parser.parse_orgid(initiating_orgid)
+        initiating_agent = Parser.parse_agent(initiating_agent)
+        if not isinstance(guarantees, list):
+            raise BalanceManagerException('Missing or invalid guarantees array', 400)
+        if len(guarantees) == 0:
+            raise BalanceManagerException('No guarantees to process', 400)
+        if len(guarantees) > BalanceManager._MAX_GUARANTEES:
+            raise BalanceManagerException(
+                'Too many guarantees, the maximum is %i' % BalanceManager._MAX_GUARANTEES,
+                400)
+
+        # Parse all guarantees before creating any
+        parsed_guarantees = []
+        required_balances = {}
+        for index, item in enumerate(guarantees):
+            try:
+                if not isinstance(item, dict):
+                    raise BalanceManagerException('Invalid guarantee', 400)
+                SimardException.check_mandatory_keys(
+                    mandatory_keys=["creditorOrgId", "currency", "amount", "expiration"],
+                    received_keys=item.keys(),
+                )
+                receiving_orgid = Parser.parse_orgid(item["creditorOrgId"])
+                if(initiating_orgid == receiving_orgid):
+                    raise BalanceManagerException(
+                        "Can not create a guarantee for the same organization",
+                        400)
+
+                guarantee = Guarantee(
+                    initiator=initiating_orgid,
+                    beneficiary=receiving_orgid,
+                    amount=Parser.parse_amount(item["amount"]),
+                    currency=Parser.parse_currency(item["currency"]),
+                    expiration=Parser.parse_expiration(item["expiration"]),
+                    agent=initiating_agent
+                )
+            except SimardException as e:
+                raise BalanceManagerException('Guarantee %i: %s' % (index, e.description), e.code) from e
+
+            parsed_guarantees.append(guarantee)
+            required_balances.setdefault(guarantee.currency, []).append(guarantee)
+
+        # Reserve the total of each currency and insert its guarantees
+        stored_guarantees = []
+        try:
+            for currency, currency_guarantees in required_balances.items():
+                balance = BalanceManager.get_balance(initiating_orgid, currency)
+                if not balance.reserve(
+                    sum(guarantee.amount for guarantee in currency_guarantees),
+                    store=lambda: Guarantee.store_many(currency_guarantees, reserved=True),
+                    release=lambda: Guarantee.discard_many(currency_guarantees)
+                ):
+                    raise BalanceManagerException(
+                        "Insufficient balance to create guarantees: %s" % currency,
+                        400)
+                stored_guarantees.extend(currency_guarantees)
+
+        # Discard the guarantees of the other currencies
+        except Exception as e:
+            Guarantee.discard_many(stored_guarantees)
+
+            if isinstance(e, SimardException):
+                raise BalanceManagerException(e.description, e.code) from e
+            raise BalanceManagerException('Could not create guarantees [%s]' % str(e), 500) from e
+
+        return [guarantee.uuid for guarantee in parsed_guarantees]
+
     @staticmethod
     def get_guarantee(orgid, guarantee_id):
         # Verify format
@@ -176,8 +298,8 @@ class BalanceManager(object):
         # Retrieve the guarantee
         guarantee = Guarantee.from_storage(guarantee_id)
 
-        # Check if it exists
-        if guarantee is None:
+        # Check if it exists, released guarantees are only kept for history
+        if guarantee is None or guarantee.status in [GuaranteeStatus.CANCELLED, GuaranteeStatus.EXPIRED]:
             raise BalanceManagerGuaranteeNotFoundException(
                 "Guarantee not found", 404)
 
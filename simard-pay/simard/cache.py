@@ -4,113 +4,549 @@ Simple wrapper around redis for the project needs
 import redis
 import re
 import json
+import time
 import atexit
-from simard.settings import REDIS_URL
+import uuid
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from simard.settings import REDIS_URL, REDIS_SOCKET_TIMEOUT, REDIS_CONNECT_TIMEOUT, REDIS_MAX_CONNECTIONS, \
+    CACHE_LOCAL_MAX_ENTRIES, CACHE_LOCAL_MAX_TTL, CACHE_MEMORY_MAX_ENTRIES, CACHE_CODEC, CACHE_COMPRESSION_THRESHOLD
 from model.exception import SimardException
 
+# msgpack is optional, values are serialized as JSON without it
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 class CacheException(SimardException):
     pass
 
 
+# Redis failures for which the cache is bypassed
+REDIS_ERRORS = (redis.ConnectionError, redis.TimeoutError)
+
+
+class JsonCodec(object):
+    """
+    Serialize the values as JSON
+    """
+    VERSION = 1
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    """
+    Serialize the values as MessagePack, more compact and faster to decode
+    """
+    VERSION = 2
+
+    @staticmethod
+    def dumps(value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    @staticmethod
+    def loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# Codecs by name and by version
+CODECS = {'json': JsonCodec, 'msgpack': MsgpackCodec}
+CODEC_VERSIONS = {codec.VERSION: codec for codec in CODECS.values()}
+
+
+class Serializer(object):
+    """
+    Serialize the values with a codec, compressed above a size threshold
+    The first byte holds the codec version and the compression flag
+    """
+    _COMPRESSED = 0x80  # Flag on the version byte of compressed values
+    _COMPRESSION_LEVEL = 1  # Favor speed over size
+
+    def __init__(self, codec=CACHE_CODEC, compression_threshold=CACHE_COMPRESSION_THRESHOLD):
+        """
+        Constructor for the serializer
+        :param codec The name of the codec, JSON is used if msgpack is missing
+        :param compression_threshold The minimum size to compress, 0 to disable
+        """
+        if codec not in CODECS:
+            raise CacheException('Unsupported cache codec: %s' % codec, 500)
+        if codec == 'msgpack' and msgpack is None:
+            codec = 'json'
+        self._codec = CODECS[codec]
+        self._compression_threshold = compression_threshold
+
+    def dumps(self, value):
+        """
+        Serialize a value
+        """
+        version = self._codec.VERSION
+        data = self._codec.dumps(value)
+
+        # Compress the large values
+        if 0 < self._compression_threshold <= len(data):
+            data = zlib.compress(data, self._COMPRESSION_LEVEL)
+            version |= self._COMPRESSED
+
+        return bytes([version]) + data
+
+    def loads(self, serialized):
+        """
+        Deserialize a value, None if it cannot be decoded
+        """
+        # Values stored before the codecs are plain JSON
+        if isinstance(serialized, str):
+            return json.loads(serialized)
+
+        codec = CODEC_VERSIONS.get(serialized[0] & ~self._COMPRESSED)
+        if codec is None:
+            return json.loads(serialized)
+
+        # Values written by a worker with msgpack cannot be read without it
+        if codec is MsgpackCodec and msgpack is None:
+            return None
+
+        data = serialized[1:]
+        if serialized[0] & self._COMPRESSED:
+            data = zlib.decompress(data)
+
+        return codec.loads(data)
+
+
+class LocalCache(object):
+    """
+    Bounded in-process cache, the least recently used entries are evicted first
+    The values are shared between callers and must not be modified
+    """
+
+    def __init__(self, max_entries=CACHE_LOCAL_MAX_ENTRIES, max_ttl=CACHE_LOCAL_MAX_TTL):
+        """
+        Constructor for the local cache
+        :param max_entries The maximum number of entries, 0 to disable
+        :param max_ttl The maximum time to live of the entries in seconds, None for no limit
+        """
+        self._max_entries = max_entries
+        self._max_ttl = max_ttl
+        self._entries = OrderedDict()  # The (expiry time, value) by key
+        self._lock = Lock()  # A thread lock on the entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Get a value, None if missing or expired
+        """
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        """
+        Get a value and its remaining time to live in seconds, (None, None) if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                now = time.monotonic()
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1], entry[0] - now
+
+                # Remove the expired entry
+                del self._entries[key]
+
+            self.misses += 1
+            return None, None
+
+    def set(self, key, value, expiry, nx=False):
+        """
+        Set a value for a number of seconds
+        :param nx Only set the value if the key is missing or expired
+        Returns True if the value was set
+        """
+        if self._max_entries <= 0 or expiry <= 0:
+            return False
+        if self._max_ttl is not None:
+            expiry = min(expiry, self._max_ttl)
+
+        with self._lock:
+            now = time.monotonic()
+            if nx and key in self._entries and self._entries[key][0] > now:
+                return False
+
+            self._entries[key] = (now + expiry, value)
+            self._entries.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+            return True
+
+    def delete(self, key, value=None):
+        """
+        Remove a value
+        :param value Only remove it if it has this value
+        """
+        with self._lock:
+            if value is None or key in self._entries and self._entries[key][1] == value:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all values and reset the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Get the counters of the cache
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class RedisBackend(object):
+    """
+    Store the serialized values in Redis, shared between the workers
+    The methods raise one of REDIS_ERRORS when Redis is unavailable
+    """
+    # Delete a key only if it still has the value
+    _DELETE_IF_EQUAL_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, url, socket_timeout=None, connect_timeout=None, max_connections=None):
+        """
+        Constructor for the Redis backend
+        :param url The redis:// or rediss:// connection string
+        """
+        # Parse the connection string
+        m = re.match(
+            r'^redis(?P<ssl_flag>s)?://((?P<user_id>.+):(?P<user_password>.+)@)?(?P<host>.+):(?P<port>[0-9]+)(/\?password=(?P<password>.+))?$',
+            url
+        )
+
+        # Verify the parsing is successfull
+        if(not m):
+            raise CacheException('Server Error: Contact Support', 500)
+
+        # Configure the connections shared by the threads
+        connection_kwargs = {
+            'host': m.group('host'),
+            'port': m.group('port'),
+            'socket_timeout': socket_timeout,
+            'socket_connect_timeout': connect_timeout,
+            'max_connections': max_connections,
+        }
+
+        # Use TLS if requested
+        if m.group('ssl_flag') is not None:
+            connection_kwargs['connection_class'] = redis.SSLConnection
+
+        # for Redis versions that supports ACL. eg. v6
+        if m.group('user_id'):
+            connection_kwargs['username'] = m.group('user_id')
+            connection_kwargs['password'] = m.group('user_password')
+
+        # Otherwise with password if provided
+        elif m.group('password'):
+            connection_kwargs['password'] = m.group('password')
+
+        # Initialize the Redis Client on a connection pool
+        self.client = redis.Redis(
+            connection_pool=redis.ConnectionPool(**connection_kwargs)
+        )
+
+    def get(self, key):
+        """
+        Get a value and its remaining time to live in milliseconds
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.get(key)
+        pipeline.pttl(key)
+        return tuple(pipeline.execute())
+
+    def get_many(self, keys):
+        """
+        Get several values and their remaining time to live in a single round-trip
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.mget(keys)
+        for key in keys:
+            pipeline.pttl(key)
+        results = pipeline.execute()
+        return list(zip(results[0], results[1:]))
+
+    def set(self, key, value, expiry, nx=False):
+        """
+        Set a value for a number of seconds, only if missing with nx
+        """
+        if nx:
+            return self.client.set(key, value, nx=True, ex=expiry)
+        return self.client.set(key, value, ex=expiry)
+
+    def delete(self, key):
+        """
+        Delete a key
+        """
+        return self.client.delete(key)
+
+    def delete_if_equal(self, key, value):
+        """
+        Delete a key if it still has the value
+        """
+        return self.client.eval(self._DELETE_IF_EQUAL_SCRIPT, 1, key, value)
+
+    def close(self):
+        """
+        Close the connections
+        """
+        self.client.connection_pool.disconnect()
+
+
+class MemoryBackend(object):
+    """
+    Store the serialized values in the process, for single node deployments and local runs
+    The values are not shared between the workers
+    """
+
+    def __init__(self, max_entries=CACHE_MEMORY_MAX_ENTRIES):
+        """
+        Constructor for the in-memory backend
+        :param max_entries The maximum number of values
+        """
+        self._entries = LocalCache(max_entries, max_ttl=None)
+
+    def get(self, key):
+        """
+        Get a value and its remaining time to live in milliseconds
+        """
+        value, ttl = self._entries.get_with_ttl(key)
+        if value is None:
+            return None, -2
+        return value, int(ttl * 1000)
+
+    def get_many(self, keys):
+        """
+        Get several values and their remaining time to live
+        """
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, expiry, nx=False):
+        """
+        Set a value for a number of seconds, only if missing with nx
+        """
+        return self._entries.set(key, value, expiry, nx=nx)
+
+    def delete(self, key):
+        """
+        Delete a key
+        """
+        self._entries.delete(key)
+
+    def delete_if_equal(self, key, value):
+        """
+        Delete a key if it still has the value
+        """
+        self._entries.delete(key, value)
+
+    def close(self):
+        """
+        Drop the values
+        """
+        self._entries.clear()
+
+
 class Cache(object):
     # Define a time to catch the objects
     _DEFAULT_RETENTION_TIME = 60  # 60 seconds
     _REDIS_URL = REDIS_URL
+    _SOCKET_TIMEOUT = REDIS_SOCKET_TIMEOUT
+    _CONNECT_TIMEOUT = REDIS_CONNECT_TIMEOUT
+    _MAX_CONNECTIONS = REDIS_MAX_CONNECTIONS
 
     def __init__(self):
         """
         Constructor for the cache object
         """
-        self._redis = None
+        self._backend = None
+        self._local = LocalCache()  # In-process tier in front of the backend
+        self._serializer = Serializer()  # Encoding of the values in the backend
         atexit.register(self.cleanup)
 
-    def _get_redis(self):
+    def _get_backend(self):
         """
-        Wrapper to lazy load the redis client
+        Wrapper to lazy load the backend selected by the REDIS_URL
         """
-        if self._redis is None:
+        if self._backend is None:
 
             # Chech the REDIS_URL was provided
             if self._REDIS_URL is None:
                 raise CacheException('Server Error: Contact Support', 500)
 
-            # Parse the connection string
-            m = re.match(
-                r'^redis(?P<ssl_flag>s)?://((?P<user_id>.+):(?P<user_password>.+)@)?(?P<host>.+):(?P<port>[0-9]+)(/\?password=(?P<password>.+))?$',
-                self._REDIS_URL
-            )
-
-            # Verify the parsing is successfull
-            if(not m):
-                raise CacheException('Server Error: Contact Support', 500)
-
-            ssl_enabled = m.group('ssl_flag') is not None
-
-            # Initialize the Redis Client with password if provided
-            if m.group('password'):
-                self._redis = redis.Redis(
-                    host=m.group('host'),
-                    port=m.group('port'),
-                    password=m.group('password'),
-                    ssl=ssl_enabled
-                )
+            # Keep the values in the process
+            if self._REDIS_URL.startswith('memory://'):
+                self._backend = MemoryBackend()
 
-            # Otherwise without password
+            # Otherwise in Redis
             else:
-                self._redis = redis.Redis(
-                    host=m.group('host'),
-                    port=m.group('port'),
-                    ssl=ssl_enabled
+                self._backend = RedisBackend(
+                    self._REDIS_URL,
+                    socket_timeout=self._SOCKET_TIMEOUT,
+                    connect_timeout=self._CONNECT_TIMEOUT,
+                    max_connections=self._MAX_CONNECTIONS
                 )
 
-            # for Redis versions that supports ACL. eg. v6
-            if m.group('user_id'):
-                self._redis.execute_command(f"AUTH {m.group('user_id')} {m.group('user_password')}")
-
-        return self._redis
+        return self._backend
 
     def cleanup(self):
         """
         Cleanup the cache, close connections
         """
-        if self._redis is not None:
-            self._redis.close()
-            self._redis = None
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
 
-    def store(self, key, object, expiry=None):
+    def store(self, key, object, expiry=None, local=None):
         """
         Store a value
+        :param local The local tier of the value, the shared one by default
         """
-        # Serialize the object as JSON
-        serialized = json.dumps(object)
+        if local is None:
+            local = self._local
+
+        # Serialize the object
+        serialized = self._serializer.dumps(object)
 
         # Define the retention time
         if expiry is None:
             expiry = self._DEFAULT_RETENTION_TIME
 
+        # Keep the value in the local tier with the same retention
+        local.set(key, object, expiry)
+
         # Store the value
         try:
-            return self._get_redis().set(key, serialized, ex=expiry)
-        except redis.ConnectionError:
+            return self._get_backend().set(key, serialized, expiry)
+        except REDIS_ERRORS:
             return None
 
-    def retrieve(self, key):
+    def retrieve(self, key, local=None):
         """
         Retrieve a value from the cache
+        :param local The local tier of the value, the shared one by default
         """
-        # Retrieve the serialized object
+        if local is None:
+            local = self._local
+
+        # Try the local tier first
+        value = local.get(key)
+        if value is not None:
+            return value
+
+        # Retrieve the serialized object and its remaining time to live
         try:
-            serialized = self._get_redis().get(key)
-        except redis.ConnectionError:
+            serialized, ttl = self._get_backend().get(key)
+        except REDIS_ERRORS:
             serialized = None
 
         # If not Found, return None
         if not serialized:
             return None
 
-        # Otherwise return the unserialized object
-        return json.loads(serialized)
+        # Otherwise keep it locally until it expires from Redis
+        value = self._serializer.loads(serialized)
+        if value is not None and ttl > 0:
+            local.set(key, value, ttl / 1000)
+
+        return value
+
+    def retrieve_many(self, keys):
+        """
+        Retrieve several values in a single round-trip
+        Returns the values in the order of the keys, None if not found
+        """
+        # Try the local tier first
+        values = [self._local.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if not missing:
+            return values
+
+        # Retrieve the missing objects and their remaining time to live
+        try:
+            results = self._get_backend().get_many(missing)
+        except REDIS_ERRORS:
+            return values
+
+        found = {}
+        for key, (serialized, ttl) in zip(missing, results):
+            if serialized:
+                found[key] = self._serializer.loads(serialized)
+
+                # Keep it locally until it expires from Redis
+                if found[key] is not None and ttl > 0:
+                    self._local.set(key, found[key], ttl / 1000)
+
+        return [found.get(key) if value is None else value for key, value in zip(keys, values)]
+
+    def delete(self, key):
+        """
+        Remove a value from the cache
+        """
+        self._local.delete(key)
+        try:
+            self._get_backend().delete(key)
+        except REDIS_ERRORS:
+            pass
+
+    def acquire_lock(self, key, lease):
+        """
+        Acquire a lock shared between the workers for a lease in seconds
+        Returns the token of the lock, None if it is held by someone else
+        """
+        token = uuid.uuid4().hex
+        try:
+            if self._get_backend().set(key, token, lease, nx=True):
+                return token
+            return None
+
+        # Without Redis the lock is only held within the worker
+        except REDIS_ERRORS:
+            return token
+
+    def release_lock(self, key, token):
+        """
+        Release a lock, unless its lease expired and it was acquired again
+        """
+        try:
+            self._get_backend().delete_if_equal(key, token)
+        except REDIS_ERRORS:
+            pass
+
+    def stats(self):
+        """
+        Get the counters of the local tier
+        """
+        return self._local.stats()
 
 
 cache = Cache()
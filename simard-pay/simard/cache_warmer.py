@@ -0,0 +1,76 @@
+"""
+Define a helper to populate the DID cache before serving requests
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from bson.objectid import ObjectId
+from simard.db import db
+from simard.cache import cache
+from simard.did_resolver import DidResolver
+from simard.parser import Parser, ParserException
+from simard.settings import CACHE_WARM_UP_WORKERS, CACHE_WARM_UP_DAYS
+
+
+class CacheWarmer(object):
+    """
+    Resolves the known organizations so the first requests hit the cache
+    """
+
+    @staticmethod
+    def collect_orgids(days=CACHE_WARM_UP_DAYS):
+        """
+        Collect the ORG.IDs of the profiles, accounts and recent settlements
+        :param days The age of the settlements to consider
+        """
+        orgids = set(db.profiles.distinct('orgid'))
+        orgids.update(db.accounts.distinct('orgid'))
+
+        # Only the recently active organizations of the ledger
+        since = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(days=days))
+        for prop in ['beneficiary', 'initiator']:
+            orgids.update(db.settlements.distinct(prop, {'_id': {'$gte': since}}))
+
+        # Skip the values which are not ORG.IDs
+        valid_orgids = set()
+        for orgid in orgids:
+            try:
+                valid_orgids.add(Parser.parse_orgid(orgid))
+            except ParserException:
+                pass
+
+        return sorted(valid_orgids)
+
+    @staticmethod
+    def warm_up(orgids=None, workers=CACHE_WARM_UP_WORKERS):
+        """
+        Resolve the ORG.IDs missing from the cache with a bounded parallelism
+        :param orgids The ORG.IDs to resolve, the known ones by default
+        :param workers The number of concurrent resolutions
+        Returns the number of ORG.IDs (already cached, resolved, failed)
+        """
+        if orgids is None:
+            orgids = CacheWarmer.collect_orgids()
+        dids = [DidResolver.normalize(orgid) for orgid in orgids]
+        if not dids:
+            return 0, 0, 0
+
+        # Skip the DIDs already cached
+        cached_entries = cache.retrieve_many([DidResolver.cache_key(did) for did in dids])
+        missing = [did for did, cached_entry in zip(dids, cached_entries) if cached_entry is None]
+
+        # Resolve the others concurrently
+        failed = 0
+        if missing:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cache-warm-up') as executor:
+                futures = [executor.submit(DidResolver.coalesced_resolve, did) for did in missing]
+                for did, future in zip(missing, futures):
+                    try:
+                        future.result()
+
+                    # Failures are left to the requests
+                    except Exception as e:
+                        failed += 1
+                        logging.warning('Could not resolve %s: %s' % (did, str(e)))
+
+        return len(dids) - len(missing), len(missing) - failed, failed
@@ -0,0 +1,180 @@
+"""
+Define the command line tools of the application
+"""
+import click
+from datetime import timedelta
+from flask.cli import AppGroup
+from simard import app
+from simard.balance import Balance, BalanceException
+from simard.ledger_checkpoint import LedgerCheckpoint
+from simard.index_manager import IndexManager, INDEXES
+from simard.guarantee import Guarantee
+from simard.cache_warmer import CacheWarmer
+from simard.orgid_watcher import OrgIdWatcher, OrgIdWatcherException
+from simard.secp256k1 import Secp256k1
+from simard.settings import CACHE_WARM_UP_DAYS, CACHE_WARM_UP_WORKERS
+
+
+# Commands to maintain the balances
+balances_cli = AppGroup('balances', help='Manage the materialized balances')
+
+
+@balances_cli.command('rebuild')
+@click.option('--dry-run', is_flag=True, help='Only report the drift.')
+def rebuild_balances(dry_run):
+    """
+    Recompute the materialized balances from the ledger
+
+    The settlements and guarantees must not be written while the balances are corrected,
+    stop the API and the event handlers first.
+    """
+    try:
+        drifts = Balance.rebuild(dry_run=dry_run)
+    except BalanceException as e:
+        raise click.ClickException(e.description)
+
+    # Report each drift found
+    for orgid, currency, field, drift in drifts:
+        click.echo('%s %s %s: %s' % (orgid, currency, field, drift))
+
+    click.echo('%i drift(s) %s' % (
+        len(drifts),
+        'found' if dry_run else 'corrected'
+    ))
+
+
+@balances_cli.command('checkpoint')
+@click.option('--lag-hours', default=24, show_default=True, help='Age of the settlements to checkpoint.')
+@click.option('--full', is_flag=True, help='Recompute the checkpoints from the start of the ledger.')
+def checkpoint_balances(lag_hours, full):
+    """
+    Move the ledger checkpoints forward
+    """
+    count = LedgerCheckpoint.run(lag=timedelta(hours=lag_hours), full=full)
+    click.echo('%i checkpoint(s) updated' % count)
+
+
+# Commands to maintain the database indexes
+indexes_cli = AppGroup('indexes', help='Manage the database indexes')
+
+
+@indexes_cli.command('ensure')
+def ensure_indexes():
+    """
+    Create the missing database indexes
+    """
+    provisioned = IndexManager.ensure_indexes()
+    for collection, name in provisioned:
+        click.echo('%s.%s: ok' % (collection, name))
+
+    # The conflicts were logged
+    expected = sum(len(indexes) for indexes in INDEXES.values())
+    if len(provisioned) < expected:
+        raise click.ClickException(
+            '%i index(es) could not be created, run flask indexes verify' % (expected - len(provisioned)))
+
+
+@indexes_cli.command('verify')
+def verify_indexes():
+    """
+    Verify the database indexes match the declared ones
+    """
+    problems = IndexManager.verify_indexes()
+    for collection, name, problem in problems:
+        click.echo('%s.%s: %s' % (collection, name, problem))
+
+    if problems:
+        raise click.ClickException('%i index problem(s) found' % len(problems))
+    click.echo('All indexes verified')
+
+
+@indexes_cli.command('explain')
+def explain_queries():
+    """
+    Print the query plans of the canonical queries
+    """
+    for collection, filters, stages in IndexManager.explain_queries():
+        click.echo('%s %s: %s' % (collection, filters, ' > '.join(stages)))
+
+
+# Commands to maintain the guarantees
+guarantees_cli = AppGroup('guarantees', help='Manage the guarantees')
+
+
+@guarantees_cli.command('sweep')
+def sweep_guarantees():
+    """
+    Release the expired guarantees which are still active
+    """
+    count = Guarantee.sweep_expired()
+    click.echo('%i expired guarantee(s) released' % count)
+
+
+@guarantees_cli.command('migrate')
+def migrate_guarantees():
+    """
+    Convert the guarantees stored with a previous format
+    """
+    count = Guarantee.migrate_expirations()
+    click.echo('%i expiration(s) migrated' % count)
+
+    count = Guarantee.migrate_statuses()
+    click.echo('%i status(es) migrated' % count)
+
+
+# Commands to maintain the cache
+cache_cli = AppGroup('cache', help='Manage the cache')
+
+
+@cache_cli.command('warm')
+@click.option('--days', default=CACHE_WARM_UP_DAYS, show_default=True, help='Age of the settlements to consider.')
+@click.option('--workers', default=CACHE_WARM_UP_WORKERS, show_default=True, help='Number of concurrent resolutions.')
+def warm_cache(days, workers):
+    """
+    Resolve the known organizations missing from the cache
+    """
+    orgids = CacheWarmer.collect_orgids(days=days)
+    cached, resolved, failed = CacheWarmer.warm_up(orgids, workers=workers)
+    click.echo('%i organization(s) already cached' % cached)
+    click.echo('%i organization(s) resolved' % resolved)
+    click.echo('%i organization(s) failed' % failed)
+
+
+@cache_cli.command('invalidate')
+@click.option('--from-block', type=int, required=True, help='First block of the ORG.ID contract logs.')
+@click.option('--to-block', type=int, required=True, help='Last block of the ORG.ID contract logs.')
+def invalidate_cache(from_block, to_block):
+    """
+    Invalidate the organizations changed in a range of blocks
+    """
+    watcher = OrgIdWatcher()
+    try:
+        watcher.verify_events()
+    except OrgIdWatcherException as e:
+        raise click.ClickException(e.description)
+
+    orgids = watcher.read_logs(from_block, to_block)
+    for orgid in sorted(orgids):
+        click.echo(orgid)
+    click.echo('%i organization(s) invalidated' % len(orgids))
+
+
+# Commands to assess the cryptography
+crypto_cli = AppGroup('crypto', help='Assess the signature verification')
+
+
+@crypto_cli.command('benchmark')
+@click.option('--iterations', default=200, show_default=True, help='Number of operations per measure.')
+def benchmark_crypto(iterations):
+    """
+    Measure the secp256k1 throughput of each backend on a single core
+    """
+    for name, verify_rate, recover_rate in Secp256k1.benchmark(iterations):
+        click.echo('%s: %i verification(s)/s, %i recovery(ies)/s' % (name, verify_rate, recover_rate))
+
+
+app.cli.add_command(balances_cli)
+app.cli.add_command(indexes_cli)
+app.cli.add_command(guarantees_cli)
+app.cli.add_command(cache_cli)
+app.cli.add_command(crypto_cli)
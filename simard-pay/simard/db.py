@@ -38,6 +38,17 @@ class DB(object):
     def profiles(self):
         return self._database.profiles
 
+    @property
+    def balances(self):
+        return self._database.balances
+
+    @property
+    def balance_checkpoints(self):
+        return self._database.balance_checkpoints
+
+    def get_collection(self, name):
+        return self._database.get_collection(name)
+
     def is_collection_created(self, name):
         return (name in self._database.list_collection_names())
 
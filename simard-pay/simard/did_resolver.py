@@ -13,8 +13,12 @@ from schemas import abi, yaml
 from datetime import datetime, timezone, timedelta
 from simard.cache import cache
 from flask import has_request_context, g
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from threading import Lock
 import logging
-from simard.settings import ORGID_CONTRACT
+import time
+from simard.settings import ORGID_CONTRACT, DID_CACHE_SOFT_TTL, DID_CACHE_HARD_TTL, DID_REFRESH_WORKERS, \
+    DID_RESOLUTION_LEASE, DID_CACHE_NEGATIVE_TTL, DID_FETCH_TIMEOUT, DID_HEDGE_DELAY, DID_FETCH_WORKERS
 
 
 # Class to parse the smartcontract answer
@@ -37,10 +41,49 @@ class DidResolverException(SimardException):
     pass
 
 
+class DidDocumentException(DidResolverException):
+    """
+    Errors caused by the published organization, kept in cache for a while
+    """
+    pass
+
+
 class DidResolver(object):
     """
     Wrapper for DID resolving operations
     """
+    # Cached results older than the soft TTL are refreshed in the background
+    # Results are kept in cache until the hard TTL
+    _SOFT_TTL = DID_CACHE_SOFT_TTL
+    _HARD_TTL = DID_CACHE_HARD_TTL
+
+    # Failures caused by the published organization are cached shortly
+    _NEGATIVE_TTL = DID_CACHE_NEGATIVE_TTL
+
+    # Background workers refreshing the cached results
+    _refresh_executor = ThreadPoolExecutor(
+        max_workers=DID_REFRESH_WORKERS,
+        thread_name_prefix='did-refresh'
+    )
+    _refreshing = set()  # The DIDs being refreshed
+    _refreshing_lock = Lock()  # A thread lock on the DIDs being refreshed
+
+    # Resolutions in progress, shared by the threads waiting for the same DID
+    _inflight = {}  # The futures of the resolutions by DID
+    _inflight_lock = Lock()  # A thread lock on the resolutions in progress
+
+    # Lease of the lock shared between workers resolving the same DID
+    _RESOLUTION_LEASE = DID_RESOLUTION_LEASE
+    _RESOLUTION_POLL_INTERVAL = 0.05  # 50 milliseconds
+
+    # Fetch of the off-chain documents, the backup URIs are raced after the hedge delay
+    _FETCH_TIMEOUT = DID_FETCH_TIMEOUT
+    _HEDGE_DELAY = DID_HEDGE_DELAY
+    _fetch_executor = ThreadPoolExecutor(
+        max_workers=DID_FETCH_WORKERS,
+        thread_name_prefix='did-fetch'
+    )
+
     @staticmethod
     def get_orgid_contract():
         orgid_contract = w3.eth.contract(
@@ -70,28 +113,76 @@ class DidResolver(object):
         if o.exists:
             return o
         else:
-            raise DidResolverException('Organization does not exist', 404)
+            raise DidDocumentException('Organization does not exist', 404)
 
     @staticmethod
-    def get_offchain_document(doc_url: str, doc_hash: bytes):
+    def fetch_offchain_document(doc_url: str, doc_hash: bytes):
         """
-        Resolve a document
+        Retrieve a document from an URI and verify its hash
         """
         # Check that the scheme is supported
         scheme = urlparse(doc_url).scheme
 
         # Get the document
         if scheme in ['http', 'https']:
-            doc = requests.get(doc_url).text
+            try:
+                doc = requests.get(doc_url, timeout=DidResolver._FETCH_TIMEOUT).text
+            except requests.RequestException as e:
+                logging.error(str(e))
+                raise DidResolverException(
+                    'Error Retrieving Offchain Document',
+                    500) from e
         else:
-            raise DidResolverException('Document URL not supported', 500)
+            raise DidDocumentException('Document URL not supported', 500)
 
         # Verify the hash
         if(doc_hash != bytes(w3.sha3(doc))):
-            raise DidResolverException('Organization hash does not match', 403)
+            raise DidDocumentException('Organization hash does not match', 403)
 
         return doc
 
+    @staticmethod
+    def get_offchain_document(doc_url: str, doc_hash: bytes, backup_urls=()):
+        """
+        Resolve a document, from the backup URIs if the primary one is slow or fails
+        The first document matching the hash is returned
+        """
+        backup_urls = [url for url in backup_urls if url and url != doc_url]
+        if not backup_urls:
+            return DidResolver.fetch_offchain_document(doc_url, doc_hash)
+
+        # Give the primary URI a head start
+        primary = DidResolver._fetch_executor.submit(DidResolver.fetch_offchain_document, doc_url, doc_hash)
+        wait([primary], timeout=DidResolver._HEDGE_DELAY)
+        if primary.done() and primary.exception() is None:
+            return primary.result()
+
+        # Then race the backup URIs
+        pending = {primary}
+        for url in backup_urls:
+            pending.add(DidResolver._fetch_executor.submit(DidResolver.fetch_offchain_document, url, doc_hash))
+
+        deadline = time.monotonic() + DidResolver._FETCH_TIMEOUT
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=max(deadline - time.monotonic(), 0),
+                return_when=FIRST_COMPLETED
+            )
+            if not done:
+                break
+
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+
+        # The primary URI may answer right after the deadline, otherwise report its error
+        if primary.done():
+            if primary.exception() is None:
+                return primary.result()
+            raise primary.exception()
+        raise DidResolverException('Error Retrieving Offchain Document', 500)
+
     @staticmethod
     def validate_offchain_document(doc):
         try:
@@ -102,7 +193,7 @@ class DidResolver(object):
             validate(instance, yaml.orgid)
 
         except ValidationError as e:
-            raise DidResolverException(
+            raise DidDocumentException(
                 'Organization schema not valid',
                 500) from e
 
@@ -122,7 +213,8 @@ class DidResolver(object):
         # Resolve the offchain document
         document = DidResolver.get_offchain_document(
             organization.orgJsonUri,
-            organization.orgJsonHash
+            organization.orgJsonHash,
+            [organization.orgJsonUriBackup1, organization.orgJsonUriBackup2]
         )
         orgid = "0x%s" % organization.orgId.hex()
 
@@ -158,39 +250,215 @@ class DidResolver(object):
 
         return result
 
+    @staticmethod
+    def normalize(did: str):
+        """
+        Get the canonical DID of an ORG.ID, with or without the DID prefix
+        """
+        return "did:orgid:%s" % Parser.parse_orgid(did).lower()
+
+    @staticmethod
+    def cache_key(did: str):
+        """
+        Get the cache key of a DID result
+        The entries of the previous format expire under the former prefix
+        """
+        return "didResultSimardV2_%s" % did
+
+    @staticmethod
+    def store_result(did: str, result):
+        """
+        Store a DID result in cache with its resolution time
+        """
+        cache.store(
+            DidResolver.cache_key(did),
+            {'result': result, 'resolvedAt': time.time()},
+            expiry=DidResolver._HARD_TTL
+        )
+
+    @staticmethod
+    def store_error(did: str, error: DidDocumentException):
+        """
+        Store a DID resolution failure in cache
+        """
+        cache.store(
+            DidResolver.cache_key(did),
+            {'error': {'description': error.description, 'code': error.code}},
+            expiry=DidResolver._NEGATIVE_TTL
+        )
+
+    @staticmethod
+    def cached_error(cached_entry):
+        """
+        Get the exception of a cached resolution failure
+        """
+        error = cached_entry['error']
+        return DidDocumentException(error['description'], error['code'])
+
+    @staticmethod
+    def invalidate(orgid: str):
+        """
+        Remove the cached results of an ORG.ID
+        """
+        cache.delete(DidResolver.cache_key(DidResolver.normalize(orgid)))
+
+    @staticmethod
+    def lock_key(did: str):
+        """
+        Get the key of the lock shared between workers resolving a DID
+        """
+        return "didLockSimard_%s" % did
+
+    @staticmethod
+    def locked_resolve(did: str):
+        """
+        Perform a full resolution and store it in cache, once across workers
+        """
+        lock_key = DidResolver.lock_key(did)
+        deadline = time.monotonic() + DidResolver._RESOLUTION_LEASE
+        token = cache.acquire_lock(lock_key, DidResolver._RESOLUTION_LEASE)
+
+        # Wait for the worker holding the lock to store its result
+        while token is None and time.monotonic() < deadline:
+            time.sleep(DidResolver._RESOLUTION_POLL_INTERVAL)
+            cached_entry = cache.retrieve(DidResolver.cache_key(did))
+            if cached_entry and 'result' in cached_entry:
+                return cached_entry['result']
+            if cached_entry and 'error' in cached_entry:
+                raise DidResolver.cached_error(cached_entry)
+            token = cache.acquire_lock(lock_key, DidResolver._RESOLUTION_LEASE)
+
+        # Resolve while holding the lock, or without once the lease is over
+        try:
+            result = DidResolver.full_resolve(did)
+            DidResolver.store_result(did, result)
+            return result
+
+        # Answer the next resolutions from cache
+        except DidDocumentException as e:
+            DidResolver.store_error(did, e)
+            raise
+
+        finally:
+            if token is not None:
+                cache.release_lock(lock_key, token)
+
+    @staticmethod
+    def coalesced_resolve(did: str):
+        """
+        Perform a full resolution, once across the threads resolving a DID
+        """
+        with DidResolver._inflight_lock:
+            future = DidResolver._inflight.get(did)
+            leader = future is None
+            if leader:
+                future = Future()
+                DidResolver._inflight[did] = future
+
+        # Wait for the resolution in progress in another thread
+        if not leader:
+            return future.result()
+
+        try:
+            result = DidResolver.locked_resolve(did)
+            future.set_result(result)
+            return result
+
+        # Share the error with the waiting threads
+        except Exception as e:
+            future.set_exception(e)
+            raise
+
+        finally:
+            with DidResolver._inflight_lock:
+                del DidResolver._inflight[did]
+
+    @staticmethod
+    def refresh(did: str):
+        """
+        Resolve a DID again and update the cache
+        """
+        lock_key = DidResolver.lock_key(did)
+        token = cache.acquire_lock(lock_key, DidResolver._RESOLUTION_LEASE)
+        try:
+            # Another worker is already resolving it
+            if token is None:
+                return
+
+            DidResolver.store_result(did, DidResolver.full_resolve(did))
+
+        # The stale result is served until the hard TTL
+        except Exception as e:
+            logging.error('Could not refresh %s: %s' % (did, str(e)))
+
+        finally:
+            if token is not None:
+                cache.release_lock(lock_key, token)
+            with DidResolver._refreshing_lock:
+                DidResolver._refreshing.discard(did)
+
+    @staticmethod
+    def schedule_refresh(did: str):
+        """
+        Refresh a DID in the background, unless it is already being refreshed
+        """
+        with DidResolver._refreshing_lock:
+            if did in DidResolver._refreshing:
+                return False
+            DidResolver._refreshing.add(did)
+
+        DidResolver._refresh_executor.submit(DidResolver.refresh, did)
+        return True
+
+    @staticmethod
+    def remember_result(did: str, result):
+        """
+        Keep a DID result in the Flask request context
+        """
+        if has_request_context():
+            if not hasattr(g, 'did_results'):
+                g.did_results = {}
+            g.did_results[did] = result
+
+    @staticmethod
+    def from_cached_entry(did: str, cached_entry):
+        """
+        Get the DID result of a cache entry, None if not cached
+        """
+        if cached_entry and 'result' in cached_entry:
+            # Serve a stale result while it is refreshed
+            if time.time() - cached_entry['resolvedAt'] > DidResolver._SOFT_TTL:
+                DidResolver.schedule_refresh(did)
+
+            return cached_entry['result']
+
+        # Fail again while the failure is cached
+        if cached_entry and 'error' in cached_entry:
+            raise DidResolver.cached_error(cached_entry)
+
+        return None
+
     @staticmethod
     def resolve(did: str):
         """
         Resolve a DID, using cache if possible
         :param did The DID to resolve
         """
+        did = DidResolver.normalize(did)
+
         # Try to get the DID from Flask request context
         if has_request_context() and hasattr(g, 'did_results') and did in g.did_results:
             return g.did_results[did]
 
         # Try to get the DID from Cache
-        did_cache_key = "didResultSimard_%s" % did
-        cached_result = cache.retrieve(did_cache_key)
-
-        if cached_result:
-            # Update the request context
-            if has_request_context():
-                g.did_result = cached_result
+        result = DidResolver.from_cached_entry(did, cache.retrieve(DidResolver.cache_key(did)))
 
-            # return the cached value
-            return cached_result
-
-        # Otherwise perform a full resolution
-        result = DidResolver.full_resolve(did)
+        # Otherwise perform a full resolution, shared with concurrent callers
+        if result is None:
+            result = DidResolver.coalesced_resolve(did)
 
         # Update FLask request context
-        if has_request_context():
-            if not hasattr(g, 'did_results'):
-                g.did_results = {}
-            g.did_results[did] = result
-
-        # Store in Cache
-        cache.store(did_cache_key, result)
+        DidResolver.remember_result(did, result)
 
         # Return the retrieved result
         return result
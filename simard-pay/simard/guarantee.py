@@ -6,14 +6,24 @@ from bson.decimal128 import Decimal128
 from decimal import Decimal
 from model.exception import SimardException
 from simard.db import db
+from simard.balance import Balance, BalanceFilter
+from pymongo import UpdateOne
 import dateutil.parser
-from datetime import datetime
+from datetime import datetime, timezone
+from enum import Enum
 
 
 class GuaranteeException(SimardException):
     pass
 
 
+class GuaranteeStatus(Enum):
+    ACTIVE = 'active'        # The amount is reserved
+    CLAIMED = 'claimed'      # The amount is settled to the beneficiary
+    CANCELLED = 'cancelled'  # Canceled by one of the parties
+    EXPIRED = 'expired'      # Released by the expiry sweeper
+
+
 class Guarantee(object):
     """
     Define a guarantee
@@ -37,13 +47,24 @@ class Guarantee(object):
         self.currency = currency
         self.expiration = expiration
         self.agent = agent
-        self.claimed = False
+        self.status = GuaranteeStatus.ACTIVE
 
         # Create default values
         self.uuid = str(uuid.uuid4())
         self._id = None
 
-    def store(self):
+    @property
+    def claimed(self):
+        """
+        Check if the guarantee has been claimed
+        """
+        return self.status == GuaranteeStatus.CLAIMED
+
+    def store(self, reserved=False):
+        """
+        Store the guarantee
+        :param reserved: The amount is already reserved on the initiator balance
+        """
         # For a new insertion, update the internal DB identifier
         if(self._id is None):
             result = db.guarantees.insert_one({
@@ -52,12 +73,16 @@ class Guarantee(object):
                 "beneficiary": self.beneficiary,
                 "amount": Decimal128(self.amount),
                 "currency": self.currency,
-                "expiration": self.expiration.isoformat(),
+                "expiration": self.expiration,
                 "agent": self.agent,
-                "claimed": self.claimed
+                "status": self.status.value
             })
             self._id = result.inserted_id
 
+            # Reserve the amount on the materialized balances
+            if self.status == GuaranteeStatus.ACTIVE:
+                self._increment_balances(self.amount, reserved)
+
         # For an update, update the values
         else:
             db.guarantees.update_one(
@@ -69,9 +94,9 @@ class Guarantee(object):
                         "beneficiary": self.beneficiary,
                         "amount": Decimal128(self.amount),
                         "currency": self.currency,
-                        "expiration": self.expiration.isoformat(),
+                        "expiration": self.expiration,
                         "agent": self.agent,
-                        "claimed": self.claimed
+                        "status": self.status.value
                     }
                 },
                 upsert=True
@@ -80,29 +105,225 @@ class Guarantee(object):
         # Return self for chaining
         return self
 
+    @staticmethod
+    def store_many(guarantees, reserved=False):
+        """
+        Insert new guarantees at once
+        :param reserved: The amounts are already reserved on the initiator balances
+        """
+        result = db.guarantees.insert_many([{
+            "uuid": guarantee.uuid,
+            "initiator": guarantee.initiator,
+            "beneficiary": guarantee.beneficiary,
+            "amount": Decimal128(guarantee.amount),
+            "currency": guarantee.currency,
+            "expiration": guarantee.expiration,
+            "agent": guarantee.agent,
+            "status": guarantee.status.value
+        } for guarantee in guarantees])
+
+        # Reserve the amounts on the materialized balances
+        increments = {}
+        for guarantee, inserted_id in zip(guarantees, result.inserted_ids):
+            guarantee._id = inserted_id
+            if guarantee.status == GuaranteeStatus.ACTIVE:
+                currency_increments = increments.setdefault(guarantee.currency, [])
+                if not reserved:
+                    currency_increments.append((guarantee.initiator, BalanceFilter.RESERVED, guarantee.amount))
+                currency_increments.append((guarantee.beneficiary, BalanceFilter.CLAIMABLE, guarantee.amount))
+
+        for currency, currency_increments in increments.items():
+            Balance.increment(currency, currency_increments)
+
+        return guarantees
+
+    def _increment_balances(self, amount, reserved=False):
+        """
+        Update the reserved and claimable materialized balances
+        """
+        increments = [(self.beneficiary, BalanceFilter.CLAIMABLE, amount)]
+        if not reserved:
+            increments.insert(0, (self.initiator, BalanceFilter.RESERVED, amount))
+        Balance.increment(self.currency, increments)
+
     def cancel(self):
         """
-        Cancel a guarantee
+        Cancel a guarantee, only an active guarantee can be canceled
+        """
+        previous = db.guarantees.find_one_and_update(
+            {
+                "uuid": self.uuid,
+                "status": GuaranteeStatus.ACTIVE.value
+            }, {
+                "$set": {
+                    "status": GuaranteeStatus.CANCELLED.value,
+                }
+            }
+        )
+
+        # Release the amount if it was still reserved
+        if previous is not None:
+            self.status = GuaranteeStatus.CANCELLED
+            self._increment_balances(-self.amount)
+
+    def discard(self):
+        """
+        Delete a guarantee which was never confirmed to the parties
+        """
+        previous = db.guarantees.find_one_and_delete({"uuid": self.uuid})
+
+        # Release the amount if it was still reserved
+        if previous is not None and previous["status"] == GuaranteeStatus.ACTIVE.value:
+            self._increment_balances(-self.amount)
+        self._id = None
+
+    @staticmethod
+    def discard_many(guarantees):
+        """
+        Delete several guarantees which were never confirmed to the parties
         """
-        # TODO: Improve this by not deleting but adding a flag
-        db.guarantees.delete_one({"uuid": self.uuid})
+        for guarantee in guarantees:
+            guarantee.discard()
 
     def flag_claimed(self):
         """
         Update the status to claimed
         """
-        self.claimed = True
-        db.guarantees.update_one(
+        self.status = GuaranteeStatus.CLAIMED
+        previous = db.guarantees.find_one_and_update(
             {
                 "uuid": self.uuid
             }, {
                 "$set": {
-                    "claimed": True,
+                    "status": GuaranteeStatus.CLAIMED.value,
                 }
             },
             upsert=True
         )
 
+        # Release the amount if it was still reserved
+        if previous is not None and previous["status"] == GuaranteeStatus.ACTIVE.value:
+            self._increment_balances(-self.amount)
+
+    @staticmethod
+    def sweep_expired(batch_size=100):
+        """
+        Release the guarantees expired and still active, by batches
+        Returns the number of guarantees released
+        """
+        # Guarantees stored before the statuses expire as well
+        Guarantee.migrate_statuses()
+
+        filters = {
+            "status": GuaranteeStatus.ACTIVE.value,
+            "expiration": {"$lte": datetime.now(timezone.utc)}
+        }
+
+        released = 0
+        while True:
+            candidates = list(db.guarantees.find(
+                filters,
+                {"_id": 1},
+                sort=[("expiration", 1)],
+                limit=batch_size
+            ))
+
+            # Flag the guarantees unless they were claimed meanwhile
+            increments = {}
+            for candidate in candidates:
+                result = db.guarantees.find_one_and_update(
+                    dict(filters, _id=candidate["_id"]),
+                    {"$set": {"status": GuaranteeStatus.EXPIRED.value}}
+                )
+                if result is None:
+                    continue
+
+                released += 1
+                amount = -result["amount"].to_decimal()
+                increments.setdefault(result["currency"], []).extend([
+                    (result["initiator"], BalanceFilter.RESERVED, amount),
+                    (result["beneficiary"], BalanceFilter.CLAIMABLE, amount),
+                ])
+
+            # Release the amounts on the materialized balances
+            for currency, currency_increments in increments.items():
+                Balance.increment(currency, currency_increments)
+
+            if len(candidates) < batch_size:
+                return released
+
+    @staticmethod
+    def migrate_expirations(batch_size=1000):
+        """
+        Convert the expirations stored as ISO strings to dates
+        Returns the number of guarantees updated
+        """
+        updated = 0
+        operations = []
+        for result in db.guarantees.find(
+            {"expiration": {"$type": "string"}},
+            {"expiration": 1}
+        ):
+            operations.append(UpdateOne(
+                {"_id": result["_id"], "expiration": result["expiration"]},
+                {"$set": {"expiration": dateutil.parser.isoparse(result["expiration"])}}
+            ))
+
+            if len(operations) == batch_size:
+                updated += db.guarantees.bulk_write(operations, ordered=False).modified_count
+                operations = []
+
+        if operations:
+            updated += db.guarantees.bulk_write(operations, ordered=False).modified_count
+
+        return updated
+
+    @staticmethod
+    def migrate_statuses():
+        """
+        Replace the claimed flag of the guarantees stored before by a status
+        Returns the number of guarantees updated
+        """
+        updated = 0
+        for claimed, status in [(True, GuaranteeStatus.CLAIMED), (False, GuaranteeStatus.ACTIVE)]:
+            updated += db.guarantees.update_many(
+                {"status": {"$exists": False}, "claimed": claimed},
+                {"$set": {"status": status.value}, "$unset": {"claimed": ""}}
+            ).modified_count
+
+        return updated
+
+    @staticmethod
+    def migrate_status(result):
+        """
+        Replace the claimed flag of a guarantee stored before by a status
+        Returns the status of the guarantee
+        """
+        status = GuaranteeStatus.CLAIMED if result.get("claimed") else GuaranteeStatus.ACTIVE
+        updated = db.guarantees.update_one(
+            {"_id": result["_id"], "status": {"$exists": False}},
+            {"$set": {"status": status.value}, "$unset": {"claimed": ""}}
+        )
+
+        # The guarantee was migrated meanwhile, and possibly updated since
+        if updated.modified_count == 0:
+            current = db.guarantees.find_one({"_id": result["_id"]}, {"status": 1})
+            if current is not None and "status" in current:
+                return GuaranteeStatus(current["status"])
+
+        return status
+
+    @staticmethod
+    def parse_expiration(expiration):
+        """
+        Parse a stored expiration as a date in UTC
+        """
+        # Guarantees stored before the migration to dates
+        if isinstance(expiration, str):
+            return dateutil.parser.isoparse(expiration)
+
+        return expiration.replace(tzinfo=timezone.utc)
+
     @classmethod
     def from_storage(cls, guarantee_uuid):
         """
@@ -121,13 +342,18 @@ class Guarantee(object):
             beneficiary=result["beneficiary"],
             amount=result["amount"].to_decimal(),
             currency=result["currency"],
-            expiration=dateutil.parser.isoparse(result["expiration"]),
+            expiration=cls.parse_expiration(result["expiration"]),
             agent=result["agent"],
         )
 
         # Update reference values
         guarantee.uuid = guarantee_uuid
         guarantee._id = result["_id"]
-        guarantee.claimed = result["claimed"]
+
+        # Guarantees stored before the statuses are migrated when read
+        if "status" in result:
+            guarantee.status = GuaranteeStatus(result["status"])
+        else:
+            guarantee.status = Guarantee.migrate_status(result)
 
         return guarantee
@@ -0,0 +1,74 @@
+"""
+Define a background worker releasing the expired guarantees
+"""
+import logging
+from threading import Lock, Timer
+from simard.guarantee import Guarantee
+from simard.settings import GUARANTEE_SWEEP_INTERVAL
+
+
+class GuaranteeSweeper(object):
+    """
+    Periodically releases the expired guarantees in a background thread
+    """
+
+    # Parameters
+    _BATCH_SIZE = 100
+
+    def __init__(self, interval=GUARANTEE_SWEEP_INTERVAL):
+        """
+        Constructor for the sweeper
+        :param interval The delay between two sweeps in seconds
+        """
+        self._interval = interval
+        self._timer = None  # The timer to schedule the next sweep
+        self._timer_lock = Lock()  # A thread lock on the timer
+        self._stopped = False
+
+    def _schedule_sweep(self):
+        """
+        Internal scheduler for sweep operations
+        """
+        with self._timer_lock:
+            if self._timer is None and not self._stopped:
+                self._timer = Timer(self._interval, self.sweep)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def start(self):
+        """
+        Start the periodic sweeps
+        """
+        self._stopped = False
+        self._schedule_sweep()
+
+    def stop(self):
+        """
+        Stop the periodic sweeps
+        """
+        with self._timer_lock:
+            self._stopped = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+
+    def sweep(self):
+        """
+        Release the expired guarantees and schedule the next sweep
+        Returns the number of guarantees released
+        """
+        with self._timer_lock:
+            self._timer = None
+
+        released = 0
+        try:
+            released = Guarantee.sweep_expired(batch_size=self._BATCH_SIZE)
+            if released:
+                logging.info('%i expired guarantee(s) released' % released)
+
+        # Errors are logged and the sweep is retried on the next run
+        except Exception as e:
+            logging.error('Could not release the expired guarantees: %s' % str(e))
+
+        self._schedule_sweep()
+        return released
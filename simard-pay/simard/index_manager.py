@@ -0,0 +1,196 @@
+"""
+Define a manager class to provision and verify the database indexes
+"""
+import logging
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from simard.db import db
+
+
+# Indexes required by the queries of each collection
+INDEXES = {
+    'guarantees': [
+        {'name': 'uuid', 'keys': [('uuid', ASCENDING)], 'unique': True},
+        # Only the active guarantees are indexed for the balances and the sweeper
+        {'name': 'initiator_currency_active', 'keys': [('initiator', ASCENDING), ('currency', ASCENDING)], 'partialFilterExpression': {'status': 'active'}},
+        {'name': 'beneficiary_currency_active', 'keys': [('beneficiary', ASCENDING), ('currency', ASCENDING)], 'partialFilterExpression': {'status': 'active'}},
+        {'name': 'expiration_active', 'keys': [('expiration', ASCENDING)], 'partialFilterExpression': {'status': 'active'}},
+        # Only the guarantees stored before the statuses, until they are migrated
+        {'name': 'claimed_legacy', 'keys': [('claimed', ASCENDING)], 'partialFilterExpression': {'claimed': {'$exists': True}}},
+    ],
+    'settlements': [
+        {'name': 'uuid', 'keys': [('uuid', ASCENDING)], 'unique': True},
+        {'name': 'beneficiary_currency_id', 'keys': [('beneficiary', ASCENDING), ('currency', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'initiator_currency_id', 'keys': [('initiator', ASCENDING), ('currency', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'beneficiary_id', 'keys': [('beneficiary', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'initiator_id', 'keys': [('initiator', ASCENDING), ('_id', ASCENDING)]},
+        {'name': 'guarantee', 'keys': [('guarantee', ASCENDING)], 'sparse': True},
+        {'name': 'source_transactionHash', 'keys': [('source', ASCENDING), ('transactionHash', ASCENDING)], 'sparse': True},
+    ],
+    'quotes': [
+        {'name': 'uuid', 'keys': [('uuid', ASCENDING)], 'unique': True},
+    ],
+    'tokens': [
+        {'name': 'uuid', 'keys': [('uuid', ASCENDING)], 'unique': True},
+        {'name': 'isAmexTravelAccountToken_travelComponents.createdAt', 'keys': [('isAmexTravelAccountToken', ASCENDING), ('travelComponents.createdAt', ASCENDING)]},
+    ],
+    'intents': [
+        {'name': 'transactionId', 'keys': [('transactionId', ASCENDING)]},
+    ],
+    'accounts': [
+        {'name': 'uuid', 'keys': [('uuid', ASCENDING)], 'unique': True},
+        {'name': 'orgid', 'keys': [('orgid', ASCENDING)]},
+    ],
+    'profiles': [
+        {'name': 'orgid', 'keys': [('orgid', ASCENDING)]},
+    ],
+    'balances': [
+        {'name': 'orgid_currency', 'keys': [('orgid', ASCENDING), ('currency', ASCENDING)], 'unique': True},
+    ],
+    'balance_checkpoints': [
+        {'name': 'orgid_currency', 'keys': [('orgid', ASCENDING), ('currency', ASCENDING)], 'unique': True},
+        {'name': 'until', 'keys': [('until', DESCENDING)]},
+    ],
+    'tadc_reports': [
+        {'name': 'status_transferDate', 'keys': [('status', ASCENDING), ('transferDate', DESCENDING)]},
+    ],
+}
+
+# Options of the declared indexes with their default value
+INDEX_OPTIONS = {'unique': False, 'sparse': False, 'partialFilterExpression': None}
+
+# Canonical queries of the hot paths, as (collection, filter)
+CANONICAL_QUERIES = [
+    ('guarantees', {'uuid': '00000000-0000-0000-0000-000000000000'}),
+    ('guarantees', {'currency': 'EUR', 'initiator': '0x00', 'status': 'active'}),
+    ('guarantees', {'currency': 'EUR', 'beneficiary': '0x00', 'status': 'active'}),
+    ('guarantees', {'status': 'active', 'expiration': {'$lte': datetime(2000, 1, 1, tzinfo=timezone.utc)}}),
+    ('guarantees', {'currency': 'EUR', 'initiator': '0x00', 'status': {'$exists': False}, 'claimed': False}),
+    ('settlements', {'uuid': '00000000-0000-0000-0000-000000000000'}),
+    ('settlements', {'currency': 'EUR', 'beneficiary': '0x00'}),
+    ('settlements', {'currency': 'EUR', 'initiator': '0x00'}),
+    ('settlements', {'currency': 'EUR', '$or': [{'beneficiary': '0x00'}, {'initiator': '0x00'}]}),
+    ('settlements', {'$or': [{'beneficiary': '0x00'}, {'initiator': '0x00'}], '_id': {'$gt': ObjectId('000000000000000000000000')}}),
+    ('settlements', {'source': 'ethereum', 'transactionHash': '0x00'}),
+    ('quotes', {'uuid': '00000000-0000-0000-0000-000000000000'}),
+    ('tokens', {'uuid': '00000000-0000-0000-0000-000000000000'}),
+    ('intents', {'transactionId': '0'}),
+    ('accounts', {'orgid': '0x00'}),
+    ('profiles', {'orgid': '0x00'}),
+    ('balances', {'orgid': '0x00', 'currency': 'EUR'}),
+    ('balance_checkpoints', {'orgid': '0x00', 'currency': 'EUR'}),
+]
+
+
+class IndexManager(object):
+
+    @staticmethod
+    def ensure_indexes():
+        """
+        Create the declared indexes, already existing ones are kept as is
+        The indexes conflicting with existing ones are logged and reported by verify_indexes
+        Returns the list of (collection, index name) provisioned
+        """
+        provisioned = []
+        for collection_name in INDEXES:
+            provisioned.extend(IndexManager.ensure_collection_indexes(collection_name))
+
+        return provisioned
+
+    @staticmethod
+    def ensure_collection_indexes(collection_name, strict=False):
+        """
+        Create the declared indexes of a collection, already existing ones are kept as is
+        :param strict Raise the conflicts with existing indexes instead of logging them
+        Returns the list of (collection, index name) provisioned
+        """
+        provisioned = []
+        collection = db.get_collection(collection_name)
+        for index in INDEXES[collection_name]:
+            options = {k: v for k, v in index.items() if k != 'keys'}
+            try:
+                collection.create_index(index['keys'], **options)
+
+            # An index with the same name or keys exists with other options
+            except OperationFailure as e:
+                if strict:
+                    raise
+                logging.error('Could not create the index %s.%s: %s' % (collection_name, index['name'], str(e)))
+                continue
+
+            provisioned.append((collection_name, index['name']))
+
+        return provisioned
+
+    @staticmethod
+    def verify_indexes():
+        """
+        Compare the existing indexes with the declared ones
+        Returns the list of (collection, index name, problem) found
+        """
+        problems = []
+        for collection_name, indexes in INDEXES.items():
+            existing = db.get_collection(collection_name).index_information()
+            for index in indexes:
+                info = existing.get(index['name'])
+                if info is None:
+                    # The same keys may be indexed under another name
+                    names = [name for name, i in existing.items() if [tuple(key) for key in i['key']] == index['keys']]
+                    if names:
+                        problems.append((collection_name, index['name'], 'exists as %s' % names[0]))
+                    else:
+                        problems.append((collection_name, index['name'], 'missing'))
+                elif [tuple(key) for key in info['key']] != index['keys']:
+                    problems.append((collection_name, index['name'], 'different keys'))
+                else:
+                    for option, default in INDEX_OPTIONS.items():
+                        if info.get(option, default) != index.get(option, default):
+                            problems.append((collection_name, index['name'], 'different %s' % option))
+
+        return problems
+
+    @staticmethod
+    def plan_summary(plan):
+        """
+        Summarize a query plan as a list of stages with their index
+        """
+        stages = []
+        while plan is not None:
+            stage = plan['stage']
+            if 'indexName' in plan:
+                stage = '%s(%s)' % (stage, plan['indexName'])
+            stages.append(stage)
+
+            # Plans with a single input are chained
+            if 'inputStage' in plan:
+                plan = plan['inputStage']
+            elif 'inputStages' in plan:
+                stages.append('[%s]' % ', '.join(
+                    ' > '.join(IndexManager.plan_summary(p))
+                    for p in plan['inputStages']
+                ))
+                plan = None
+            else:
+                plan = None
+
+        return stages
+
+    @staticmethod
+    def explain_queries():
+        """
+        Explain the canonical queries
+        Returns the list of (collection, filter, plan stages)
+        """
+        plans = []
+        for collection_name, filters in CANONICAL_QUERIES:
+            explain = db.get_collection(collection_name).find(filters).explain()
+            winning_plan = explain['queryPlanner']['winningPlan']
+            plans.append((
+                collection_name,
+                filters,
+                IndexManager.plan_summary(winning_plan)
+            ))
+
+        return plans
@@ -0,0 +1,228 @@
+""""
+Define a class to manage the ledger checkpoints
+"""
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteMany
+from simard.db import db
+from simard.index_manager import IndexManager
+
+
+class LedgerCheckpoint(object):
+    """
+    Stores the cumulative settlement totals of an ORG.ID in a currency
+    All the settlements with an identifier lower than `until` are included
+    """
+    # Settlements created after this delay are not checkpointed yet
+    _DEFAULT_LAG = timedelta(hours=24)
+
+    def __init__(
+        self,
+        orgid,
+        currency,
+        until: ObjectId,
+        credit=Decimal(),
+        debit=Decimal(),
+        received=0
+    ):
+        self.orgid = orgid
+        self.currency = currency
+        self.until = until
+        self.credit = credit
+        self.debit = debit
+        self.received = received
+
+    @property
+    def settlement_filters(self):
+        """
+        Filters on the settlements created after the checkpoint
+        """
+        return {'_id': {'$gte': self.until}}
+
+    @classmethod
+    def from_database_result(cls, result):
+        """
+        Create the object from a database result
+        """
+        return cls(
+            orgid=result['orgid'],
+            currency=result['currency'],
+            until=result['until'],
+            credit=result['credit'].to_decimal(),
+            debit=result['debit'].to_decimal(),
+            received=result['received'],
+        )
+
+    @classmethod
+    def from_storage(cls, orgid, currency):
+        """
+        Retrieve the checkpoint of a balance, None if there is none
+        """
+        result = db.balance_checkpoints.find_one({
+            'orgid': orgid,
+            'currency': currency
+        })
+
+        if result is None:
+            return None
+
+        return cls.from_database_result(result)
+
+    @classmethod
+    def from_storage_all(cls, orgid):
+        """
+        Retrieve the checkpoints of all the balances of an ORG.ID by currency
+        """
+        checkpoints = {}
+        for result in db.balance_checkpoints.find({'orgid': orgid}):
+            checkpoints[result['currency']] = cls.from_database_result(result)
+
+        return checkpoints
+
+    @staticmethod
+    def aggregate_settlements(filters):
+        """
+        Compute the settlement totals by ORG.ID and currency
+        """
+        totals = {}
+        for prop, field in [('beneficiary', 'credit'), ('initiator', 'debit')]:
+            result = db.settlements.aggregate([
+                {
+                    '$match': filters
+                },
+                {
+                    '$group': {
+                        '_id': {'orgid': '$%s' % prop, 'currency': '$currency'},
+                        'total': {'$sum': '$amount'},
+                        'count': {'$sum': 1},
+                    }
+                },
+            ])
+
+            for doc in result:
+                key = (doc['_id']['orgid'], doc['_id']['currency'])
+                if key not in totals:
+                    totals[key] = {'credit': Decimal(), 'debit': Decimal(), 'received': 0}
+
+                total = doc['total']
+                if type(total) is Decimal128:
+                    total = total.to_decimal()
+                totals[key][field] = Decimal(total)
+                if field == 'credit':
+                    totals[key]['received'] = doc['count']
+
+        return totals
+
+    @staticmethod
+    def aggregate_balance_settlements(orgid, currency, until):
+        """
+        Compute the settlement totals of a balance before a position
+        """
+        totals = LedgerCheckpoint.aggregate_settlements({
+            'currency': currency,
+            '$or': [{'beneficiary': orgid}, {'initiator': orgid}],
+            '_id': {'$lt': until},
+        })
+        return totals.get((orgid, currency), {'credit': Decimal(), 'debit': Decimal(), 'received': 0})
+
+    @staticmethod
+    def run(lag=None, full=False):
+        """
+        Move the checkpoints forward to the settlements older than the lag
+        Returns the number of checkpoints with new settlements
+        """
+        if lag is None:
+            lag = LedgerCheckpoint._DEFAULT_LAG
+        until = ObjectId.from_datetime(datetime.now(timezone.utc) - lag)
+
+        # Concurrent runs are detected by the unique orgid/currency index
+        IndexManager.ensure_collection_indexes('balance_checkpoints', strict=True)
+
+        # A full run replaces each checkpoint, the others stay valid if it is interrupted
+        if full:
+            totals = LedgerCheckpoint.aggregate_settlements({'_id': {'$lt': until}})
+            operations = [
+                ReplaceOne(
+                    {'orgid': orgid, 'currency': currency},
+                    {
+                        'orgid': orgid,
+                        'currency': currency,
+                        'until': until,
+                        'credit': Decimal128(total['credit']),
+                        'debit': Decimal128(total['debit']),
+                        'received': total['received'],
+                    },
+                    upsert=True
+                )
+                for (orgid, currency), total in totals.items()
+            ]
+
+            # Remove the checkpoints of the balances without settlements anymore
+            operations.append(DeleteMany({'until': {'$lt': until}}))
+            db.balance_checkpoints.bulk_write(operations, ordered=True)
+            return len(totals)
+
+        # Get the position of each checkpoint, an interrupted run can leave them at several ones
+        positions = {}
+        for result in db.balance_checkpoints.find({}, {'orgid': 1, 'currency': 1, 'until': 1}):
+            positions[(result['orgid'], result['currency'])] = result['until']
+
+        # Nothing to do if the checkpoints are already further
+        behind = sorted(set(position for position in positions.values() if position < until))
+        if positions and not behind:
+            return 0
+
+        # Increment each checkpoint with the settlements since its own position
+        operations = []
+        updated = set()
+        for position in behind:
+            totals = LedgerCheckpoint.aggregate_settlements({'_id': {'$gte': position, '$lt': until}})
+            for (orgid, currency), total in totals.items():
+                if positions.get((orgid, currency)) != position:
+                    continue
+                operations.append(UpdateOne(
+                    {'orgid': orgid, 'currency': currency, 'until': position},
+                    {
+                        '$inc': {
+                            'credit': Decimal128(total['credit']),
+                            'debit': Decimal128(total['debit']),
+                            'received': total['received'],
+                        },
+                        '$set': {'until': until},
+                    }
+                ))
+                updated.add((orgid, currency))
+
+        # The balances without checkpoint have settlements after the oldest position
+        filters = {'_id': {'$lt': until}}
+        if behind:
+            filters['_id']['$gte'] = behind[0]
+        totals = LedgerCheckpoint.aggregate_settlements(filters)
+        created = [key for key in totals if key not in positions]
+        for orgid, currency in created:
+            # Including the settlements before the oldest position
+            total = totals[(orgid, currency)]
+            if behind:
+                total = LedgerCheckpoint.aggregate_balance_settlements(orgid, currency, until)
+            operations.append(InsertOne({
+                'orgid': orgid,
+                'currency': currency,
+                'until': until,
+                'credit': Decimal128(total['credit']),
+                'debit': Decimal128(total['debit']),
+                'received': total['received'],
+            }))
+
+        # Move forward the checkpoints without new settlements
+        if behind:
+            operations.append(UpdateMany(
+                {'until': {'$in': behind}},
+                {'$set': {'until': until}}
+            ))
+
+        if operations:
+            db.balance_checkpoints.bulk_write(operations, ordered=True)
+
+        return len(updated) + len(created)
@@ -1,16 +1,16 @@
 import base64
 import json
 
-import requests
-from eth_account.messages import encode_defunct
 from model.exception import SimardException
 from simard.settings import SIMARD_ORGID, ORGIDVALIDATOR_URL, SIMARD_ORGID_CHAINID, ORGIDVALIDATOR_V2_URL, \
-    ORGID_VALIDATION_DISABLED
-from simard.w3 import w3
+    ORGID_VALIDATION_DISABLED, JWT_CACHE_MAX_TTL, JWT_VALIDATION_MODE, JWT_REMOTE_FALLBACK, ORGID_CHAINID, \
+    JWT_KEY_CACHE_MAX_ENTRIES, DID_CACHE_HARD_TTL, JWT_CACHE_LOCAL_MAX_ENTRIES
 from simard.parser import Parser
-from simard.did_resolver import DidResolver
+from simard.did_resolver import DidResolver, DidResolverException, DidDocumentException
+from simard.cache import cache, LocalCache
+from simard.secp256k1 import secp256k1
+from simard.validator_client import validator_client
 import re
-import ecdsa
 import hashlib
 import time
 
@@ -19,6 +19,10 @@ class OAuthManagerInvalidToken(SimardException):
     pass
 
 
+class OAuthManagerUnsupportedToken(OAuthManagerInvalidToken):
+    pass
+
+
 class OAuthManagerWeb3Exception(SimardException):
     pass
 
@@ -27,6 +31,18 @@ class OAuthManager(object):
     """
     A class to handle OAuth with ORG.ID
     """
+    # Successful validations are cached until the token expires, at most this time
+    _VALIDATION_MAX_TTL = JWT_CACHE_MAX_TTL
+    _validations = LocalCache(JWT_CACHE_LOCAL_MAX_ENTRIES)  # Kept apart from the DID documents
+
+    # Validate the tokens with the ORG.ID validator or locally
+    _VALIDATION_MODE = JWT_VALIDATION_MODE
+    _REMOTE_FALLBACK = JWT_REMOTE_FALLBACK  # Use the validator for tokens not supported locally
+
+    # Parsed verifying keys by (orgid, key id, PEM digest)
+    # A key changed in the DID document has a new digest and is parsed again
+    _verifying_keys = LocalCache(JWT_KEY_CACHE_MAX_ENTRIES)
+    _VERIFYING_KEY_TTL = DID_CACHE_HARD_TTL
 
     @staticmethod
     def field_to_bytes(jwt_field):
@@ -105,6 +121,7 @@ class OAuthManager(object):
 
         # Validate the token was meant for Simard
         if ('did:orgid:%s' % SIMARD_ORGID) not in claims['aud'] and \
+           ('did:orgid:%s:%s' % (SIMARD_ORGID_CHAINID, SIMARD_ORGID)) not in claims['aud'] and \
            SIMARD_ORGID not in claims['aud'] and \
            '<simard>' not in claims['aud']:
 
@@ -138,21 +155,13 @@ class OAuthManager(object):
         """
         Validate a signature and extracts the signatory address
         """
-        # Check the web3 instance is present
-        if(w3 is None):
-            raise OAuthManagerWeb3Exception(
-                "Error interacting with Ethereum", 503)
-
         # Extract the part to build the signed message
         jwt_parts = jwt_token.split('.', 2)
         signed_message = '.'.join(jwt_parts[0:2])
         signature = OAuthManager.field_to_bytes(jwt_parts[2])
-        message = encode_defunct(text=signed_message)
 
         # Recover the address
-        address = w3.eth.account.recover_message(
-            message,
-            signature=signature)
+        address = secp256k1.recover_address(signed_message, signature)
 
         return address
 
@@ -169,11 +178,25 @@ class OAuthManager(object):
         organization = doc['organization']
         return (account in [organization['owner'], organization['director']])
 
+    @staticmethod
+    def load_verifying_key(orgid, keyid, public_key_pem):
+        """
+        Get the verifying key of a PEM public key listed in a DID document
+        The keys are parsed once with their precomputed points and kept in process
+        """
+        key = (orgid, keyid, hashlib.sha256(public_key_pem.encode()).hexdigest())
+        vk = OAuthManager._verifying_keys.get(key)
+        if vk is None:
+            vk = secp256k1.load_public_key(public_key_pem)
+            OAuthManager._verifying_keys.set(key, vk, OAuthManager._VERIFYING_KEY_TTL)
+
+        return vk
+
     @staticmethod
     def validate_key_authorization(keyid, jwt_token):
         # Check format and extract parameters
         m = re.match(
-            r'^did:orgid:(?P<orgid>0x[A-Za-z0-9]{64})#(?P<keyid>.+)$',
+            r'^did:orgid:([0-9]+:)?(?P<orgid>0x[A-Za-z0-9]{64})#(?P<keyid>.+)$',
             keyid
         )
         if not m:
@@ -184,6 +207,9 @@ class OAuthManager(object):
         orgid = m.group('orgid')
         doc = DidResolver.resolve(orgid)
 
+        # The keys are referenced without chain identifier in the documents
+        keyid = 'did:orgid:%s#%s' % (orgid, m.group('keyid'))
+
         # Get the list of keys
         if 'publicKey' not in doc['didDocument']:
             raise OAuthManagerInvalidToken(
@@ -204,9 +230,10 @@ class OAuthManager(object):
 
                 # Load the key
                 try:
-                    vk = ecdsa.VerifyingKey.from_pem(
-                        public_key['publicKeyPem'],
-                        hashfunc=hashlib.sha256
+                    vk = OAuthManager.load_verifying_key(
+                        orgid,
+                        public_key['id'],
+                        public_key['publicKeyPem']
                     )
                 except Exception as e:
                     raise OAuthManagerInvalidToken(
@@ -218,12 +245,8 @@ class OAuthManager(object):
                 # Note that it differs from openssl signature
                 # as OpenSSL creates an ASN.1 signature
                 try:
-                    signature_match = vk.verify(
-                        signature,
-                        message,
-                        hashfunc=hashlib.sha256
-                    )
-                except ecdsa.keys.BadSignatureError as e:
+                    signature_match = secp256k1.verify(vk, signature, message)
+                except ValueError as e:
                     raise OAuthManagerInvalidToken(
                         "Unable to decode the JWT signature",
                         400
@@ -292,6 +315,74 @@ class OAuthManager(object):
         # Provide the claims
         return orgid, key_reference
 
+    @staticmethod
+    def validate_token_local(jwt_token):
+        """
+        Validate a JWT Token against the resolved ORG.ID, without the ORG.ID validator
+        Tokens which cannot be validated locally raise OAuthManagerUnsupportedToken
+        """
+        # Check the type is string
+        if not isinstance(jwt_token, str):
+            raise OAuthManagerInvalidToken(
+                "JWT Token is not a string", 400)
+
+        # Split the elements
+        elements = jwt_token.split('.')
+        if(len(elements) != 3):
+            raise OAuthManagerInvalidToken(
+                "JWT Token format is not valid %d" % len(elements), 400)
+
+        # Check the algorithm can be verified locally
+        if OAuthManager.field_to_object(elements[0]).get('alg') not in ["ETH", "ES256K"]:
+            raise OAuthManagerUnsupportedToken(
+                "JWT Token algorithm is not supported locally", 400)
+
+        # Get and validate the different elements
+        header = OAuthManager.parse_header(elements[0])
+        claims = OAuthManager.parse_claims(elements[1])
+
+        # The expiry bounds the validity of the tokens validated locally
+        if 'exp' not in claims:
+            raise OAuthManagerInvalidToken(
+                "JWT Token has no expiration", 403)
+
+        # Only the ORG.IDs of the resolver chain can be resolved
+        (chain, orgid, agentkey) = Parser.parse_did_into_elements(claims['iss'])
+        if chain is not None and chain != ORGID_CHAINID:
+            raise OAuthManagerUnsupportedToken(
+                "JWT Token issuer chain is not supported locally", 400)
+
+        try:
+            # Verify with the ORG.ID that the signatory is allowed
+            if(header['alg'] == 'ETH'):
+                address = OAuthManager.get_ethereum_signatory_address(jwt_token)
+                if not OAuthManager.validate_eth_authorization(address, orgid):
+                    raise OAuthManagerInvalidToken(
+                        "JWT Token not authorized", 403)
+                return orgid, address
+
+            # Verify the key is listed in the ORG.ID
+            validated, orgid = OAuthManager.validate_key_authorization(claims['iss'], jwt_token)
+            return orgid, claims['iss']
+
+        # The organization is not valid
+        except DidDocumentException:
+            raise
+
+        # The organization could not be resolved
+        except DidResolverException as e:
+            raise OAuthManagerUnsupportedToken(
+                "JWT Token issuer could not be resolved locally", 502) from e
+
+    @staticmethod
+    def validate_token_remote(jwt_token, chain):
+        """
+        Validate a JWT Token with the ORG.ID validator of its format
+        """
+        if chain is not None:
+            return OAuthManager._validate_token_v2(jwt_token)
+        return OAuthManager._validate_token_v1(jwt_token)
+
     @staticmethod
     def validate_token(jwt_token):
         # extract jwt payload
@@ -310,14 +401,57 @@ class OAuthManager(object):
         if ORGID_VALIDATION_DISABLED:
             return f"did:orgid:{did}",claims['iss']
 
-        if chain is not None:
-            return OAuthManager._validate_token_v2(jwt_token)
-        return OAuthManager._validate_token_v1(jwt_token)
+        # Skip the validator for the tokens already validated
+        cache_key = OAuthManager.validation_cache_key(jwt_token)
+        validated = cache.retrieve(cache_key, local=OAuthManager._validations)
+        if validated is not None:
+            return tuple(validated)
+
+        if OAuthManager._VALIDATION_MODE == 'local':
+            try:
+                validated = OAuthManager.validate_token_local(jwt_token)
+
+            # Fallback to the ORG.ID validator if enabled
+            except OAuthManagerUnsupportedToken:
+                if not OAuthManager._REMOTE_FALLBACK:
+                    raise
+                validated = OAuthManager.validate_token_remote(jwt_token, chain)
+
+        else:
+            validated = OAuthManager.validate_token_remote(jwt_token, chain)
+
+        # Keep the validation until the token expires
+        ttl = OAuthManager.validation_ttl(claims)
+        if validated is not None and ttl > 0:
+            cache.store(cache_key, validated, expiry=ttl, local=OAuthManager._validations)
+
+        return validated
+
+    @staticmethod
+    def validation_cache_key(jwt_token):
+        """
+        Get the cache key of a token validation, the token itself is not stored
+        """
+        return "jwtValidationSimard_%s" % hashlib.sha256(jwt_token.encode()).hexdigest()
+
+    @staticmethod
+    def validation_ttl(claims):
+        """
+        Get the time to keep a token validation in cache, in whole seconds
+        """
+        ttl = OAuthManager._VALIDATION_MAX_TTL
+        if 'exp' in claims:
+            try:
+                ttl = min(ttl, int(float(claims['exp']) - time.time()))
+            except (TypeError, ValueError):
+                return 0
+
+        return ttl
 
     @staticmethod
     def _validate_token_v1(jwt_token):
         """Validate token using ORGiD validator V1 (JWT with iss/aud without chainID)"""
-        r = requests.get(ORGIDVALIDATOR_URL + '/jwt', {'jwt': jwt_token, 'audience': 'did:orgid:' + SIMARD_ORGID})
+        r = validator_client.get(ORGIDVALIDATOR_URL + '/jwt', {'jwt': jwt_token, 'audience': 'did:orgid:' + SIMARD_ORGID})
 
         # Validate the API response
         if not r.ok:
@@ -340,7 +474,7 @@ class OAuthManager(object):
     @staticmethod
     def _validate_token_v2(jwt_token):
         """Validate token using ORGiD validator V2 (JWT with iss/aud with chainID, different response than V1)"""
-        r = requests.get(ORGIDVALIDATOR_V2_URL + '/jwt', {'jwt': jwt_token, 'audience': f'did:orgid:{SIMARD_ORGID_CHAINID}:{SIMARD_ORGID}'})
+        r = validator_client.get(ORGIDVALIDATOR_V2_URL + '/jwt', {'jwt': jwt_token, 'audience': f'did:orgid:{SIMARD_ORGID_CHAINID}:{SIMARD_ORGID}'})
 
         # Validate the API response
         if not r.ok:
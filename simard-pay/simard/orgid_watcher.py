@@ -0,0 +1,206 @@
+"""
+Define a background worker invalidating the cached DIDs from the ORG.ID contract events
+"""
+import logging
+from threading import Lock, Timer
+from hexbytes import HexBytes
+from web3 import Web3
+from schemas import abi
+from simard.w3 import w3
+from simard.did_resolver import DidResolver
+from simard.settings import ORGID_CONTRACT, ORGID_WATCHER_INTERVAL
+from model.exception import SimardException
+
+
+class OrgIdWatcherException(SimardException):
+    pass
+
+
+class OrgIdWatcher(object):
+    """
+    Periodically reads the logs of the ORG.ID contract in a background thread
+    The cached DIDs of the organizations changed are removed
+    """
+
+    # The argument holding the organization changed by each event
+    _EVENTS = {
+        'OrganizationCreated': 'orgId',
+        'UnitCreated': 'unitOrgId',
+        'OrganizationActiveStateChanged': 'orgId',
+        'DirectorshipAccepted': 'orgId',
+        'DirectorshipTransferred': 'orgId',
+        'OrganizationOwnershipTransferred': 'orgId',
+        'OrgJsonChanged': 'orgId',
+    }
+
+    # Storage slots of the implementation behind an upgradeable proxy (EIP-1967 and ZeppelinOS)
+    _IMPLEMENTATION_SLOTS = [
+        0x360894a13ba1a3210667c828492db98dca3e2076cc3735a920a3ca505d382bbc,
+        0x7050c9e0f4ca769c69bd3a8ef740bc37934f8e2c036e5a723fd8ee048ed3f8c3,
+    ]
+
+    # Parameters
+    _MAX_BLOCK_RANGE = 1000
+
+    def __init__(self, interval=ORGID_WATCHER_INTERVAL):
+        """
+        Constructor for the watcher
+        :param interval The delay between two reads in seconds
+        """
+        self._interval = interval
+        self._timer = None  # The timer to schedule the next read
+        self._timer_lock = Lock()  # A thread lock on the timer
+        self._stopped = False
+        self._from_block = None  # The next block to read
+        self._topics = OrgIdWatcher.event_topics()
+
+    @staticmethod
+    def event_topics():
+        """
+        Get the position of the organization in the topics of each event
+        Returns the positions by event signature topic
+        """
+        topics = {}
+        for event in abi.orgid:
+            if event['type'] != 'event' or event['name'] not in OrgIdWatcher._EVENTS:
+                continue
+
+            signature = '%s(%s)' % (event['name'], ','.join(i['type'] for i in event['inputs']))
+            indexed = [i['name'] for i in event['inputs'] if i['indexed']]
+            topics[bytes(Web3.keccak(text=signature))] = 1 + indexed.index(OrgIdWatcher._EVENTS[event['name']])
+
+        return topics
+
+    @staticmethod
+    def contract_code():
+        """
+        Get the runtime code of the ORG.ID contract, with the one of its implementation if it is a proxy
+        """
+        code = bytes(w3.eth.get_code(ORGID_CONTRACT))
+        for slot in OrgIdWatcher._IMPLEMENTATION_SLOTS:
+            address = bytes(w3.eth.get_storage_at(ORGID_CONTRACT, slot))[-20:]
+            if any(address):
+                code += bytes(w3.eth.get_code(Web3.toChecksumAddress(address)))
+
+        return code
+
+    def verify_events(self):
+        """
+        Verify the deployed contract emits the events of the ABI
+        The signature topics of the events are constants of the contract code
+        """
+        code = OrgIdWatcher.contract_code()
+        missing = [Web3.toHex(topic) for topic in self._topics if topic not in code]
+        if len(self._topics) != len(OrgIdWatcher._EVENTS) or missing:
+            raise OrgIdWatcherException(
+                'The ORG.ID contract does not emit the events: %s' % ', '.join(missing or OrgIdWatcher._EVENTS),
+                500)
+
+    def process_logs(self, logs):
+        """
+        Invalidate the organizations changed by contract logs
+        Returns the set of ORG.IDs invalidated
+        """
+        orgids = set()
+        for log in logs:
+            topics = [bytes(HexBytes(topic)) for topic in log['topics']]
+            position = self._topics.get(topics[0]) if topics else None
+            if position is not None and position < len(topics):
+                orgids.add('0x%s' % topics[position].hex())
+
+        for orgid in orgids:
+            DidResolver.invalidate(orgid)
+
+        return orgids
+
+    def read_logs(self, from_block, to_block):
+        """
+        Process the contract logs of a range of blocks
+        Returns the set of ORG.IDs invalidated
+        """
+        orgids = set()
+        while from_block <= to_block:
+            end_block = min(to_block, from_block + self._MAX_BLOCK_RANGE - 1)
+            logs = w3.eth.get_logs({
+                'address': ORGID_CONTRACT,
+                'fromBlock': from_block,
+                'toBlock': end_block,
+                'topics': [[Web3.toHex(topic) for topic in self._topics]],
+            })
+            orgids.update(self.process_logs(logs))
+            from_block = end_block + 1
+
+        return orgids
+
+    def poll(self):
+        """
+        Process the contract logs since the previous poll
+        Returns the set of ORG.IDs invalidated
+        """
+        latest_block = w3.eth.block_number
+
+        # Start watching from the latest block
+        if self._from_block is None:
+            self.verify_events()
+            self._from_block = latest_block + 1
+            return set()
+
+        if self._from_block > latest_block:
+            return set()
+
+        orgids = self.read_logs(self._from_block, latest_block)
+        self._from_block = latest_block + 1
+        return orgids
+
+    def _schedule_watch(self):
+        """
+        Internal scheduler for watch operations
+        """
+        with self._timer_lock:
+            if self._timer is None and not self._stopped:
+                self._timer = Timer(self._interval, self.watch)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def start(self):
+        """
+        Start watching the contract
+        """
+        self._stopped = False
+        self._schedule_watch()
+
+    def stop(self):
+        """
+        Stop watching the contract
+        """
+        with self._timer_lock:
+            self._stopped = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+
+    def watch(self):
+        """
+        Poll the contract logs and schedule the next poll
+        Returns the set of ORG.IDs invalidated
+        """
+        with self._timer_lock:
+            self._timer = None
+
+        orgids = set()
+        try:
+            orgids = self.poll()
+            if orgids:
+                logging.info('%i organization(s) invalidated' % len(orgids))
+
+        # The contract cannot be watched with this ABI
+        except OrgIdWatcherException as e:
+            logging.error('Could not watch the ORG.ID contract: %s' % e.description)
+            self.stop()
+
+        # Errors are logged and the blocks are read again on the next run
+        except Exception as e:
+            logging.error('Could not read the ORG.ID contract logs: %s' % str(e))
+
+        self._schedule_watch()
+        return orgids
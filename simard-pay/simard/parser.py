@@ -6,6 +6,7 @@ from datetime import datetime, timezone
 from iso4217 import Currency
 import dateutil.parser
 from decimal import Decimal
+from bson.objectid import ObjectId
 import re
 from model.exception import SimardException
 from iso3166 import countries
@@ -174,6 +175,37 @@ class Parser(object):
                 "Expiration datetime is in the past",
                 400)
 
+    @staticmethod
+    def parse_date(date):
+        """
+        Helper function to parse a date in UTC
+        """
+        try:
+            date_datetime = dateutil.parser.isoparse(date)
+
+        except Exception as e:
+            raise ParserException(
+                "Unsupported datetime",
+                400) from e
+
+        # Dates without timezone are in UTC
+        if date_datetime.tzinfo is None:
+            return date_datetime.replace(tzinfo=timezone.utc)
+
+        return date_datetime.astimezone(timezone.utc)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """
+        Helper function to parse a pagination cursor
+        """
+        if not ObjectId.is_valid(cursor):
+            raise ParserException(
+                "Cursor format is incorrect",
+                400)
+
+        return ObjectId(cursor)
+
     @staticmethod
     def parse_uuid(uuid_string):
         """
@@ -1,4 +1,4 @@
-from flask import request, jsonify, g, redirect, make_response, Response
+from flask import request, jsonify, g, redirect, make_response, Response, stream_with_context
 from flask_httpauth import HTTPTokenAuth
 from flask_swagger_ui import get_swaggerui_blueprint
 from werkzeug.exceptions import HTTPException
@@ -19,6 +19,8 @@ from tadc import TADC
 import traceback
 import logging
 import json
+import csv
+import io
 from simard.settings import ENABLE_SIMULATED_DEPOSIT, TADC_REPORT_API_ENABLED, OVERRIDE_AMEX_TOKEN
 from simard.intent import Intent
 
@@ -256,6 +258,92 @@ def balances():
         return jsonify(balance_dic)
 
 
+def statement_entry(orgid, settlement):
+    """
+    Format a settlement as a statement entry for an ORG.ID
+    """
+    credited = settlement.beneficiary == orgid
+    return {
+        "id": settlement.uuid,
+        "date": settlement.date.isoformat()[:-6] + "Z",
+        "currency": settlement.currency,
+        "amount": str(settlement.amount),
+        "direction": "credit" if credited else "debit",
+        "counterpartyOrgId": settlement.initiator if credited else settlement.beneficiary,
+        "source": settlement.source,
+        "guaranteeId": settlement.guarantee_uuid,
+        "transactionHash": settlement.transaction_hash,
+        "quoteId": settlement.quote_uuid,
+    }
+
+
+# Columns of the CSV statements
+STATEMENT_CSV_FIELDS = [
+    "id", "date", "currency", "amount", "direction", "counterpartyOrgId",
+    "source", "guaranteeId", "transactionHash", "quoteId",
+]
+
+
+@app.route("/api/v1/balances/statement", methods=["GET"])
+@auth.login_required
+def statement():
+    output_format = request.args.get("format", "json")
+    if output_format not in ["json", "ndjson", "csv"]:
+        raise SimardException("Unsupported statement format: %s" % output_format, 400)
+
+    # Handle the JSON page
+    if output_format == "json":
+        settlements, next_cursor = BalanceManager.get_statement_page(
+            orgid=g.orgid,
+            currency=request.args.get("currency"),
+            start=request.args.get("from"),
+            end=request.args.get("to"),
+            cursor=request.args.get("cursor"),
+            limit=request.args.get("limit", "100"),
+        )
+        return jsonify({
+            "settlements": [statement_entry(g.orgid, settlement) for settlement in settlements],
+            "nextCursor": next_cursor,
+        })
+
+    # Stream the other formats
+    settlements = BalanceManager.get_statement(
+        orgid=g.orgid,
+        currency=request.args.get("currency"),
+        start=request.args.get("from"),
+        end=request.args.get("to"),
+        cursor=request.args.get("cursor"),
+    )
+
+    # Stream one JSON document per line
+    orgid = g.orgid
+    if output_format == "ndjson":
+        def generate():
+            for settlement in settlements:
+                yield json.dumps(statement_entry(orgid, settlement)) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    # Stream the CSV rows
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=STATEMENT_CSV_FIELDS)
+        writer.writeheader()
+        for settlement in settlements:
+            writer.writerow(statement_entry(orgid, settlement))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=statement.csv"}
+    )
+
+
 @app.route("/api/v1/balances/guarantees", methods=["POST"])
 @auth.login_required
 def create_guarantee():
@@ -278,6 +366,27 @@ def create_guarantee():
     return jsonify({"guaranteeId": guarantee_uuid})
 
 
+@app.route("/api/v1/balances/guarantees/batch", methods=["POST"])
+@auth.login_required
+def create_guarantees():
+    # Check all parameters are present
+    parameters = request.get_json(True)
+    SimardException.check_mandatory_keys(
+        mandatory_keys=["guarantees"],
+        received_keys=parameters.keys(),
+    )
+
+    # Create the guarantees
+    guarantee_uuids = BalanceManager.add_guarantees(
+        initiating_orgid=g.orgid,
+        initiating_agent=g.agent,
+        guarantees=parameters["guarantees"],
+    )
+    return jsonify({
+        "guarantees": [{"guaranteeId": guarantee_uuid} for guarantee_uuid in guarantee_uuids]
+    })
+
+
 @app.route(
     "/api/v1/balances/guarantees/<guarantee_id>", methods=["GET", "DELETE"]
 )
@@ -0,0 +1,209 @@
+"""
+Define the secp256k1 backends verifying the JWT signatures
+"""
+import hashlib
+import time
+import ecdsa
+from ecdsa.ellipticcurve import PointJacobi
+from ecdsa.util import sigdecode_string, sigencode_der
+from eth_account import Account
+from eth_account.messages import encode_defunct
+from eth_utils import keccak, to_checksum_address
+from simard.settings import SECP256K1_BACKEND
+from model.exception import SimardException
+
+# coincurve binds the native libsecp256k1, the pure-Python ecdsa is used without it
+try:
+    import coincurve
+except ImportError:
+    coincurve = None
+
+
+class Secp256k1Exception(SimardException):
+    pass
+
+
+class EcdsaBackend(object):
+    """
+    Verify with the pure-Python ecdsa and recover with eth-account
+    """
+    NAME = 'ecdsa'
+
+    @staticmethod
+    def load_public_key(public_key_pem):
+        """
+        Load a PEM public key with its precomputed multiplication tables
+        """
+        vk = ecdsa.VerifyingKey.from_pem(
+            public_key_pem,
+            hashfunc=hashlib.sha256
+        )
+
+        # The points loaded from PEM have no order, which the precomputation requires
+        point = vk.pubkey.point
+        vk.pubkey.point = PointJacobi(
+            point.curve(), point.x(), point.y(), 1, vk.curve.order, generator=True)
+        vk.pubkey.point * 2  # Compute the multiplication tables now
+        return vk
+
+    @staticmethod
+    def verify(public_key, signature, message):
+        """
+        Verify a raw (r, s) signature of the SHA-256 of a message
+        Raises a ValueError if the signature cannot be decoded
+        """
+        if len(signature) != 64:
+            raise ValueError('The signature must be 64 bytes')
+
+        try:
+            return public_key.verify(signature, message, hashfunc=hashlib.sha256)
+        except ecdsa.keys.BadSignatureError:
+            return False
+
+    @staticmethod
+    def recover_address(text, signature):
+        """
+        Recover the address which signed a text as an Ethereum message
+        """
+        return Account.recover_message(encode_defunct(text=text), signature=signature)
+
+
+class CoincurveBackend(object):
+    """
+    Verify and recover with the native libsecp256k1
+    """
+    NAME = 'coincurve'
+
+    @staticmethod
+    def load_public_key(public_key_pem):
+        """
+        Load a PEM public key
+        """
+        vk = ecdsa.VerifyingKey.from_pem(public_key_pem)
+        return coincurve.PublicKey(vk.to_string('uncompressed'))
+
+    @staticmethod
+    def verify(public_key, signature, message):
+        """
+        Verify a raw (r, s) signature of the SHA-256 of a message
+        Raises a ValueError if the signature cannot be decoded
+        """
+        if len(signature) != 64:
+            raise ValueError('The signature must be 64 bytes')
+
+        # libsecp256k1 only accepts the signatures with a low s
+        order = ecdsa.SECP256k1.order
+        r, s = sigdecode_string(signature, order)
+        if not (0 < r < order and 0 < s < order):
+            return False
+        der = sigencode_der(r, min(s, order - s), order)
+        return public_key.verify(der, message, hasher=lambda m: hashlib.sha256(m).digest())
+
+    @staticmethod
+    def recover_address(text, signature):
+        """
+        Recover the address which signed a text as an Ethereum message
+        """
+        if len(signature) != 65:
+            raise ValueError('The signature must be 65 bytes')
+
+        # The recovery identifier is offset by 27 in Ethereum signatures
+        v = signature[64] - 27 if signature[64] >= 27 else signature[64]
+        if v not in (0, 1):
+            raise ValueError('The signature recovery identifier is invalid')
+
+        message = text.encode('utf-8')
+        message_hash = keccak(b'\x19Ethereum Signed Message:\n%i%s' % (len(message), message))
+        public_key = coincurve.PublicKey.from_signature_and_message(
+            signature[:64] + bytes([v]), message_hash, hasher=None)
+        return to_checksum_address(keccak(public_key.format(compressed=False)[1:])[-20:])
+
+
+# Backends by name
+BACKENDS = {'ecdsa': EcdsaBackend, 'coincurve': CoincurveBackend}
+
+
+class Secp256k1(object):
+    """
+    Verify the secp256k1 signatures with the configured backend
+    """
+
+    def __init__(self, backend=SECP256K1_BACKEND):
+        """
+        Constructor for the verifier
+        :param backend The name of the backend, ecdsa is used if coincurve is missing
+        """
+        if backend not in BACKENDS:
+            raise Secp256k1Exception('Unsupported secp256k1 backend: %s' % backend, 500)
+        if backend == 'coincurve' and coincurve is None:
+            backend = 'ecdsa'
+        self._backend = BACKENDS[backend]
+
+    @property
+    def name(self):
+        return self._backend.NAME
+
+    def load_public_key(self, public_key_pem):
+        """
+        Load a PEM public key for the verifications
+        """
+        return self._backend.load_public_key(public_key_pem)
+
+    def verify(self, public_key, signature, message):
+        """
+        Verify a raw (r, s) signature of the SHA-256 of a message
+        """
+        return self._backend.verify(public_key, signature, message)
+
+    def recover_address(self, text, signature):
+        """
+        Recover the address which signed a text as an Ethereum message
+        """
+        return self._backend.recover_address(text, signature)
+
+    @staticmethod
+    def available_backends():
+        """
+        Get the names of the backends which can be used
+        """
+        return [name for name in BACKENDS if name != 'coincurve' or coincurve is not None]
+
+    @staticmethod
+    def benchmark(iterations=200):
+        """
+        Measure the throughput of each available backend on a single core
+        Returns the (backend, verifications per second, recoveries per second)
+        """
+        message = b'eyJhbGciOiJFUzI1NksiLCJ0eXAiOiJKV1QifQ.eyJpc3MiOiJkaWQ6b3JnaWQ6MHgwIn0'
+
+        # Sign the message for both algorithms
+        signing_key = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1, hashfunc=hashlib.sha256)
+        public_key_pem = signing_key.get_verifying_key().to_pem().decode()
+        signature = signing_key.sign(message)
+        account = Account.create()
+        eth_signature = bytes(account.sign_message(encode_defunct(text=message.decode())).signature)
+
+        results = []
+        for name in Secp256k1.available_backends():
+            verifier = Secp256k1(name)
+            public_key = verifier.load_public_key(public_key_pem)
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                if not verifier.verify(public_key, signature, message):
+                    raise Secp256k1Exception('The %s backend rejected a valid signature' % name, 500)
+            verify_rate = iterations / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                if verifier.recover_address(message.decode(), eth_signature) != account.address:
+                    raise Secp256k1Exception('The %s backend recovered a wrong address' % name, 500)
+            recover_rate = iterations / (time.perf_counter() - start)
+
+            results.append((name, verify_rate, recover_rate))
+
+        return results
+
+
+# The verifier of the application
+secp256k1 = Secp256k1()
@@ -9,6 +9,13 @@ def get_key(key_name):
 
 # Database
 MONGODB_DATABASE_URI = get_key('MONGO_URI')
+MATERIALIZED_BALANCES_ENABLED = get_key('MATERIALIZED_BALANCES_ENABLED') == "TRUE"
+MATERIALIZED_BALANCES_WRITES_ENABLED = get_key('MATERIALIZED_BALANCES_WRITES_ENABLED') == "TRUE"
+MONGO_ENSURE_INDEXES = get_key('MONGO_ENSURE_INDEXES') == "TRUE"
+
+# Guarantees
+GUARANTEE_SWEEPER_ENABLED = get_key('GUARANTEE_SWEEPER_ENABLED') == "TRUE"
+GUARANTEE_SWEEP_INTERVAL = int(get_key('GUARANTEE_SWEEP_INTERVAL') or "60")
 
 # Infura parameters
 INFURA_WSS_ENDPOINT = get_key('INFURA_WSS_ENDPOINT')
@@ -33,9 +40,20 @@ USDC_DECIMALS = get_key('USDC_DECIMALS')
 
 # Simard parameters
 ORGID_CONTRACT = get_key('ORGID_CONTRACT')
+ORGID_CHAINID = get_key('ORGID_CHAINID')
 ORGIDVALIDATOR_URL = get_key('ORGIDVALIDATOR_URL')
 ORGIDVALIDATOR_V2_URL = get_key('ORGIDVALIDATOR_V2_URL')
+ORGIDVALIDATOR_CONNECT_TIMEOUT = float(get_key('ORGIDVALIDATOR_CONNECT_TIMEOUT') or "1")
+ORGIDVALIDATOR_READ_TIMEOUT = float(get_key('ORGIDVALIDATOR_READ_TIMEOUT') or "5")
+ORGIDVALIDATOR_RETRIES = int(get_key('ORGIDVALIDATOR_RETRIES') or "1")
+ORGIDVALIDATOR_POOL_SIZE = int(get_key('ORGIDVALIDATOR_POOL_SIZE') or "20")
 ORGID_VALIDATION_DISABLED = get_key('ORGID_VALIDATION_DISABLED') == "TRUE"
+JWT_CACHE_MAX_TTL = int(get_key('JWT_CACHE_MAX_TTL') or "300")
+JWT_CACHE_LOCAL_MAX_ENTRIES = int(get_key('JWT_CACHE_LOCAL_MAX_ENTRIES') or "1024")
+JWT_VALIDATION_MODE = get_key('JWT_VALIDATION_MODE') or "remote"
+JWT_REMOTE_FALLBACK = get_key('JWT_REMOTE_FALLBACK') == "TRUE"
+JWT_KEY_CACHE_MAX_ENTRIES = int(get_key('JWT_KEY_CACHE_MAX_ENTRIES') or "256")
+SECP256K1_BACKEND = get_key('SECP256K1_BACKEND') or "coincurve"
 
 
 PAYMENT_MANAGER_CONTRACT = get_key('PAYMENT_MANAGER_CONTRACT')
@@ -52,6 +70,27 @@ ELASTIC_SEARCH_URL = get_key('ELASTIC_SEARCH_URL')
 
 # Redis Memcache
 REDIS_URL = get_key('REDIS_URL')
+REDIS_SOCKET_TIMEOUT = float(get_key('REDIS_SOCKET_TIMEOUT') or "0.5")
+REDIS_CONNECT_TIMEOUT = float(get_key('REDIS_CONNECT_TIMEOUT') or "0.5")
+REDIS_MAX_CONNECTIONS = int(get_key('REDIS_MAX_CONNECTIONS') or "50")
+CACHE_LOCAL_MAX_ENTRIES = int(get_key('CACHE_LOCAL_MAX_ENTRIES') or "1024")
+CACHE_LOCAL_MAX_TTL = float(get_key('CACHE_LOCAL_MAX_TTL') or "5")
+CACHE_MEMORY_MAX_ENTRIES = int(get_key('CACHE_MEMORY_MAX_ENTRIES') or "100000")
+CACHE_CODEC = get_key('CACHE_CODEC') or "msgpack"
+CACHE_COMPRESSION_THRESHOLD = int(get_key('CACHE_COMPRESSION_THRESHOLD') or "1024")
+ORGID_WATCHER_ENABLED = get_key('ORGID_WATCHER_ENABLED') == "TRUE"
+ORGID_WATCHER_INTERVAL = int(get_key('ORGID_WATCHER_INTERVAL') or "15")
+CACHE_WARM_UP_ENABLED = get_key('CACHE_WARM_UP_ENABLED') == "TRUE"
+CACHE_WARM_UP_WORKERS = int(get_key('CACHE_WARM_UP_WORKERS') or "8")
+CACHE_WARM_UP_DAYS = int(get_key('CACHE_WARM_UP_DAYS') or "30")
+DID_CACHE_SOFT_TTL = int(get_key('DID_CACHE_SOFT_TTL') or "60")
+DID_CACHE_HARD_TTL = int(get_key('DID_CACHE_HARD_TTL') or "900")
+DID_REFRESH_WORKERS = int(get_key('DID_REFRESH_WORKERS') or "4")
+DID_RESOLUTION_LEASE = int(get_key('DID_RESOLUTION_LEASE') or "10")
+DID_CACHE_NEGATIVE_TTL = int(get_key('DID_CACHE_NEGATIVE_TTL') or "30")
+DID_FETCH_TIMEOUT = float(get_key('DID_FETCH_TIMEOUT') or "5")
+DID_HEDGE_DELAY = float(get_key('DID_HEDGE_DELAY') or "0.5")
+DID_FETCH_WORKERS = int(get_key('DID_FETCH_WORKERS') or "16")
 
 # PCI-Proxy
 PCIPROXY_API_USERNAME = get_key('PCIPROXY_API_USERNAME')
@@ -3,9 +3,11 @@ Define a class to manage the Settlement object
 """
 import uuid
 from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
 from decimal import Decimal
 from model.exception import SimardException
 from simard.db import db
+from simard.balance import Balance, BalanceFilter
 from simard.guarantee import Guarantee
 from simard.w3 import w3, DISCARD, TransactionNotFound
 from schemas import abi
@@ -20,6 +22,9 @@ class Settlement(object):
     """
     Define a settlement action
     """
+    # Number of settlements read at once for a statement
+    _STATEMENT_BATCH_SIZE = 500
+
     def __init__(
         self,
         initiator,
@@ -77,6 +82,12 @@ class Settlement(object):
             result = db.settlements.insert_one(document)
             self._id = result.inserted_id
 
+            # Record the movement on the materialized balances
+            Balance.increment(self.currency, [
+                (self.beneficiary, BalanceFilter.CREDITED, self.amount),
+                (self.initiator, BalanceFilter.DEBITED, self.amount),
+            ])
+
         # For an update, update the values
         else:
             db.settlements.update_one(
@@ -87,6 +98,15 @@ class Settlement(object):
         # Return self for chaining
         return self
 
+    @property
+    def date(self):
+        """
+        The creation date of a stored settlement
+        """
+        if self._id is None:
+            return None
+        return self._id.generation_time
+
     @classmethod
     def from_database_result(cls, result):
         """
@@ -123,6 +143,39 @@ class Settlement(object):
 
         return settlement
 
+    @classmethod
+    def from_statement(cls, orgid, currency=None, start=None, end=None, after=None, limit=None):
+        """
+        Iterate over the settlements of an ORG.ID in their creation order
+        :param after: The identifier of the last settlement already read
+        """
+        filters = {'$or': [{'beneficiary': orgid}, {'initiator': orgid}]}
+        if currency is not None:
+            filters['currency'] = currency
+
+        # The identifiers are ordered by creation date
+        id_filters = {}
+        if start is not None:
+            id_filters['$gte'] = ObjectId.from_datetime(start)
+        if end is not None:
+            id_filters['$lt'] = ObjectId.from_datetime(end)
+        if after is not None:
+            id_filters['$gt'] = after
+        if id_filters:
+            filters['_id'] = id_filters
+
+        # Results are read by batches from the cursor
+        cursor = db.settlements.find(
+            filters,
+            sort=[('_id', 1)],
+            batch_size=cls._STATEMENT_BATCH_SIZE
+        )
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        for result in cursor:
+            yield cls.from_database_result(result)
+
     @classmethod
     def from_storage(cls, settlement_uuid):
         """
@@ -0,0 +1,104 @@
+"""
+Define the HTTP client of the ORG.ID validator
+"""
+import time
+import atexit
+from threading import Lock
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from simard.settings import ORGIDVALIDATOR_CONNECT_TIMEOUT, ORGIDVALIDATOR_READ_TIMEOUT, \
+    ORGIDVALIDATOR_RETRIES, ORGIDVALIDATOR_POOL_SIZE
+from model.exception import SimardException
+
+
+class ValidatorClientException(SimardException):
+    pass
+
+
+class ValidatorClient(object):
+    """
+    Send the requests to the ORG.ID validator over kept-alive connections
+    The latency of the requests is measured
+    """
+    # Responses of an unavailable validator, retried
+    _RETRY_STATUSES = (502, 503, 504)
+    _RETRY_BACKOFF = 0.1  # Seconds before the second retry, doubled for each one
+
+    def __init__(
+        self,
+        connect_timeout=ORGIDVALIDATOR_CONNECT_TIMEOUT,
+        read_timeout=ORGIDVALIDATOR_READ_TIMEOUT,
+        retries=ORGIDVALIDATOR_RETRIES,
+        pool_size=ORGIDVALIDATOR_POOL_SIZE
+    ):
+        """
+        Constructor for the client
+        :param connect_timeout The maximum time to open a connection in seconds
+        :param read_timeout The maximum time between two bytes of the response in seconds
+        :param retries The number of retries of a failed request
+        :param pool_size The number of connections kept alive by host
+        """
+        self._timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            status_forcelist=self._RETRY_STATUSES,
+            allowed_methods=['GET'],
+            backoff_factor=self._RETRY_BACKOFF,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        atexit.register(self.close)
+
+        # Latency metrics
+        self._lock = Lock()  # A thread lock on the metrics
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def get(self, url, params):
+        """
+        Send a GET request to the validator
+        """
+        start = time.perf_counter()
+        try:
+            return self._session.get(url, params=params, timeout=self._timeout)
+
+        # The validator could not be reached in time
+        except requests.exceptions.RequestException as e:
+            with self._lock:
+                self.errors += 1
+            raise ValidatorClientException(
+                "ORG.ID validator is not available", 502) from e
+
+        finally:
+            latency = time.perf_counter() - start
+            with self._lock:
+                self.requests += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        """
+        Get the counters and latencies of the requests in seconds
+        """
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'averageLatency': self.total_latency / self.requests if self.requests else 0.0,
+                'maxLatency': self.max_latency,
+            }
+
+    def close(self):
+        """
+        Close the connections
+        """
+        self._session.close()
+
+
+validator_client = ValidatorClient()
@@ -0,0 +1,15 @@
+from simard.balance import BalanceSnapshot
+
+
+def aggregated_snapshot(balance):
+    """
+    Compute a snapshot with one aggregation per total, mongomock does not implement $unionWith
+    """
+    return BalanceSnapshot(
+        balance.orgid,
+        balance.currency,
+        credit=balance.credit,
+        debit=balance.debit,
+        reserved=balance.reserved,
+        claimable=balance.claimable
+    )
@@ -1,5 +1,7 @@
-from unittest import TestCase
-from simard.balance import Balance
+import os
+import uuid
+from unittest import TestCase, SkipTest
+from simard.balance import Balance, BalanceFilter, BalanceException
 from simard.settlement import Settlement
 from simard.guarantee import Guarantee
 from decimal import Decimal
@@ -7,7 +9,12 @@ from simard.db import db
 from unittest import mock
 import mongomock
 from bson.decimal128 import Decimal128
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import dateutil.parser
+from datetime import datetime, timedelta, timezone
+from bson.objectid import ObjectId
+from simard.ledger_checkpoint import LedgerCheckpoint
 
 
 # 2020-03-03: Aggregate function needs to be manually patched
@@ -28,6 +35,22 @@ def get_mock_debit_aggregate(operations, currency, initiator):
     return [{'total': Decimal128(total), '_id': currency}]
 
 
+def get_mock_snapshot_aggregate(settlements, guarantees, currency, orgid):
+    def facet(operations, prop):
+        total = Decimal()
+        for o in operations:
+            if o.currency == currency and getattr(o, prop) == orgid:
+                total += o.amount
+        return [{'_id': None, 'total': Decimal128(total)}]
+
+    return [{
+        'credit': facet(settlements, 'beneficiary'),
+        'debit': facet(settlements, 'initiator'),
+        'reserved': facet(guarantees, 'initiator'),
+        'claimable': facet(guarantees, 'beneficiary'),
+    }]
+
+
 def get_credit_aggregate_pipeline(currency, beneficiary):
     return [
         {
@@ -74,6 +97,7 @@ class BalanceTest(TestCase):
         db._database = mongomock.MongoClient().unittest
         db.settlements.drop()
         db.guarantees.drop()
+        db.balances.drop()
 
         self.g1_initiator = "1234"
         self.g1_beneficiary = "4567"
@@ -324,23 +348,14 @@ class BalanceTest(TestCase):
                 Decimal('75.0')
             )
 
-        # Check the amount available
+        # Check the amount available is computed in a single call
         with mock.patch("mongomock.collection.Collection.aggregate") as ma:
             ma.side_effect = [
-                get_mock_credit_aggregate(
-                    operations=settlements,
+                get_mock_snapshot_aggregate(
+                    settlements=settlements,
+                    guarantees=guarantees,
                     currency='EUR',
-                    beneficiary='did:orgid:ota'
-                ),
-                get_mock_debit_aggregate(
-                    operations=settlements,
-                    currency='EUR',
-                    initiator='did:orgid:ota'
-                ),
-                get_mock_debit_aggregate(
-                    operations=guarantees,
-                    currency='EUR',
-                    initiator='did:orgid:ota'
+                    orgid='did:orgid:ota'
                 ),
                 Exception('Too many calls')
             ]
@@ -351,6 +366,284 @@ class BalanceTest(TestCase):
                 Decimal('25.0')
             )
 
+    def test_snapshot(self):
+        """
+        Test that all the totals of a balance are computed in a single call
+        """
+        settlements = [
+            Settlement(
+                initiator='did:orgid:faucet',
+                beneficiary='did:orgid:ota',
+                amount=Decimal('100.00'),
+                currency='EUR',
+                agent='bob',
+            ),
+            Settlement(
+                initiator='did:orgid:ota',
+                beneficiary='did:orgid:supplier',
+                amount=Decimal('10.00'),
+                currency='EUR',
+                agent='bob',
+            ),
+        ]
+        guarantees = [
+            Guarantee(
+                initiator='did:orgid:ota',
+                beneficiary='did:orgid:supplier',
+                amount=Decimal('75.00'),
+                currency='EUR',
+                expiration=dateutil.parser.isoparse(
+                    '2020-01-01T12:16:14+00:00'),
+                agent='bob',
+            ),
+        ]
+
+        with mock.patch("mongomock.collection.Collection.aggregate") as ma:
+            ma.return_value = get_mock_snapshot_aggregate(
+                settlements=settlements,
+                guarantees=guarantees,
+                currency='EUR',
+                orgid='did:orgid:ota'
+            )
+            snapshot = Balance(orgid='did:orgid:ota', currency='EUR').snapshot()
+
+            # Verify the single call made on the settlements
+            ma.assert_called_once()
+            (pipeline,), _ = ma.call_args
+            self.assertEqual(pipeline[0]['$match']['currency'], 'EUR')
+            self.assertEqual(pipeline[2]['$unionWith']['coll'], 'guarantees')
+            self.assertEqual(
+                sorted(pipeline[3]['$facet'].keys()),
+                ['claimable', 'credit', 'debit', 'reserved']
+            )
+
+        self.assertEqual(snapshot.orgid, 'did:orgid:ota')
+        self.assertEqual(snapshot.currency, 'EUR')
+        self.assertEqual(snapshot.credit, Decimal('100.00'))
+        self.assertEqual(snapshot.debit, Decimal('10.00'))
+        self.assertEqual(snapshot.reserved, Decimal('75.00'))
+        self.assertEqual(snapshot.claimable, Decimal('0.00'))
+        self.assertEqual(snapshot.total, Decimal('90.00'))
+        self.assertEqual(snapshot.available, Decimal('15.00'))
+
+    def test_snapshot_empty(self):
+        """
+        Test a snapshot of a balance without any operation
+        """
+        with mock.patch("mongomock.collection.Collection.aggregate") as ma:
+            ma.return_value = [{'credit': [], 'debit': [], 'reserved': [], 'claimable': []}]
+            snapshot = Balance(orgid='did:orgid:ota', currency='EUR').snapshot()
+
+        self.assertEqual(snapshot.total, Decimal('0.0'))
+        self.assertEqual(snapshot.reserved, Decimal('0.0'))
+        self.assertEqual(snapshot.available, Decimal('0.0'))
+
+    @mock.patch("simard.balance.MATERIALIZED_BALANCES_ENABLED", True)
+    def test_materialized_snapshot(self):
+        """
+        Test the balance is read from the materialized document
+        """
+        db.balances.insert_one({
+            'orgid': 'did:orgid:ota',
+            'currency': 'EUR',
+            'credit': Decimal128('100.00'),
+            'debit': Decimal128('10.00'),
+            'reserved': Decimal128('75.00'),
+        })
+
+        with mock.patch("mongomock.collection.Collection.aggregate") as ma:
+            ma.side_effect = Exception('No aggregation expected')
+            balance = Balance(orgid='did:orgid:ota', currency='EUR')
+            self.assertEqual(balance.total, Decimal('90.00'))
+            self.assertEqual(balance.reserved, Decimal('75.00'))
+            self.assertEqual(balance.claimable, Decimal('0.00'))
+            self.assertEqual(balance.available, Decimal('15.00'))
+
+            # A balance without document is empty
+            empty = Balance(orgid='did:orgid:ota', currency='USD').snapshot()
+            self.assertEqual(empty.available, Decimal('0.00'))
+
+    @mock.patch("simard.balance.MATERIALIZED_BALANCES_WRITES_ENABLED", True)
+    def test_materialized_increments(self):
+        """
+        Test the materialized balances are incremented by the operations
+        """
+        with mock.patch("mongomock.collection.Collection.bulk_write") as bw:
+            settlement = Settlement(
+                initiator='did:orgid:faucet',
+                beneficiary='did:orgid:ota',
+                amount=Decimal('100.00'),
+                currency='EUR',
+                agent='bob',
+            ).store()
+            bw.assert_called_once_with([
+                UpdateOne(
+                    {'orgid': 'did:orgid:ota', 'currency': 'EUR'},
+                    {'$inc': {'credit': Decimal128('100.00')}},
+                    upsert=True
+                ),
+                UpdateOne(
+                    {'orgid': 'did:orgid:faucet', 'currency': 'EUR'},
+                    {'$inc': {'debit': Decimal128('100.00')}},
+                    upsert=True
+                ),
+            ], ordered=False)
+
+            # An update of the settlement is not counted twice
+            settlement.store()
+            self.assertEqual(bw.call_count, 1)
+
+    def test_materialized_increments_disabled(self):
+        """
+        Test the materialized balances are untouched when disabled
+        """
+        with mock.patch("mongomock.collection.Collection.bulk_write") as bw:
+            self.assertIsNone(Balance.increment('EUR', [
+                ('did:orgid:ota', BalanceFilter.CREDITED, Decimal('1.00'))
+            ]))
+            bw.assert_not_called()
+
+    @mock.patch("simard.balance.MATERIALIZED_BALANCES_WRITES_ENABLED", True)
+    def test_materialized_writes_only(self):
+        """
+        Test the totals are maintained but not read until the reads are enabled
+        """
+        db.balances.create_index([('orgid', 1), ('currency', 1)], unique=True)
+        store, release = mock.Mock(), mock.Mock()
+
+        with mock.patch("mongomock.collection.Collection.find_one_and_update") as fu, \
+                mock.patch("simard.balance.Balance.increment") as bi, \
+                mock.patch('simard.balance.Balance.available', new_callable=mock.PropertyMock) as ma:
+            ma.return_value = Decimal('100.00')
+            self.assertTrue(self.initiator_balance.reserve(Decimal('60.00'), store, release))
+
+            # The reservation is checked on the ledger and recorded on the totals
+            fu.assert_not_called()
+            bi.assert_called_once_with(self.g1_currency, [(self.g1_initiator, BalanceFilter.RESERVED, Decimal('60.00'))])
+            store.assert_called_once_with()
+
+    def test_rebuild(self):
+        """
+        Test the materialized balances are rebuilt from the ledger
+        """
+        Settlement(
+            initiator='did:orgid:faucet',
+            beneficiary='did:orgid:ota',
+            amount=Decimal('100.00'),
+            currency='EUR',
+            agent='bob',
+        ).store()
+        Guarantee(
+            initiator='did:orgid:ota',
+            beneficiary='did:orgid:supplier',
+            amount=Decimal('75.00'),
+            currency='EUR',
+            expiration=dateutil.parser.isoparse('2020-01-01T12:16:14+00:00'),
+            agent='bob',
+        ).store()
+        db.balances.insert_one({
+            'orgid': 'did:orgid:ota',
+            'currency': 'EUR',
+            'credit': Decimal128('90.00'),
+            'reserved': Decimal128('75.00'),
+        })
+        db.balances.insert_one({
+            'orgid': 'did:orgid:ghost',
+            'currency': 'EUR',
+            'credit': Decimal128('5.00'),
+        })
+
+        # Check the drift is reported
+        drifts = Balance.rebuild(dry_run=True)
+        self.assertCountEqual(drifts, [
+            ('did:orgid:faucet', 'EUR', 'debit', Decimal('100.00')),
+            ('did:orgid:ota', 'EUR', 'credit', Decimal('10.00')),
+            ('did:orgid:supplier', 'EUR', 'claimable', Decimal('75.00')),
+            ('did:orgid:ghost', 'EUR', 'credit', Decimal('-5.00')),
+        ])
+
+        # Check the drift is corrected on the totals read
+        with mock.patch("mongomock.collection.Collection.bulk_write") as bw:
+            bw.return_value.bulk_api_result = {'nMatched': 2, 'nUpserted': 2}
+            Balance.rebuild()
+            (operations,), _ = bw.call_args
+            self.assertIn(UpdateOne(
+                {
+                    'orgid': 'did:orgid:ota',
+                    'currency': 'EUR',
+                    'credit': Decimal128('90.00'),
+                    'debit': {'$exists': False},
+                    'reserved': Decimal128('75.00'),
+                    'claimable': {'$exists': False},
+                },
+                {'$inc': {'credit': Decimal128('10.00')}},
+                upsert=False
+            ), operations)
+            self.assertIn(UpdateOne(
+                {
+                    'orgid': 'did:orgid:supplier',
+                    'currency': 'EUR',
+                    'credit': {'$exists': False},
+                    'debit': {'$exists': False},
+                    'reserved': {'$exists': False},
+                    'claimable': {'$exists': False},
+                },
+                {'$inc': {'claimable': Decimal128('75.00')}},
+                upsert=True
+            ), operations)
+            self.assertEqual(len(operations), 4)
+
+    def test_rebuild_concurrent(self):
+        """
+        Test that the totals updated during the rebuild are reported
+        """
+        Settlement(
+            initiator='did:orgid:faucet',
+            beneficiary='did:orgid:ota',
+            amount=Decimal('100.00'),
+            currency='EUR',
+            agent='bob',
+        ).store()
+
+        # One total was updated since it was read
+        with mock.patch("mongomock.collection.Collection.bulk_write") as bw:
+            bw.return_value.bulk_api_result = {'nMatched': 0, 'nUpserted': 1}
+            with self.assertRaises(BalanceException) as ctx:
+                Balance.rebuild()
+        self.assertEqual(ctx.exception.code, 409)
+
+        # Or created since it was read
+        with mock.patch("mongomock.collection.Collection.bulk_write") as bw:
+            bw.side_effect = BulkWriteError({'nMatched': 0, 'nUpserted': 1, 'writeErrors': [{'code': 11000}]})
+            with self.assertRaises(BalanceException) as ctx:
+                Balance.rebuild()
+        self.assertEqual(ctx.exception.code, 409)
+
+    def test_ledger_totals_legacy_guarantees(self):
+        """
+        Test the guarantees stored with a claimed flag are reserved until claimed
+        """
+        for uuid_value, claimed in [('a', True), ('b', False)]:
+            db.guarantees.insert_one({
+                'uuid': uuid_value,
+                'initiator': 'did:orgid:ota',
+                'beneficiary': 'did:orgid:supplier',
+                'amount': Decimal128('75.00'),
+                'currency': 'EUR',
+                'expiration': dateutil.parser.isoparse('2020-01-01T12:16:14+00:00'),
+                'agent': 'bob',
+                'claimed': claimed,
+            })
+
+        totals = Balance.ledger_totals()
+        self.assertEqual(totals[('did:orgid:ota', 'EUR')].reserved, Decimal('75.00'))
+        self.assertEqual(totals[('did:orgid:supplier', 'EUR')].claimable, Decimal('75.00'))
+        self.assertEqual(self.initiator_balance.aggregate_guarantees(BalanceFilter.RESERVED), Decimal('0'))
+        self.assertEqual(
+            Balance('did:orgid:ota', 'EUR').aggregate_guarantees(BalanceFilter.RESERVED),
+            Decimal('75.00')
+        )
+
     def test_guarantee_claimable_scenario(self):
         # Initial test setup
         db.settlements.drop()
@@ -478,3 +771,320 @@ class BalanceTest(TestCase):
 
         res3 = Balance.retrieve_all('did:orgid:ota')
         self.assertEqual(len(res3), 2)
+
+    def test_snapshot_all(self):
+        """
+        Test that all the balances of an ORG.ID are computed in a single call
+        """
+        with mock.patch("mongomock.collection.Collection.aggregate") as ma:
+            ma.return_value = [
+                {
+                    '_id': 'EUR',
+                    'received': 2,
+                    'credit': Decimal128('100.00'),
+                    'debit': Decimal128('10.00'),
+                    'reserved': Decimal128('75.00'),
+                    'claimable': 0,
+                },
+                {
+                    '_id': 'USD',
+                    'received': 1,
+                    'credit': Decimal128('30.00'),
+                    'debit': 0,
+                    'reserved': 0,
+                    'claimable': Decimal128('5.00'),
+                },
+                {
+                    '_id': 'GBP',
+                    'received': 0,
+                    'credit': 0,
+                    'debit': 0,
+                    'reserved': 0,
+                    'claimable': Decimal128('5.00'),
+                },
+            ]
+            snapshots = Balance.snapshot_all('did:orgid:ota')
+
+            # Verify the single call grouping by currency
+            ma.assert_called_once()
+            (pipeline,), _ = ma.call_args
+            self.assertEqual(pipeline[2]['$unionWith']['coll'], 'guarantees')
+            self.assertEqual(pipeline[3]['$group']['_id'], '$currency')
+
+        self.assertEqual(len(snapshots), 2)
+        self.assertEqual(snapshots[0].orgid, 'did:orgid:ota')
+        self.assertEqual(snapshots[0].currency, 'EUR')
+        self.assertEqual(snapshots[0].total, Decimal('90.00'))
+        self.assertEqual(snapshots[0].reserved, Decimal('75.00'))
+        self.assertEqual(snapshots[0].available, Decimal('15.00'))
+        self.assertEqual(snapshots[1].currency, 'USD')
+        self.assertEqual(snapshots[1].available, Decimal('30.00'))
+        self.assertEqual(snapshots[1].claimable, Decimal('5.00'))
+
+    @mock.patch("simard.balance.MATERIALIZED_BALANCES_ENABLED", True)
+    def test_materialized_snapshot_all(self):
+        """
+        Test that all the balances are read from the materialized documents
+        """
+        db.balances.insert_many([
+            {'orgid': 'did:orgid:ota', 'currency': 'EUR', 'credit': Decimal128('100.00'), 'reserved': Decimal128('20.00')},
+            {'orgid': 'did:orgid:ota', 'currency': 'USD', 'debit': Decimal128('0.00')},
+            {'orgid': 'did:orgid:other', 'currency': 'EUR', 'credit': Decimal128('50.00')},
+        ])
+
+        snapshots = Balance.snapshot_all('did:orgid:ota')
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(snapshots[0].currency, 'EUR')
+        self.assertEqual(snapshots[0].total, Decimal('100.00'))
+        self.assertEqual(snapshots[0].available, Decimal('80.00'))
+
+    def test_reserve(self):
+        """
+        Test that a reservation bumps the version of the balance
+        """
+        db.balances.create_index([('orgid', 1), ('currency', 1)], unique=True)
+        store, release = mock.Mock(), mock.Mock()
+
+        with mock.patch(
+            'simard.balance.Balance.available',
+            new_callable=mock.PropertyMock
+        ) as ma:
+            ma.return_value = Decimal('100.00')
+            self.assertTrue(self.initiator_balance.reserve(Decimal('60.00'), store, release))
+            self.assertTrue(self.initiator_balance.reserve(Decimal('40.00'), store, release))
+            self.assertFalse(self.initiator_balance.reserve(Decimal('100.01'), store, release))
+
+        self.assertEqual(store.call_count, 2)
+        release.assert_not_called()
+        result = db.balances.find_one({'orgid': self.g1_initiator, 'currency': self.g1_currency})
+        self.assertEqual(result['version'], 2)
+
+    def test_reserve_index(self):
+        """
+        Test that the unique index detecting concurrent reservations is provisioned
+        """
+        with mock.patch(
+            'simard.balance.Balance.available',
+            new_callable=mock.PropertyMock
+        ) as ma:
+            ma.return_value = Decimal('100.00')
+            self.assertTrue(self.initiator_balance.reserve(Decimal('60.00'), mock.Mock(), mock.Mock()))
+
+        self.assertTrue(db.balances.index_information()['orgid_currency']['unique'])
+
+        # A reservation on another version is detected
+        with self.assertRaises(DuplicateKeyError):
+            db.balances.update_one(
+                {'orgid': self.g1_initiator, 'currency': self.g1_currency, 'version': 0},
+                {'$set': {'version': 1}},
+                upsert=True
+            )
+
+    def test_reserve_concurrent(self):
+        """
+        Test that a reservation is released when made concurrently
+        """
+        db.balances.create_index([('orgid', 1), ('currency', 1)], unique=True)
+        store, release = mock.Mock(), mock.Mock()
+
+        # Another reservation is made between the check and the version update
+        def concurrent_store():
+            db.balances.update_one(
+                {'orgid': self.g1_initiator, 'currency': self.g1_currency},
+                {'$inc': {'version': 1}},
+                upsert=True
+            )
+        store.side_effect = concurrent_store
+
+        with mock.patch(
+            'simard.balance.Balance.available',
+            new_callable=mock.PropertyMock
+        ) as ma:
+            ma.return_value = Decimal('100.00')
+            with self.assertRaises(BalanceException) as ctx:
+                self.initiator_balance.reserve(Decimal('60.00'), store, release)
+
+        self.assertEqual(ctx.exception.code, 409)
+        self.assertEqual(store.call_count, Balance._RESERVE_ATTEMPTS)
+        self.assertEqual(release.call_count, Balance._RESERVE_ATTEMPTS)
+
+    @mock.patch("simard.balance.MATERIALIZED_BALANCES_ENABLED", True)
+    def test_reserve_materialized(self):
+        """
+        Test that a materialized balance is checked and reserved at once
+        """
+        store, release = mock.Mock(), mock.Mock()
+
+        with mock.patch("mongomock.collection.Collection.find_one_and_update") as fu:
+            fu.return_value = None
+            self.assertFalse(self.initiator_balance.reserve(Decimal('60.00'), store, release))
+            store.assert_not_called()
+
+            fu.return_value = {'orgid': self.g1_initiator}
+            self.assertTrue(self.initiator_balance.reserve(Decimal('60.00'), store, release))
+            store.assert_called_once_with()
+            self.assertEqual(fu.call_args[0][1], {'$inc': {'reserved': Decimal128('60.00')}})
+
+            # The reservation is reverted if the storage fails
+            store.side_effect = Exception('Storage failure')
+            with mock.patch("mongomock.collection.Collection.bulk_write") as bw:
+                with self.assertRaises(Exception):
+                    self.initiator_balance.reserve(Decimal('60.00'), store, release)
+                bw.assert_called_once_with([UpdateOne(
+                    {'orgid': self.g1_initiator, 'currency': self.g1_currency},
+                    {'$inc': {'reserved': Decimal128('-60.00')}},
+                    upsert=True
+                )], ordered=False)
+            release.assert_not_called()
+
+
+class BalanceMongoDBTest(TestCase):
+    """
+    Run the aggregations mongomock does not implement against a MongoDB 4.4+ server
+    The server is read from MONGO_TEST_URI, the tests are skipped without one
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.client = MongoClient(
+            os.environ.get('MONGO_TEST_URI', 'mongodb://localhost:27017'),
+            serverSelectionTimeoutMS=500
+        )
+        try:
+            version = cls.client.server_info()['versionArray']
+        except PyMongoError:
+            cls.client.close()
+            raise SkipTest('No MongoDB server available')
+
+        if version < [4, 4]:
+            cls.client.close()
+            raise SkipTest('$unionWith requires MongoDB 4.4')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+
+    def setUp(self):
+        self.database_name = 'simard_unittest_%s' % uuid.uuid4().hex
+        self.previous_database = db._database
+        db._database = self.client[self.database_name]
+
+    def tearDown(self):
+        db._database = self.previous_database
+        self.client.drop_database(self.database_name)
+
+    def add_settlement(self, initiator, beneficiary, amount, currency, days_ago):
+        """
+        Insert a settlement created in the past
+        """
+        timestamp = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(days=days_ago))
+        db.settlements.insert_one({
+            '_id': ObjectId(timestamp.binary[:4] + ObjectId().binary[4:]),
+            'initiator': initiator,
+            'beneficiary': beneficiary,
+            'amount': Decimal128(amount),
+            'currency': currency,
+        })
+
+    def add_ledger(self):
+        """
+        Insert settlements in several currencies, partly checkpointed, and guarantees
+        """
+        self.add_settlement('did:orgid:faucet', 'did:orgid:ota', '100.00', 'EUR', 10)
+        self.add_settlement('did:orgid:ota', 'did:orgid:supplier', '30.00', 'EUR', 10)
+        self.add_settlement('did:orgid:faucet', 'did:orgid:ota', '40.00', 'GBP', 10)
+        LedgerCheckpoint.run(lag=timedelta(days=5))
+
+        self.add_settlement('did:orgid:faucet', 'did:orgid:ota', '20.00', 'EUR', 3)
+        self.add_settlement('did:orgid:faucet', 'did:orgid:ota', '15.00', 'USD', 3)
+        LedgerCheckpoint.run(lag=timedelta(days=1))
+        self.add_settlement('did:orgid:ota', 'did:orgid:supplier', '5.00', 'EUR', 0)
+
+        expiration = dateutil.parser.isoparse('2218-05-25T12:16:14+00:00')
+        Guarantee('did:orgid:ota', 'did:orgid:supplier', Decimal('50.00'), 'EUR', expiration, 'bob').store()
+        Guarantee('did:orgid:supplier', 'did:orgid:ota', Decimal('8.00'), 'USD', expiration, 'bob').store()
+        claimed = Guarantee('did:orgid:ota', 'did:orgid:supplier', Decimal('9.00'), 'EUR', expiration, 'bob')
+        claimed.store()
+        db.guarantees.update_one({'uuid': claimed.uuid}, {'$set': {'status': 'claimed'}})
+
+    def test_snapshot(self):
+        """
+        Test that the snapshot matches the separate aggregations
+        """
+        Settlement('did:orgid:faucet', 'did:orgid:ota', Decimal('100.00'), 'EUR', 'bob').store()
+        Settlement('did:orgid:ota', 'did:orgid:supplier', Decimal('10.00'), 'EUR', 'bob').store()
+        Settlement('did:orgid:supplier', 'did:orgid:ota', Decimal('2.50'), 'EUR', 'bob').store()
+        Settlement('did:orgid:faucet', 'did:orgid:ota', Decimal('40.00'), 'USD', 'bob').store()
+
+        expiration = dateutil.parser.isoparse('2218-05-25T12:16:14+00:00')
+        Guarantee('did:orgid:ota', 'did:orgid:supplier', Decimal('75.00'), 'EUR', expiration, 'bob').store()
+        Guarantee('did:orgid:supplier', 'did:orgid:ota', Decimal('5.00'), 'EUR', expiration, 'bob').store()
+
+        # Guarantees no longer active or stored before the statuses
+        claimed = Guarantee('did:orgid:ota', 'did:orgid:supplier', Decimal('20.00'), 'EUR', expiration, 'bob')
+        claimed.store()
+        db.guarantees.update_one({'uuid': claimed.uuid}, {'$set': {'status': 'claimed'}})
+        db.guarantees.insert_many([
+            {'initiator': 'did:orgid:ota', 'beneficiary': 'did:orgid:supplier', 'amount': Decimal128('7.00'),
+             'currency': 'EUR', 'claimed': False},
+            {'initiator': 'did:orgid:ota', 'beneficiary': 'did:orgid:supplier', 'amount': Decimal128('9.00'),
+             'currency': 'EUR', 'claimed': True},
+        ])
+
+        balance = Balance(orgid='did:orgid:ota', currency='EUR')
+        snapshot = balance.snapshot()
+        self.assertEqual(snapshot.credit, Decimal('102.50'))
+        self.assertEqual(snapshot.debit, Decimal('10.00'))
+        self.assertEqual(snapshot.reserved, Decimal('82.00'))
+        self.assertEqual(snapshot.claimable, Decimal('5.00'))
+        self.assertEqual(snapshot.available, Decimal('10.50'))
+        self.assertEqual(
+            (snapshot.credit, snapshot.debit, snapshot.reserved, snapshot.claimable),
+            (balance.credit, balance.debit, balance.reserved, balance.claimable)
+        )
+
+        # A balance without any operation
+        empty = Balance(orgid='did:orgid:ota', currency='GBP').snapshot()
+        self.assertEqual(empty.total, Decimal('0'))
+        self.assertEqual(empty.available, Decimal('0'))
+
+    def test_snapshot_checkpoint(self):
+        """
+        Test that the checkpointed settlements are added once to the recent ones
+        """
+        self.add_ledger()
+        checkpoint = LedgerCheckpoint.from_storage('did:orgid:ota', 'EUR')
+        self.assertEqual(checkpoint.credit, Decimal('120.00'))
+
+        balance = Balance(orgid='did:orgid:ota', currency='EUR')
+        snapshot = balance.snapshot()
+        self.assertEqual(snapshot.credit, Decimal('120.00'))
+        self.assertEqual(snapshot.debit, Decimal('35.00'))
+        self.assertEqual(snapshot.reserved, Decimal('50.00'))
+        self.assertEqual(snapshot.available, Decimal('35.00'))
+        self.assertEqual((snapshot.credit, snapshot.debit), (balance.credit, balance.debit))
+
+    def test_snapshot_all(self):
+        """
+        Test the snapshots of all the currencies of an ORG.ID
+        """
+        self.add_ledger()
+
+        snapshots = sorted(Balance.snapshot_all('did:orgid:ota'), key=lambda s: s.currency)
+        self.assertEqual([s.currency for s in snapshots], ['EUR', 'GBP', 'USD'])
+        totals = [(s.credit, s.debit, s.reserved, s.claimable) for s in snapshots]
+        self.assertEqual(totals, [
+            (Decimal('120.00'), Decimal('35.00'), Decimal('50.00'), Decimal('0')),
+            (Decimal('40.00'), Decimal('0'), Decimal('0'), Decimal('0')),
+            (Decimal('15.00'), Decimal('0'), Decimal('0'), Decimal('8.00')),
+        ])
+
+        # Each snapshot matches the one of its balance
+        for s in snapshots:
+            snapshot = Balance(orgid='did:orgid:ota', currency=s.currency).snapshot()
+            self.assertEqual(
+                (snapshot.credit, snapshot.debit, snapshot.reserved, snapshot.claimable),
+                (s.credit, s.debit, s.reserved, s.claimable)
+            )
+
+        # The balances of the ORG.IDs which never received a settlement are not returned
+        self.assertEqual(Balance.snapshot_all('did:orgid:faucet'), [])
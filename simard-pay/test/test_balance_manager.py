@@ -11,10 +11,12 @@ from bson.decimal128 import Decimal128
 from unittest import mock
 import uuid
 import dateutil.parser
+from datetime import datetime
 from simard.virtualcard import VirtualCard
 from web3 import Web3
 from simard.quote import Quote, QuoteException
 from simard.quote_manager import QuoteManagerException
+from test.helpers import aggregated_snapshot
 
 
 ETHEREUM_RPC = 'wss://ropsten.infura.io/ws/v3/2fd62c57b57e4f27b8d6909d07c2b6d1'
@@ -30,6 +32,7 @@ TRANSFERWISE_API_ENDPOINT = 'https://api.sandbox.transferwise.tech/v1'
 TRANSFERWISE_API_TOKEN = '52a1a8f0-f962-478e-83a4-000000000000'
 TRANSFERWISE_PROFILE_ID = '00000000'
 
+
 @mock.patch("simard.quote.TRANSFERWISE_API_ENDPOINT", TRANSFERWISE_API_ENDPOINT)
 @mock.patch("simard.quote.TRANSFERWISE_API_TOKEN", TRANSFERWISE_API_TOKEN)
 @mock.patch("simard.quote.TRANSFERWISE_PROFILE_ID", TRANSFERWISE_PROFILE_ID)
@@ -110,7 +113,7 @@ class TestBalanceManager(unittest.TestCase):
         self.assertEqual(g1['amount'], Decimal128('2500.00'))
         self.assertEqual(g1['currency'], self.currency)
         self.assertEqual(g1['agent'], self.ota_agent)
-        self.assertEqual(g1['claimed'], False)
+        self.assertEqual(g1['status'], 'active')
 
         # The OTA Verifies the guarantee
         g2 = BalanceManager.get_guarantee(
@@ -489,7 +492,7 @@ class TestBalanceManager(unittest.TestCase):
             guarantee_id=g1_uuid
         )
         g2 = db._database.guarantees.find_one({'uuid': g1_uuid})
-        self.assertIsNone(g2)
+        self.assertEqual(g2['status'], 'cancelled')
 
     def test_cancel_guarantee_before_expiration(self):
         """
@@ -530,7 +533,7 @@ class TestBalanceManager(unittest.TestCase):
             guarantee_id=g1_uuid
         )
         g2 = db._database.guarantees.find_one({'uuid': g1_uuid})
-        self.assertIsNone(g2)
+        self.assertEqual(g2['status'], 'cancelled')
 
     def test_cancel_guarantee_not_mine(self):
         """
@@ -664,7 +667,7 @@ class TestBalanceManager(unittest.TestCase):
                     )
 
         guarantees = db.guarantees.find_one({})
-        self.assertEqual(guarantees, None)
+        self.assertEqual(guarantees['status'], 'cancelled')
         self.assertEqual(ctx.exception.code, 500)
 
     def test_claim_guarantee_with_card(self):
@@ -735,7 +738,7 @@ class TestBalanceManager(unittest.TestCase):
         self.assertEqual(g1['amount'], Decimal128('100.00'))
         self.assertEqual(g1['currency'], self.currency)
         self.assertEqual(g1['agent'], self.glider_b2b_agent)
-        self.assertEqual(g1['expiration'], '2218-05-29T12:16:14.123000+00:00')
+        self.assertEqual(g1['expiration'], datetime(2218, 5, 29, 12, 16, 14, 123000))
 
         # FIXME: Cards should be stored in DB before
         # Check the values used for the card creation
@@ -783,7 +786,7 @@ class TestBalanceManager(unittest.TestCase):
         )
 
         g = db._database.guarantees.find_one({'uuid': card.guarantee_id})
-        self.assertIsNone(g)
+        self.assertEqual(g['status'], 'cancelled')
 
     @mock.patch("simard.settlement.GLIDER_OTA_ORGID", GLIDER_OTA_ORGID)
     @mock.patch("simard.settlement.USDC_CONTRACT", USDC_CONTRACT)
@@ -815,6 +818,7 @@ class TestBalanceManager(unittest.TestCase):
         self.assertEqual(s1['currency'], 'USD')
         self.assertEqual(s1['agent'], self.ota_agent)
 
+    @mock.patch('simard.balance.Balance.ledger_snapshot', aggregated_snapshot)
     def test_swap_basics(self):
         """
         Test for making a quote swap
@@ -912,6 +916,7 @@ class TestBalanceManager(unittest.TestCase):
             self.assertEqual(BalanceManager.get_balance(self.ota, 'USD').total, Decimal('456.68'))
             self.assertTrue(Quote.from_storage(q1.uuid).is_used)
 
+    @mock.patch('simard.balance.Balance.ledger_snapshot', aggregated_snapshot)
     def test_swap_multiple(self):
         """
         Test for making multiple quote swaps in batch
@@ -1,9 +1,10 @@
 import unittest
 from unittest import mock
 import json
-from redis import Redis
+import time
+from redis import Redis, SSLConnection, ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
 import simard.settings
-from simard.cache import Cache, CacheException
+from simard.cache import Cache, CacheException, LocalCache, RedisBackend, MemoryBackend, Serializer, JsonCodec, MsgpackCodec, msgpack
 
 
 class TestCache(unittest.TestCase):
@@ -29,79 +30,84 @@ class TestCache(unittest.TestCase):
         Test that just retrieving an instance does not open the connection
         """
         cache = Cache()
-        self.assertIsNone(cache._redis)
+        self.assertIsNone(cache._backend)
 
     def test_get_internal_instance_with_generic_password(self):
-        # Mock the Redis __init__ method
+        # Mock the ConnectionPool __init__ method
         cache = Cache()
-        mock_redis = mock.Mock()
-        mock_redis.mock_init.return_value = None
-        with mock.patch.object(Redis, "__init__", mock_redis.mock_init):
+        with mock.patch('redis.ConnectionPool') as mock_pool:
             cache._REDIS_URL = self.redis_url
-            cache._get_redis()
+            cache._get_backend()
 
         # Check the initiatialization
-        mock_redis.mock_init.assert_called_once_with(
+        mock_pool.assert_called_once_with(
             host=self.host,
             port=self.port,
             password=self.password,
-            ssl=False
+            socket_timeout=cache._SOCKET_TIMEOUT,
+            socket_connect_timeout=cache._CONNECT_TIMEOUT,
+            max_connections=cache._MAX_CONNECTIONS
         )
-        self.assertIsNotNone(cache._redis)
+        self.assertIs(cache._backend.client.connection_pool, mock_pool.return_value)
 
     def test_get_internal_instance_no_password(self):
-        # Mock the Redis __init__ method
+        # Mock the ConnectionPool __init__ method
         cache = Cache()
-        mock_redis = mock.Mock()
-        mock_redis.mock_init.return_value = None
-        with mock.patch.object(Redis, "__init__", mock_redis.mock_init):
+        with mock.patch('redis.ConnectionPool') as mock_pool:
             cache._REDIS_URL = "redis://%s:%s" % (self.host, self.port)
-            cache._get_redis()
+            cache._get_backend()
 
         # Check the initiatialization
-        mock_redis.mock_init.assert_called_once_with(
+        mock_pool.assert_called_once_with(
             host=self.host,
             port=self.port,
-            ssl=False
+            socket_timeout=cache._SOCKET_TIMEOUT,
+            socket_connect_timeout=cache._CONNECT_TIMEOUT,
+            max_connections=cache._MAX_CONNECTIONS
         )
-        self.assertIsNotNone(cache._redis)
+        self.assertIsNotNone(cache._backend)
 
     def test_get_internal_instance_with_acl_enabled(self):
-        # Mock the Redis excute_command method
+        # Mock the ConnectionPool __init__ method
         cache = Cache()
-        mock_redis = mock.Mock()
-        mock_redis.mock_init.return_value = None
-        with mock.patch.object(Redis, "execute_command", mock_redis.mock_init):
+        with mock.patch('redis.ConnectionPool') as mock_pool:
             cache._REDIS_URL = "redis://%s:%s@%s:%s" % (
                     self.acl_username,
                     self.acl_password,
                     self.host,
                     self.port
                 )
-            cache._get_redis()
+            cache._get_backend()
 
-        # Check the initiatialization
-        mock_redis.mock_init.assert_called_once_with(
-            f"AUTH {self.acl_username} {self.acl_password}"
+        # Check the initiatialization, each connection authenticates
+        mock_pool.assert_called_once_with(
+            host=self.host,
+            port=self.port,
+            username=self.acl_username,
+            password=self.acl_password,
+            socket_timeout=cache._SOCKET_TIMEOUT,
+            socket_connect_timeout=cache._CONNECT_TIMEOUT,
+            max_connections=cache._MAX_CONNECTIONS
         )
-        self.assertIsNotNone(cache._redis)
+        self.assertIsNotNone(cache._backend)
 
     def test_get_internal_instance_with_ssl_enabled(self):
-        # Mock the Redis __init__ method
+        # Mock the ConnectionPool __init__ method
         cache = Cache()
-        mock_redis = mock.Mock()
-        mock_redis.mock_init.return_value = None
-        with mock.patch.object(Redis, "__init__", mock_redis.mock_init):
+        with mock.patch('redis.ConnectionPool') as mock_pool:
             cache._REDIS_URL = "rediss://%s:%s" % (self.host, self.port)
-            cache._get_redis()
+            cache._get_backend()
 
         # Check the initiatialization
-        mock_redis.mock_init.assert_called_once_with(
+        mock_pool.assert_called_once_with(
             host=self.host,
             port=self.port,
-            ssl=True
+            connection_class=SSLConnection,
+            socket_timeout=cache._SOCKET_TIMEOUT,
+            socket_connect_timeout=cache._CONNECT_TIMEOUT,
+            max_connections=cache._MAX_CONNECTIONS
         )
-        self.assertIsNotNone(cache._redis)
+        self.assertIsNotNone(cache._backend)
 
     def test_store_and_retrieve(self):
         """
@@ -113,27 +119,291 @@ class TestCache(unittest.TestCase):
         cache = Cache()
         cache._REDIS_URL = self.redis_url
 
-        mock_redis = mock.Mock()
-        mock_redis.mock_init.return_value = None
-        with mock.patch.object(Redis, "__init__", mock_redis.mock_init):
+        with mock.patch('redis.ConnectionPool') as mock_pool:
 
             # Store an object
             with mock.patch('redis.Redis.set') as mock_set:
                 mock_set.return_value = None
                 cache.store('my_key', dummy_object)
-                mock_set.assert_called_once_with('my_key', json.dumps(dummy_object), ex=cache._DEFAULT_RETENTION_TIME)
-
-            # Check that the connection was established
-            mock_redis.mock_init.assert_called_once_with(
-                host=self.host,
-                port=self.port,
-                password=self.password,
-                ssl=False
-            )
-            self.assertIsNotNone(cache._redis)
-
-            # Retrieve an object
-            with mock.patch('redis.Redis.get') as mock_get:
-                mock_get.return_value = json.dumps(dummy_object)
-                cache.retrieve('my_key')
-                mock_get.assert_called_once_with('my_key')
+                mock_set.assert_called_once_with('my_key', cache._serializer.dumps(dummy_object), ex=cache._DEFAULT_RETENTION_TIME)
+
+            # Check that the connection pool was created
+            mock_pool.assert_called_once()
+            self.assertIsNotNone(cache._backend)
+
+            # Retrieve an object from the local tier
+            with mock.patch('redis.Redis.pipeline') as mock_pipeline:
+                self.assertEqual(cache.retrieve('my_key'), dummy_object)
+                mock_pipeline.assert_not_called()
+
+            # Retrieve an object from Redis
+            cache._local.clear()
+            with mock.patch('redis.Redis.pipeline') as mock_pipeline:
+                mock_pipeline.return_value.execute.return_value = [json.dumps(dummy_object), 3000]
+                self.assertEqual(cache.retrieve('my_key'), dummy_object)
+                mock_pipeline.return_value.get.assert_called_once_with('my_key')
+                mock_pipeline.return_value.pttl.assert_called_once_with('my_key')
+
+            # The object is kept locally for its remaining time to live
+            now = time.monotonic()
+            with mock.patch('simard.cache.time.monotonic') as mock_time:
+                mock_time.return_value = now + 2
+                self.assertEqual(cache._local.get('my_key'), dummy_object)
+                mock_time.return_value += 2
+                self.assertIsNone(cache._local.get('my_key'))
+
+    @mock.patch('redis.Redis.set')
+    def test_store_and_retrieve_local(self, mock_set):
+        """
+        Test that values of another local tier do not evict the shared one
+        """
+        cache = Cache()
+        cache._REDIS_URL = self.redis_url
+        cache._local = LocalCache(max_entries=1)
+        local = LocalCache(max_entries=1)
+
+        with mock.patch('redis.ConnectionPool'):
+            cache.store('shared_key', {'dummy': 0})
+            cache.store('other_key', {'dummy': 1}, local=local)
+
+        self.assertEqual(cache._local.get('shared_key'), {'dummy': 0})
+        self.assertIsNone(cache._local.get('other_key'))
+        with mock.patch('redis.Redis.pipeline') as mock_pipeline:
+            self.assertEqual(cache.retrieve('other_key', local=local), {'dummy': 1})
+            mock_pipeline.assert_not_called()
+
+    def test_retrieve_missing(self):
+        """
+        Test that a missing object is not kept locally
+        """
+        cache = Cache()
+        cache._REDIS_URL = self.redis_url
+        with mock.patch('redis.Redis.pipeline') as mock_pipeline:
+            mock_pipeline.return_value.execute.return_value = [None, -2]
+            self.assertIsNone(cache.retrieve('my_key'))
+            self.assertIsNone(cache.retrieve('my_key'))
+            self.assertEqual(mock_pipeline.call_count, 2)
+        self.assertEqual(cache.stats(), {'entries': 0, 'hits': 0, 'misses': 2})
+
+    def test_acquire_and_release_lock(self):
+        cache = Cache()
+        cache._REDIS_URL = self.redis_url
+
+        # Acquire a free lock
+        with mock.patch('redis.Redis.set') as mock_set:
+            mock_set.return_value = True
+            token = cache.acquire_lock('my_lock', 10)
+            self.assertIsNotNone(token)
+            mock_set.assert_called_once_with('my_lock', token, nx=True, ex=10)
+
+        # A held lock is not acquired
+        with mock.patch('redis.Redis.set') as mock_set:
+            mock_set.return_value = None
+            self.assertIsNone(cache.acquire_lock('my_lock', 10))
+
+        # The lock is released with its token
+        with mock.patch('redis.Redis.eval') as mock_eval:
+            cache.release_lock('my_lock', token)
+            mock_eval.assert_called_once_with(RedisBackend._DELETE_IF_EQUAL_SCRIPT, 1, 'my_lock', token)
+
+    def test_acquire_lock_without_redis(self):
+        cache = Cache()
+        cache._REDIS_URL = self.redis_url
+        with mock.patch('redis.Redis.set') as mock_set:
+            mock_set.side_effect = RedisConnectionError()
+            self.assertIsNotNone(cache.acquire_lock('my_lock', 10))
+
+    def test_retrieve_timeout(self):
+        """
+        Test that a slow Redis is bypassed
+        """
+        cache = Cache()
+        cache._REDIS_URL = self.redis_url
+        with mock.patch('redis.Redis.pipeline') as mock_pipeline:
+            mock_pipeline.return_value.execute.side_effect = RedisTimeoutError()
+            self.assertIsNone(cache.retrieve('my_key'))
+        with mock.patch('redis.Redis.set') as mock_set:
+            mock_set.side_effect = RedisTimeoutError()
+            self.assertIsNone(cache.store('my_key', {'dummy': 0}))
+
+    def test_retrieve_many(self):
+        cache = Cache()
+        cache._REDIS_URL = self.redis_url
+        objects = {'key_1': {'dummy': 1}, 'key_2': {'dummy': 2}}
+        cache._local.set('key_1', objects['key_1'], 30)
+
+        # Retrieve the local ones and the missing ones in a single round-trip
+        with mock.patch('redis.Redis.pipeline') as mock_pipeline:
+            mock_pipeline.return_value.execute.return_value = [[cache._serializer.dumps(objects['key_2']), None], 30000, -2]
+            values = cache.retrieve_many(['key_1', 'key_2', 'key_3'])
+            self.assertEqual(values, [objects['key_1'], objects['key_2'], None])
+            mock_pipeline.return_value.mget.assert_called_once_with(['key_2', 'key_3'])
+            mock_pipeline.return_value.execute.assert_called_once()
+
+        # All the objects are now local
+        with mock.patch('redis.Redis.pipeline') as mock_pipeline:
+            self.assertEqual(cache.retrieve_many(['key_1', 'key_2']), [objects['key_1'], objects['key_2']])
+            mock_pipeline.assert_not_called()
+
+    def test_retrieve_many_without_redis(self):
+        cache = Cache()
+        cache._REDIS_URL = self.redis_url
+        with mock.patch('redis.Redis.pipeline') as mock_pipeline:
+            mock_pipeline.return_value.execute.side_effect = RedisConnectionError()
+            self.assertEqual(cache.retrieve_many(['key_1', 'key_2']), [None, None])
+
+
+class TestLocalCache(unittest.TestCase):
+    def test_get_and_set(self):
+        """
+        Test that values are retrieved until they expire
+        """
+        local = LocalCache(max_entries=10)
+        local.set('a', {'value': 1}, 60)
+        self.assertEqual(local.get('a'), {'value': 1})
+        self.assertIsNone(local.get('b'))
+
+        now = time.monotonic()
+        with mock.patch('simard.cache.time.monotonic') as mock_time:
+            mock_time.return_value = now + 61
+            self.assertIsNone(local.get('a'))
+
+        self.assertEqual(local.stats(), {'entries': 0, 'hits': 1, 'misses': 2})
+
+    def test_eviction(self):
+        """
+        Test that the least recently used values are evicted
+        """
+        local = LocalCache(max_entries=2)
+        local.set('a', 1, 60)
+        local.set('b', 2, 60)
+        local.get('a')
+        local.set('c', 3, 60)
+
+        self.assertEqual(local.get('a'), 1)
+        self.assertIsNone(local.get('b'))
+        self.assertEqual(local.get('c'), 3)
+
+        local.delete('c')
+        self.assertIsNone(local.get('c'))
+
+    def test_max_ttl(self):
+        """
+        Test that values are kept at most for the maximum time to live
+        """
+        local = LocalCache(max_entries=10, max_ttl=5)
+        local.set('a', 1, 60)
+        local.set('b', 2, 3)
+
+        now = time.monotonic()
+        with mock.patch('simard.cache.time.monotonic') as mock_time:
+            mock_time.return_value = now + 4
+            self.assertEqual(local.get('a'), 1)
+            self.assertIsNone(local.get('b'))
+            mock_time.return_value = now + 6
+            self.assertIsNone(local.get('a'))
+
+    def test_disabled(self):
+        """
+        Test that nothing is kept without entries allowed
+        """
+        local = LocalCache(max_entries=0)
+        local.set('a', 1, 60)
+        self.assertIsNone(local.get('a'))
+
+
+class TestMemoryBackend(unittest.TestCase):
+    def setUp(self):
+        self.cache = Cache()
+        self.cache._REDIS_URL = 'memory://'
+
+    def test_backend_selection(self):
+        self.assertIsInstance(self.cache._get_backend(), MemoryBackend)
+
+    def test_store_and_retrieve(self):
+        dummy_object = {'dummy': 0}
+        self.cache.store('my_key', dummy_object, expiry=30)
+        self.cache.store('key_1', {'dummy': 1}, expiry=30)
+
+        # Retrieve the objects from the backend
+        self.cache._local.clear()
+        self.assertEqual(self.cache.retrieve('my_key'), dummy_object)
+        self.assertEqual(
+            self.cache.retrieve_many(['my_key', 'key_1', 'key_2']),
+            [dummy_object, {'dummy': 1}, None]
+        )
+
+        # The objects are kept in the backend beyond the time to live of the local tier
+        self.cache._local.clear()
+        now = time.monotonic()
+        with mock.patch('simard.cache.time.monotonic') as mock_time:
+            mock_time.return_value = now + 20
+            self.assertEqual(self.cache.retrieve('my_key'), dummy_object)
+
+        # The objects expire from the backend
+        self.cache._local.clear()
+        with mock.patch('simard.cache.time.monotonic') as mock_time:
+            mock_time.return_value = now + 31
+            self.assertIsNone(self.cache.retrieve('my_key'))
+
+    def test_delete(self):
+        self.cache.store('my_key', {'dummy': 0}, expiry=30)
+        self.cache.delete('my_key')
+        self.assertIsNone(self.cache.retrieve('my_key'))
+
+    def test_lock(self):
+        token = self.cache.acquire_lock('my_lock', 10)
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.cache.acquire_lock('my_lock', 10))
+
+        # Only the holder releases the lock
+        self.cache.release_lock('my_lock', 'other')
+        self.assertIsNone(self.cache.acquire_lock('my_lock', 10))
+        self.cache.release_lock('my_lock', token)
+        self.assertIsNotNone(self.cache.acquire_lock('my_lock', 10))
+
+
+class TestSerializer(unittest.TestCase):
+    def setUp(self):
+        self.value = {'dummy': 0, 'list': ['a', 'b'], 'nested': {'flag': True}}
+
+    def test_json(self):
+        serializer = Serializer(codec='json', compression_threshold=0)
+        serialized = serializer.dumps(self.value)
+        self.assertEqual(serialized[0], JsonCodec.VERSION)
+        self.assertEqual(serializer.loads(serialized), self.value)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        serializer = Serializer(codec='msgpack', compression_threshold=0)
+        serialized = serializer.dumps(self.value)
+        self.assertEqual(serialized[0], MsgpackCodec.VERSION)
+        self.assertEqual(serializer.loads(serialized), self.value)
+
+    def test_msgpack_missing(self):
+        with mock.patch('simard.cache.msgpack', None):
+            serializer = Serializer(codec='msgpack')
+            self.assertEqual(serializer.dumps(self.value)[0], JsonCodec.VERSION)
+
+            # Values written with msgpack are ignored
+            self.assertIsNone(serializer.loads(bytes([MsgpackCodec.VERSION]) + b'\x80'))
+
+    def test_compression(self):
+        serializer = Serializer(codec='json', compression_threshold=100)
+        large_value = {'text': 'x' * 1000}
+
+        # Only the large values are compressed
+        self.assertEqual(serializer.dumps(self.value)[0], JsonCodec.VERSION)
+        serialized = serializer.dumps(large_value)
+        self.assertEqual(serialized[0], JsonCodec.VERSION | 0x80)
+        self.assertLess(len(serialized), 100)
+        self.assertEqual(serializer.loads(serialized), large_value)
+
+    def test_legacy_json(self):
+        serializer = Serializer()
+        self.assertEqual(serializer.loads(json.dumps(self.value)), self.value)
+        self.assertEqual(serializer.loads(json.dumps(self.value).encode('utf-8')), self.value)
+
+    def test_unsupported_codec(self):
+        with self.assertRaises(CacheException):
+            Serializer(codec='pickle')
@@ -0,0 +1,49 @@
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+import mongomock
+from bson.objectid import ObjectId
+from simard.db import db
+from simard.cache_warmer import CacheWarmer
+from simard.did_resolver import DidDocumentException
+
+
+class TestCacheWarmer(unittest.TestCase):
+    def setUp(self):
+        db._database = mongomock.MongoClient().unittest
+        self.orgids = ['0x%s' % (str(i) * 64) for i in range(5)]
+
+    def test_collect_orgids(self):
+        db.profiles.insert_one({'orgid': self.orgids[0]})
+        db.accounts.insert_many([{'orgid': self.orgids[0]}, {'orgid': self.orgids[1]}])
+        db.settlements.insert_one({'beneficiary': self.orgids[2], 'initiator': 'did:orgid:ota'})
+
+        # Old settlements are skipped
+        old_id = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(days=60))
+        db.settlements.insert_one({'_id': old_id, 'beneficiary': self.orgids[3], 'initiator': self.orgids[4]})
+
+        self.assertEqual(CacheWarmer.collect_orgids(days=30), self.orgids[:3])
+        self.assertEqual(CacheWarmer.collect_orgids(days=90), self.orgids)
+
+    @mock.patch('simard.did_resolver.DidResolver.coalesced_resolve')
+    @mock.patch('simard.cache.Cache.retrieve_many')
+    def test_warm_up(self, mock_retrieve, mock_resolve):
+        # The first organization is cached, the last one fails
+        mock_retrieve.return_value = [{'result': {}, 'resolvedAt': 0}, None, None]
+        mock_resolve.side_effect = [{}, DidDocumentException('Organization does not exist', 404)]
+
+        with self.assertLogs(level='WARNING'):
+            result = CacheWarmer.warm_up(self.orgids[:3], workers=1)
+        self.assertEqual(result, (1, 1, 1))
+
+        # Check only the missing organizations were resolved
+        mock_retrieve.assert_called_once_with(['didResultSimardV2_did:orgid:%s' % orgid for orgid in self.orgids[:3]])
+        mock_resolve.assert_has_calls([
+            mock.call('did:orgid:%s' % self.orgids[1]),
+            mock.call('did:orgid:%s' % self.orgids[2]),
+        ])
+
+    @mock.patch('simard.cache.Cache.retrieve_many')
+    def test_warm_up_nothing(self, mock_retrieve):
+        self.assertEqual(CacheWarmer.warm_up([]), (0, 0, 0))
+        self.assertFalse(mock_retrieve.called)
@@ -0,0 +1,107 @@
+import unittest
+from unittest import mock
+from decimal import Decimal
+from simard import app
+from simard.balance import BalanceException
+from simard.orgid_watcher import OrgIdWatcherException
+
+
+class TestCommands(unittest.TestCase):
+    def setUp(self):
+        self.runner = app.test_cli_runner()
+
+    def test_balances_rebuild_dry_run(self):
+        with mock.patch('simard.balance.Balance.rebuild') as br:
+            br.return_value = [('did:orgid:ota', 'EUR', 'credit', Decimal('10.00'))]
+            result = self.runner.invoke(args=['balances', 'rebuild', '--dry-run'])
+
+        br.assert_called_once_with(dry_run=True)
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output, 'did:orgid:ota EUR credit: 10.00\n1 drift(s) found\n')
+
+    def test_balances_rebuild(self):
+        with mock.patch('simard.balance.Balance.rebuild') as br:
+            br.return_value = []
+            result = self.runner.invoke(args=['balances', 'rebuild'])
+
+        br.assert_called_once_with(dry_run=False)
+        self.assertEqual(result.output, '0 drift(s) corrected\n')
+
+    def test_balances_rebuild_concurrent(self):
+        with mock.patch('simard.balance.Balance.rebuild') as br:
+            br.side_effect = BalanceException('1 balance(s) changed during the rebuild', 409)
+            result = self.runner.invoke(args=['balances', 'rebuild'])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('1 balance(s) changed during the rebuild', result.output)
+
+    def test_indexes_ensure_conflict(self):
+        with mock.patch('simard.index_manager.IndexManager.ensure_indexes') as ei:
+            ei.return_value = [('guarantees', 'uuid')]
+            result = self.runner.invoke(args=['indexes', 'ensure'])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('guarantees.uuid: ok\n', result.output)
+        self.assertIn('index(es) could not be created', result.output)
+
+    def test_indexes_verify(self):
+        with mock.patch('simard.index_manager.IndexManager.verify_indexes') as vi:
+            vi.return_value = [('guarantees', 'uuid', 'missing')]
+            result = self.runner.invoke(args=['indexes', 'verify'])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('guarantees.uuid: missing\n', result.output)
+
+    def test_indexes_explain(self):
+        with mock.patch('simard.index_manager.IndexManager.explain_queries') as eq:
+            eq.return_value = [('quotes', {'uuid': '1'}, ['FETCH', 'IXSCAN(uuid)'])]
+            result = self.runner.invoke(args=['indexes', 'explain'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output, "quotes {'uuid': '1'}: FETCH > IXSCAN(uuid)\n")
+
+    def test_cache_warm(self):
+        with mock.patch('simard.cache_warmer.CacheWarmer.collect_orgids') as co, \
+                mock.patch('simard.cache_warmer.CacheWarmer.warm_up') as wu:
+            co.return_value = ['0x00']
+            wu.return_value = (3, 2, 1)
+            result = self.runner.invoke(args=['cache', 'warm', '--days', '7', '--workers', '2'])
+
+        co.assert_called_once_with(days=7)
+        wu.assert_called_once_with(['0x00'], workers=2)
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(
+            result.output,
+            '3 organization(s) already cached\n2 organization(s) resolved\n1 organization(s) failed\n'
+        )
+
+    @mock.patch('simard.orgid_watcher.OrgIdWatcher.verify_events')
+    def test_cache_invalidate(self, ve):
+        with mock.patch('simard.orgid_watcher.OrgIdWatcher.read_logs') as rl:
+            rl.return_value = {'0x01'}
+            result = self.runner.invoke(args=['cache', 'invalidate', '--from-block', '10', '--to-block', '20'])
+
+        rl.assert_called_once_with(10, 20)
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(result.output, '0x01\n1 organization(s) invalidated\n')
+
+    @mock.patch('simard.orgid_watcher.OrgIdWatcher.verify_events')
+    def test_cache_invalidate_unverified(self, ve):
+        ve.side_effect = OrgIdWatcherException('The ORG.ID contract does not emit the events: 0x00', 500)
+        with mock.patch('simard.orgid_watcher.OrgIdWatcher.read_logs') as rl:
+            result = self.runner.invoke(args=['cache', 'invalidate', '--from-block', '10', '--to-block', '20'])
+
+        self.assertFalse(rl.called)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('does not emit the events', result.output)
+
+    def test_crypto_benchmark(self):
+        with mock.patch('simard.secp256k1.Secp256k1.benchmark') as bm:
+            bm.return_value = [('ecdsa', 500.4, 3000.0), ('coincurve', 12000.0, 5000.0)]
+            result = self.runner.invoke(args=['crypto', 'benchmark', '--iterations', '10'])
+
+        bm.assert_called_once_with(10)
+        self.assertEqual(result.output, (
+            'ecdsa: 500 verification(s)/s, 3000 recovery(ies)/s\n'
+            'coincurve: 12000 verification(s)/s, 5000 recovery(ies)/s\n'
+        ))
@@ -1,9 +1,14 @@
 import unittest
 from unittest import mock
-from simard.did_resolver import DidResolver, DidResolverException
+from simard.did_resolver import DidResolver, DidResolverException, DidDocumentException
 from simard.w3 import w3
+from simard.cache import cache
 import binascii
 import json
+import time
+import threading
+import requests
+from concurrent.futures import wait
 
 
 class TestDidResolver(unittest.TestCase):
@@ -29,6 +34,9 @@ class TestDidResolver(unittest.TestCase):
         self.isActive = True
         self.isDirectorshipAccepted = False
 
+        # Start with an empty local cache
+        cache._local.clear()
+
     def test_get_onchain_organization(self):
         """
         Test that we can get the on-chain data
@@ -78,7 +86,7 @@ class TestDidResolver(unittest.TestCase):
             )
 
             self.assertEqual(doc, "<dummy>")
-            g.assert_called_once_with(self.orgJsonUri)
+            g.assert_called_once_with(self.orgJsonUri, timeout=DidResolver._FETCH_TIMEOUT)
 
     def test_get_offchain_document_no_http(self):
         """
@@ -118,6 +126,102 @@ class TestDidResolver(unittest.TestCase):
                 'Organization hash does not match'
             )
 
+    def mock_hosts(self, hosts):
+        """
+        Simulate the document hosts as url: (delay, document)
+        """
+        def get(url, timeout=None):
+            delay, text = hosts[url]
+            time.sleep(delay)
+            response = mock.Mock()
+            response.text = text
+            return response
+        return get
+
+    def test_get_offchain_document_primary(self):
+        doc_hash = bytes(w3.sha3('<dummy>'))
+        with mock.patch('requests.get') as g:
+            g.side_effect = self.mock_hosts({
+                'https://primary': (0, '<dummy>'),
+                'https://backup': (0, '<dummy>'),
+            })
+            doc = DidResolver.get_offchain_document('https://primary', doc_hash, ['https://backup', ''])
+
+        # The backup is not requested when the primary answers in time
+        self.assertEqual(doc, '<dummy>')
+        g.assert_called_once_with('https://primary', timeout=DidResolver._FETCH_TIMEOUT)
+
+    def test_get_offchain_document_slow_primary(self):
+        doc_hash = bytes(w3.sha3('<dummy>'))
+        with mock.patch('requests.get') as g, mock.patch.object(DidResolver, '_HEDGE_DELAY', 0.01):
+            g.side_effect = self.mock_hosts({
+                'https://primary': (0.5, '<dummy>'),
+                'https://backup1': (0, '<dummy>'),
+                'https://backup2': (0.5, '<dummy>'),
+            })
+            start = time.monotonic()
+            doc = DidResolver.get_offchain_document('https://primary', doc_hash, ['https://backup1', 'https://backup2'])
+
+        # The first backup answers before the primary
+        self.assertEqual(doc, '<dummy>')
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(g.call_count, 3)
+
+    def test_get_offchain_document_primary_mismatch(self):
+        doc_hash = bytes(w3.sha3('<dummy>'))
+        with mock.patch('requests.get') as g:
+            g.side_effect = self.mock_hosts({
+                'https://primary': (0, '<outdated>'),
+                'https://backup': (0, '<dummy>'),
+            })
+            doc = DidResolver.get_offchain_document('https://primary', doc_hash, ['https://backup'])
+
+        # The backup matching the hash is accepted
+        self.assertEqual(doc, '<dummy>')
+
+    def test_get_offchain_document_all_failed(self):
+        doc_hash = bytes(w3.sha3('<dummy>'))
+        with mock.patch('requests.get') as g:
+            g.side_effect = self.mock_hosts({
+                'https://primary': (0, '<outdated>'),
+                'https://backup': (0, '<other>'),
+            })
+            with self.assertRaises(DidDocumentException) as ctx:
+                DidResolver.get_offchain_document('https://primary', doc_hash, ['https://backup'])
+
+        # The error of the primary is reported
+        self.assertEqual(ctx.exception.code, 403)
+
+    def test_get_offchain_document_primary_after_deadline(self):
+        doc_hash = bytes(w3.sha3('<dummy>'))
+
+        # The deadline expires just before the primary answers
+        def late_wait(futures, timeout=None, return_when=None):
+            if return_when is None:
+                return wait(futures, timeout=timeout)
+            wait(futures)
+            return set(), set(futures)
+
+        with mock.patch('requests.get') as g, mock.patch('simard.did_resolver.wait', side_effect=late_wait), \
+                mock.patch.object(DidResolver, '_HEDGE_DELAY', 0.01):
+            g.side_effect = self.mock_hosts({
+                'https://primary': (0.1, '<dummy>'),
+                'https://backup': (0, '<other>'),
+            })
+            doc = DidResolver.get_offchain_document('https://primary', doc_hash, ['https://backup'])
+
+        # The backup failed, the document of the primary is used
+        self.assertEqual(doc, '<dummy>')
+
+    def test_get_offchain_document_unreachable(self):
+        with mock.patch('requests.get') as g:
+            g.side_effect = requests.ConnectionError('Connection refused')
+            with self.assertRaises(DidResolverException) as ctx:
+                DidResolver.get_offchain_document('https://primary', b'\x00')
+
+        self.assertEqual(ctx.exception.code, 500)
+        self.assertEqual(ctx.exception.description, 'Error Retrieving Offchain Document')
+
     def test_validate_offline_document(self):
         with open('./test/simard.json', 'r', encoding="utf-8") as fs:
             doc = fs.read()
@@ -157,7 +261,7 @@ class TestDidResolver(unittest.TestCase):
         res = DidResolver.full_resolve(self.did)
 
         # Verify the mocks were called
-        mock_get.assert_called_once_with(self.orgJsonUri)
+        mock_get.assert_called_once_with(self.orgJsonUri, timeout=DidResolver._FETCH_TIMEOUT)
         self.assertTrue(mock_cc.called)
 
         # Validate the results
@@ -175,35 +279,249 @@ class TestDidResolver(unittest.TestCase):
         self.assertEqual(res['organization'], expected)
 
     @mock.patch('redis.Redis.set')
-    @mock.patch('redis.Redis.get')
-    def test_resolve_cache_hit(self, mock_get, mock_set):
+    @mock.patch('redis.Redis.pipeline')
+    def test_resolve_cache_hit(self, mock_pipeline, mock_set):
         # Define the mock calls
         doc = {'dummy': 0}
-        mock_get.return_value = json.dumps(doc)
+        entry = {'result': doc, 'resolvedAt': time.time()}
+        mock_pipeline.return_value.execute.return_value = [json.dumps(entry), 60000]
 
         # Check the values
         result = DidResolver.resolve(self.did)
         self.assertEqual(result, doc)
 
         # Check the mocks
-        mock_get.assert_called_once_with("didResultSimard_%s" % self.did)
+        mock_pipeline.return_value.get.assert_called_once_with("didResultSimardV2_%s" % self.did)
+        self.assertFalse(mock_set.called)
+
+        # The next resolution is served by the local tier
+        self.assertEqual(DidResolver.resolve(self.did), doc)
+        self.assertEqual(mock_pipeline.call_count, 1)
+
+    @mock.patch('redis.Redis.set')
+    @mock.patch('redis.Redis.pipeline')
+    def test_resolve_normalized(self, mock_pipeline, mock_set):
+        # Define the mock calls
+        doc = {'dummy': 0}
+        entry = {'result': doc, 'resolvedAt': time.time()}
+        mock_pipeline.return_value.execute.return_value = [json.dumps(entry), 60000]
+
+        # The bare ORG.ID shares the cache entry of the DID
+        self.assertEqual(DidResolver.resolve("0x%s" % self.orgId.upper()), doc)
+        mock_pipeline.return_value.get.assert_called_once_with("didResultSimardV2_%s" % self.did.lower())
+        self.assertEqual(DidResolver.resolve(self.did), doc)
+        self.assertEqual(mock_pipeline.call_count, 1)
+
+    @mock.patch('simard.cache.Cache.delete')
+    def test_invalidate(self, mock_delete):
+        DidResolver.invalidate("0x%s" % self.orgId)
+        mock_delete.assert_called_once_with("didResultSimardV2_%s" % self.did.lower())
+
+    @mock.patch('simard.did_resolver.DidResolver.schedule_refresh')
+    @mock.patch('redis.Redis.set')
+    @mock.patch('redis.Redis.pipeline')
+    def test_resolve_cache_stale(self, mock_pipeline, mock_set, mock_refresh):
+        # Define the mock calls
+        doc = {'dummy': 0}
+        entry = {'result': doc, 'resolvedAt': time.time() - DidResolver._SOFT_TTL - 1}
+        mock_pipeline.return_value.execute.return_value = [json.dumps(entry), 60000]
+
+        # The stale result is served and refreshed in the background
+        result = DidResolver.resolve(self.did)
+        self.assertEqual(result, doc)
+        mock_refresh.assert_called_once_with(self.did)
         self.assertFalse(mock_set.called)
 
+    @mock.patch('simard.cache.Cache.release_lock')
+    @mock.patch('simard.cache.Cache.acquire_lock')
     @mock.patch('simard.did_resolver.DidResolver.full_resolve')
     @mock.patch('redis.Redis.set')
-    @mock.patch('redis.Redis.get')
-    def test_resolve_cache_miss(self, mock_get, mock_set, mock_rslv):
+    def test_refresh(self, mock_set, mock_rslv, mock_acquire, mock_release):
+        # Define the mock calls
+        doc = {'dummy': 1}
+        mock_set.return_value = True
+        mock_rslv.return_value = doc
+        mock_acquire.return_value = 'token'
+
+        # Refresh synchronously
+        DidResolver._refreshing.add(self.did)
+        with mock.patch('time.time', return_value=1000.0):
+            DidResolver.refresh(self.did)
+
+        # Check the cache is updated with the fresh result
+        mock_set.assert_called_once_with(
+            "didResultSimardV2_%s" % self.did,
+            cache._serializer.dumps({'result': doc, 'resolvedAt': 1000.0}),
+            ex=DidResolver._HARD_TTL
+        )
+        self.assertNotIn(self.did, DidResolver._refreshing)
+        mock_release.assert_called_once_with("didLockSimard_%s" % self.did, 'token')
+
+    @mock.patch('simard.cache.Cache.acquire_lock')
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    def test_refresh_locked(self, mock_rslv, mock_acquire):
+        # Another worker is refreshing the DID
+        mock_acquire.return_value = None
+        DidResolver._refreshing.add(self.did)
+        DidResolver.refresh(self.did)
+        self.assertFalse(mock_rslv.called)
+        self.assertNotIn(self.did, DidResolver._refreshing)
+
+    @mock.patch('simard.cache.Cache.release_lock')
+    @mock.patch('simard.cache.Cache.acquire_lock')
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    @mock.patch('redis.Redis.set')
+    def test_refresh_failure(self, mock_set, mock_rslv, mock_acquire, mock_release):
+        mock_acquire.return_value = 'token'
+        mock_rslv.side_effect = DidResolverException('Organization does not exist', 404)
+
+        # The failure is logged and the cache is left untouched
+        DidResolver._refreshing.add(self.did)
+        with self.assertLogs(level='ERROR'):
+            DidResolver.refresh(self.did)
+        self.assertFalse(mock_set.called)
+        self.assertNotIn(self.did, DidResolver._refreshing)
+
+    @mock.patch('simard.did_resolver.DidResolver._refresh_executor')
+    def test_schedule_refresh_once(self, mock_executor):
+        # A second refresh is not scheduled while the first is pending
+        self.assertTrue(DidResolver.schedule_refresh(self.did))
+        self.assertFalse(DidResolver.schedule_refresh(self.did))
+        mock_executor.submit.assert_called_once_with(DidResolver.refresh, self.did)
+        DidResolver._refreshing.discard(self.did)
+
+    @mock.patch('simard.cache.Cache.release_lock')
+    @mock.patch('simard.cache.Cache.acquire_lock')
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    @mock.patch('redis.Redis.set')
+    @mock.patch('redis.Redis.pipeline')
+    def test_resolve_cache_miss(self, mock_pipeline, mock_set, mock_rslv, mock_acquire, mock_release):
         # Define the mock calls
         doc = {'dummy': 0}
-        mock_get.return_value = None
+        mock_pipeline.return_value.execute.return_value = [None, -2]
         mock_set.return_value = True
         mock_rslv.return_value = doc
+        mock_acquire.return_value = 'token'
 
         # Check the values
-        result = DidResolver.resolve(self.did)
+        with mock.patch('time.time', return_value=1000.0):
+            result = DidResolver.resolve(self.did)
         self.assertEqual(result, doc)
 
         # Check the mocks
-        mock_get.assert_called_once_with("didResultSimard_%s" % self.did)
-        mock_set.assert_called_once_with("didResultSimard_%s" % self.did, json.dumps(doc), ex=60)
+        mock_pipeline.return_value.get.assert_called_once_with("didResultSimardV2_%s" % self.did)
+        mock_set.assert_called_once_with(
+            "didResultSimardV2_%s" % self.did,
+            cache._serializer.dumps({'result': doc, 'resolvedAt': 1000.0}),
+            ex=DidResolver._HARD_TTL
+        )
         mock_rslv.assert_called_once_with(self.did)
+
+    @mock.patch('simard.cache.Cache.release_lock')
+    @mock.patch('simard.cache.Cache.acquire_lock')
+    @mock.patch('simard.did_resolver.DidResolver.store_result')
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    def test_coalesced_resolve(self, mock_rslv, mock_store, mock_acquire, mock_release):
+        # Block the first resolution until the other threads are waiting
+        doc = {'dummy': 0}
+        started = threading.Event()
+        proceed = threading.Event()
+
+        def slow_resolve(did):
+            started.set()
+            proceed.wait(5)
+            return doc
+        mock_rslv.side_effect = slow_resolve
+        mock_acquire.return_value = 'token'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(DidResolver.coalesced_resolve(self.did)))
+            for _ in range(4)
+        ]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        proceed.set()
+        for thread in threads:
+            thread.join(5)
+
+        # Check a single resolution was shared
+        self.assertEqual(results, [doc] * 4)
+        mock_rslv.assert_called_once_with(self.did)
+        mock_store.assert_called_once_with(self.did, doc)
+        mock_release.assert_called_once_with("didLockSimard_%s" % self.did, 'token')
+        self.assertEqual(DidResolver._inflight, {})
+
+    @mock.patch('simard.cache.Cache.acquire_lock')
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    def test_coalesced_resolve_error(self, mock_rslv, mock_acquire):
+        mock_rslv.side_effect = DidResolverException('Organization does not exist', 404)
+        mock_acquire.return_value = None
+
+        # Without cached result, the resolution is performed once the lease is over
+        with mock.patch.object(DidResolver, '_RESOLUTION_LEASE', 0):
+            with self.assertRaises(DidResolverException):
+                DidResolver.coalesced_resolve(self.did)
+        mock_rslv.assert_called_once_with(self.did)
+        self.assertEqual(DidResolver._inflight, {})
+
+    @mock.patch('simard.cache.Cache.retrieve')
+    @mock.patch('simard.cache.Cache.acquire_lock')
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    def test_locked_resolve_other_worker(self, mock_rslv, mock_acquire, mock_retrieve):
+        # Another worker holds the lock and stores its result
+        doc = {'dummy': 0}
+        mock_acquire.return_value = None
+        mock_retrieve.side_effect = [None, {'result': doc, 'resolvedAt': time.time()}]
+
+        with mock.patch.object(DidResolver, '_RESOLUTION_POLL_INTERVAL', 0):
+            self.assertEqual(DidResolver.locked_resolve(self.did), doc)
+        self.assertFalse(mock_rslv.called)
+        self.assertEqual(mock_retrieve.call_count, 2)
+
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    @mock.patch('redis.Redis.pipeline')
+    def test_resolve_negative_cache_hit(self, mock_pipeline, mock_rslv):
+        # The failure is answered from cache
+        entry = {'error': {'description': 'Organization does not exist', 'code': 404}}
+        mock_pipeline.return_value.execute.return_value = [json.dumps(entry), 30000]
+
+        with self.assertRaises(DidDocumentException) as ctx:
+            DidResolver.resolve(self.did)
+        self.assertEqual(ctx.exception.description, 'Organization does not exist')
+        self.assertEqual(ctx.exception.code, 404)
+        self.assertFalse(mock_rslv.called)
+
+    @mock.patch('simard.cache.Cache.release_lock')
+    @mock.patch('simard.cache.Cache.acquire_lock')
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    @mock.patch('redis.Redis.set')
+    def test_locked_resolve_stores_error(self, mock_set, mock_rslv, mock_acquire, mock_release):
+        mock_rslv.side_effect = DidDocumentException('Organization hash does not match', 403)
+        mock_acquire.return_value = 'token'
+
+        with self.assertRaises(DidDocumentException):
+            DidResolver.locked_resolve(self.did)
+
+        # Check the failure is cached shortly
+        mock_set.assert_called_once_with(
+            "didResultSimardV2_%s" % self.did,
+            cache._serializer.dumps({'error': {'description': 'Organization hash does not match', 'code': 403}}),
+            ex=DidResolver._NEGATIVE_TTL
+        )
+
+    @mock.patch('simard.cache.Cache.release_lock')
+    @mock.patch('simard.cache.Cache.acquire_lock')
+    @mock.patch('simard.did_resolver.DidResolver.full_resolve')
+    @mock.patch('redis.Redis.set')
+    def test_locked_resolve_transient_error(self, mock_set, mock_rslv, mock_acquire, mock_release):
+        mock_rslv.side_effect = DidResolverException('Error Resolving Onchain Organization', 500)
+        mock_acquire.return_value = 'token'
+
+        # Errors reaching the chain are not cached
+        with self.assertRaises(DidResolverException):
+            DidResolver.locked_resolve(self.did)
+        self.assertFalse(mock_set.called)
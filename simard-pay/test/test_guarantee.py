@@ -1,11 +1,13 @@
 from unittest import TestCase
-from simard.guarantee import Guarantee
+from simard.guarantee import Guarantee, GuaranteeStatus
+from simard.balance import BalanceFilter
 from decimal import Decimal
 from bson.decimal128 import Decimal128
 from simard.db import db
 import mongomock
 import uuid
-from datetime import datetime, timezone
+from unittest import mock
+from datetime import datetime, timezone, timedelta
 
 
 class GuaranteeTest(TestCase):
@@ -17,7 +19,9 @@ class GuaranteeTest(TestCase):
         self.g1_beneficiary = "4567"
         self.g1_amount = Decimal('300.45')
         self.g1_currency = "EUR"
-        self.g1_expiration = datetime.now(timezone.utc)
+        # Dates are stored with a millisecond precision
+        now = datetime.now(timezone.utc)
+        self.g1_expiration = now.replace(microsecond=now.microsecond // 1000 * 1000)
         self.g1_agent = "myAgent"
         self.g1_id = "5e5910b71aa85b667b20e4d6"
 
@@ -62,10 +66,10 @@ class GuaranteeTest(TestCase):
             '_id': self.g1._id,
             'initiator': self.g1.initiator,
             'beneficiary': self.g1.beneficiary,
-            'claimed': False,
+            'status': 'active',
             'amount': Decimal128(self.g1.amount),
             'currency': self.g1.currency,
-            'expiration': self.g1.expiration.isoformat(),
+            'expiration': self.g1.expiration.replace(tzinfo=None),
             'agent': self.g1.agent,
             'uuid': self.g1.uuid
         })
@@ -124,3 +128,202 @@ class GuaranteeTest(TestCase):
 
         # Clean
         db.guarantees.drop()
+
+    def test_release_materialized_balance(self):
+        """
+        Test that a claim or a cancelation releases the reserved amount once
+        """
+        db.guarantees.drop()
+        with mock.patch('simard.guarantee.Balance.increment') as bi:
+            self.g1.store()
+            bi.assert_called_once_with(self.g1_currency, [
+                (self.g1_initiator, BalanceFilter.RESERVED, self.g1_amount),
+                (self.g1_beneficiary, BalanceFilter.CLAIMABLE, self.g1_amount),
+            ])
+
+            # Claiming releases the amount
+            self.g1.flag_claimed()
+            self.assertEqual(bi.call_count, 2)
+            bi.assert_called_with(self.g1_currency, [
+                (self.g1_initiator, BalanceFilter.RESERVED, -self.g1_amount),
+                (self.g1_beneficiary, BalanceFilter.CLAIMABLE, -self.g1_amount),
+            ])
+
+            # The amount is not released again
+            self.g1.flag_claimed()
+            self.g1.cancel()
+            self.assertEqual(bi.call_count, 2)
+
+        # Cancel an unclaimed guarantee
+        g2 = Guarantee(
+            initiator=self.g1_initiator,
+            beneficiary=self.g1_beneficiary,
+            amount=self.g1_amount,
+            currency=self.g1_currency,
+            expiration=self.g1_expiration,
+            agent=self.g1_agent,
+        ).store()
+        with mock.patch('simard.guarantee.Balance.increment') as bi:
+            g2.cancel()
+            g2.cancel()
+            bi.assert_called_once_with(self.g1_currency, [
+                (self.g1_initiator, BalanceFilter.RESERVED, -self.g1_amount),
+                (self.g1_beneficiary, BalanceFilter.CLAIMABLE, -self.g1_amount),
+            ])
+        db.guarantees.drop()
+
+    def test_store_reserved(self):
+        """
+        Test that an amount already reserved is not reserved again
+        """
+        db.guarantees.drop()
+        with mock.patch('simard.guarantee.Balance.increment') as bi:
+            self.g1.store(reserved=True)
+            bi.assert_called_once_with(self.g1_currency, [
+                (self.g1_beneficiary, BalanceFilter.CLAIMABLE, self.g1_amount),
+            ])
+
+    def test_init_from_storage_legacy_expiration(self):
+        """
+        Test that an expiration stored as an ISO string is parsed
+        """
+        db.guarantees.drop()
+        self.g1.store()
+        db.guarantees.update_one(
+            {'uuid': self.g1.uuid},
+            {'$set': {'expiration': '2052-03-30T13:37:38+00:00'}}
+        )
+
+        g = Guarantee.from_storage(self.g1.uuid)
+        self.assertEqual(g.expiration, datetime(2052, 3, 30, 13, 37, 38, tzinfo=timezone.utc))
+
+        # The migration converts it to a date
+        self.assertEqual(Guarantee.migrate_expirations(), 1)
+        self.assertEqual(Guarantee.migrate_expirations(), 0)
+        stored = db.guarantees.find_one({'uuid': self.g1.uuid})
+        self.assertEqual(stored['expiration'], datetime(2052, 3, 30, 13, 37, 38))
+
+    def test_sweep_expired(self):
+        """
+        Test that the expired guarantees which are not claimed are released
+        """
+        db.guarantees.drop()
+        now = datetime.now(timezone.utc)
+        guarantees = []
+        for expiration in [now - timedelta(days=2), now - timedelta(days=1), now + timedelta(days=1)]:
+            guarantees.append(Guarantee(
+                initiator=self.g1_initiator,
+                beneficiary=self.g1_beneficiary,
+                amount=self.g1_amount,
+                currency=self.g1_currency,
+                expiration=expiration,
+                agent=self.g1_agent,
+            ).store())
+        guarantees[1].flag_claimed()
+
+        with mock.patch('simard.guarantee.Balance.increment') as bi:
+            self.assertEqual(Guarantee.sweep_expired(batch_size=1), 1)
+            bi.assert_called_once_with(self.g1_currency, [
+                (self.g1_initiator, BalanceFilter.RESERVED, -self.g1_amount),
+                (self.g1_beneficiary, BalanceFilter.CLAIMABLE, -self.g1_amount),
+            ])
+
+        # Only the expired guarantee is released
+        self.assertEqual(Guarantee.from_storage(guarantees[0].uuid).status, GuaranteeStatus.EXPIRED)
+        self.assertEqual(Guarantee.from_storage(guarantees[1].uuid).status, GuaranteeStatus.CLAIMED)
+        self.assertEqual(Guarantee.from_storage(guarantees[2].uuid).status, GuaranteeStatus.ACTIVE)
+        self.assertEqual(Guarantee.sweep_expired(), 0)
+
+    def test_cancel_keeps_history(self):
+        """
+        Test that a canceled guarantee is kept with its status
+        """
+        db.guarantees.drop()
+        self.g1.store()
+        self.g1.cancel()
+        self.assertEqual(Guarantee.from_storage(self.g1.uuid).status, GuaranteeStatus.CANCELLED)
+
+        # A claimed guarantee can not be canceled
+        g2 = Guarantee(
+            initiator=self.g1_initiator,
+            beneficiary=self.g1_beneficiary,
+            amount=self.g1_amount,
+            currency=self.g1_currency,
+            expiration=self.g1_expiration,
+            agent=self.g1_agent,
+        ).store()
+        g2.flag_claimed()
+        g2.cancel()
+        self.assertEqual(Guarantee.from_storage(g2.uuid).status, GuaranteeStatus.CLAIMED)
+
+        # A discarded guarantee is deleted
+        g2.discard()
+        self.assertIsNone(Guarantee.from_storage(g2.uuid))
+
+    def test_migrate_statuses(self):
+        """
+        Test that the claimed flag is replaced by a status
+        """
+        db.guarantees.drop()
+        for uuid_value, claimed in [('a', True), ('b', False)]:
+            db.guarantees.insert_one({
+                'uuid': uuid_value,
+                'initiator': self.g1_initiator,
+                'beneficiary': self.g1_beneficiary,
+                'amount': Decimal128(self.g1_amount),
+                'currency': self.g1_currency,
+                'expiration': self.g1_expiration,
+                'agent': self.g1_agent,
+                'claimed': claimed,
+            })
+
+        self.assertEqual(Guarantee.migrate_statuses(), 2)
+        self.assertEqual(Guarantee.migrate_statuses(), 0)
+        self.assertEqual(Guarantee.from_storage('a').status, GuaranteeStatus.CLAIMED)
+        self.assertEqual(Guarantee.from_storage('b').status, GuaranteeStatus.ACTIVE)
+        self.assertNotIn('claimed', db.guarantees.find_one({'uuid': 'a'}))
+
+    def test_from_storage_legacy(self):
+        """
+        Test that a guarantee stored with a claimed flag is migrated when read
+        """
+        db.guarantees.drop()
+        for uuid_value, claimed in [('a', True), ('b', False)]:
+            db.guarantees.insert_one({
+                'uuid': uuid_value,
+                'initiator': self.g1_initiator,
+                'beneficiary': self.g1_beneficiary,
+                'amount': Decimal128(self.g1_amount),
+                'currency': self.g1_currency,
+                'expiration': self.g1_expiration,
+                'agent': self.g1_agent,
+                'claimed': claimed,
+            })
+
+        self.assertEqual(Guarantee.from_storage('a').status, GuaranteeStatus.CLAIMED)
+        g = Guarantee.from_storage('b')
+        self.assertEqual(g.status, GuaranteeStatus.ACTIVE)
+        self.assertEqual(db.guarantees.find_one({'uuid': 'b'})['status'], 'active')
+        self.assertNotIn('claimed', db.guarantees.find_one({'uuid': 'b'}))
+
+        # The migrated guarantee can be canceled
+        g.cancel()
+        self.assertEqual(Guarantee.from_storage('b').status, GuaranteeStatus.CANCELLED)
+
+    def test_sweep_expired_legacy(self):
+        """
+        Test that the guarantees stored with a claimed flag are swept
+        """
+        db.guarantees.insert_one({
+            'uuid': 'legacy',
+            'initiator': self.g1_initiator,
+            'beneficiary': self.g1_beneficiary,
+            'amount': Decimal128(self.g1_amount),
+            'currency': self.g1_currency,
+            'expiration': datetime.now(timezone.utc) - timedelta(days=1),
+            'agent': self.g1_agent,
+            'claimed': False,
+        })
+
+        self.assertEqual(Guarantee.sweep_expired(), 1)
+        self.assertEqual(Guarantee.from_storage('legacy').status, GuaranteeStatus.EXPIRED)
@@ -0,0 +1,50 @@
+from unittest import TestCase
+from unittest import mock
+from simard.guarantee_sweeper import GuaranteeSweeper
+
+
+class GuaranteeSweeperTest(TestCase):
+    def setUp(self):
+        self.sweeper = GuaranteeSweeper(interval=3600)
+        self.addCleanup(self.sweeper.stop)
+
+    def test_start_stop(self):
+        """
+        Test that a single sweep is scheduled until stopped
+        """
+        self.sweeper.start()
+        timer = self.sweeper._timer
+        self.assertTrue(timer.daemon)
+        self.assertTrue(timer.is_alive())
+
+        self.sweeper.start()
+        self.assertIs(self.sweeper._timer, timer)
+
+        self.sweeper.stop()
+        self.assertIsNone(self.sweeper._timer)
+
+    @mock.patch('simard.guarantee.Guarantee.sweep_expired')
+    def test_sweep(self, se):
+        """
+        Test that a sweep releases the guarantees and schedules the next one
+        """
+        se.return_value = 3
+        self.sweeper.start()
+        self.assertEqual(self.sweeper.sweep(), 3)
+        se.assert_called_once_with(batch_size=GuaranteeSweeper._BATCH_SIZE)
+        self.assertIsNotNone(self.sweeper._timer)
+
+    @mock.patch('simard.guarantee.Guarantee.sweep_expired')
+    def test_sweep_error(self, se):
+        """
+        Test that a failing sweep is retried on the next run
+        """
+        se.side_effect = Exception('Database unavailable')
+        self.sweeper.start()
+        self.assertEqual(self.sweeper.sweep(), 0)
+        self.assertIsNotNone(self.sweeper._timer)
+
+        # A stopped sweeper is not scheduled again
+        self.sweeper.stop()
+        self.sweeper.sweep()
+        self.assertIsNone(self.sweeper._timer)
@@ -0,0 +1,139 @@
+import unittest
+from unittest import mock
+import mongomock
+from pymongo.errors import OperationFailure
+from simard.db import db
+from simard.index_manager import IndexManager, INDEXES, CANONICAL_QUERIES
+
+
+class TestIndexManager(unittest.TestCase):
+    def setUp(self):
+        db._database = mongomock.MongoClient().unittest
+
+        # mongomock drops the partial filters, they are reported as MongoDB does
+        self.partial_filters = {}
+        create_index = mongomock.collection.Collection.create_index
+        index_information = mongomock.collection.Collection.index_information
+
+        def create_partial_index(collection, keys, **kwargs):
+            if 'partialFilterExpression' in kwargs:
+                self.partial_filters[(collection.name, kwargs['name'])] = kwargs.pop('partialFilterExpression')
+            return create_index(collection, keys, **kwargs)
+
+        def partial_index_information(collection):
+            info = index_information(collection)
+            for name in info:
+                if (collection.name, name) in self.partial_filters:
+                    info[name]['partialFilterExpression'] = self.partial_filters[(collection.name, name)]
+            return info
+
+        for name, method in [('create_index', create_partial_index), ('index_information', partial_index_information)]:
+            patcher = mock.patch.object(mongomock.collection.Collection, name, autospec=True, side_effect=method)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_verify_missing(self):
+        """
+        Test that missing indexes are reported
+        """
+        problems = IndexManager.verify_indexes()
+        self.assertIn(('guarantees', 'uuid', 'missing'), problems)
+        self.assertEqual(len(problems), sum(len(i) for i in INDEXES.values()))
+
+    def test_ensure_then_verify(self):
+        """
+        Test that indexes are created idempotently and verified
+        """
+        provisioned = IndexManager.ensure_indexes()
+        self.assertIn(('settlements', 'beneficiary_currency_id'), provisioned)
+        self.assertEqual(IndexManager.verify_indexes(), [])
+
+        # A second run does not fail
+        IndexManager.ensure_indexes()
+        info = db.settlements.index_information()
+        self.assertEqual(info['uuid']['key'], [('uuid', 1)])
+        self.assertTrue(info['uuid']['unique'])
+
+    def test_verify_different_keys(self):
+        """
+        Test that an index with the same name but other keys is reported
+        """
+        db.quotes.create_index([('orgid', 1)], name='uuid')
+        self.assertIn(('quotes', 'uuid', 'different keys'), IndexManager.verify_indexes())
+
+    def test_ensure_conflict(self):
+        """
+        Test that an index conflicting with an existing one is reported instead of failing
+        """
+        db.quotes.create_index([('uuid', 1)], name='uuid')
+
+        with self.assertLogs(level='ERROR'):
+            provisioned = IndexManager.ensure_indexes()
+        self.assertNotIn(('quotes', 'uuid'), provisioned)
+        self.assertIn(('quotes', 'uuid', 'different unique'), IndexManager.verify_indexes())
+
+        # The indexes required for the consistency are not skipped
+        with self.assertRaises(OperationFailure):
+            IndexManager.ensure_collection_indexes('quotes', strict=True)
+
+    def test_verify_renamed(self):
+        """
+        Test that the declared keys indexed under another name are reported
+        """
+        db.accounts.create_index([('orgid', 1)], name='orgid_1')
+        self.assertIn(('accounts', 'orgid', 'exists as orgid_1'), IndexManager.verify_indexes())
+
+    def test_verify_different_options(self):
+        """
+        Test that an index with the same keys but other options is reported
+        """
+        db.quotes.create_index([('uuid', 1)], name='uuid')
+        db.settlements.create_index([('guarantee', 1)], name='guarantee')
+        db.guarantees.create_index([('expiration', 1)], name='expiration_active', partialFilterExpression={'claimed': False})
+        db.guarantees.create_index([('claimed', 1)], name='claimed_legacy')
+
+        problems = IndexManager.verify_indexes()
+        self.assertIn(('quotes', 'uuid', 'different unique'), problems)
+        self.assertIn(('settlements', 'guarantee', 'different sparse'), problems)
+        self.assertIn(('guarantees', 'expiration_active', 'different partialFilterExpression'), problems)
+        self.assertIn(('guarantees', 'claimed_legacy', 'different partialFilterExpression'), problems)
+
+    def test_plan_summary(self):
+        """
+        Test the summary of nested query plans
+        """
+        plan = {
+            'stage': 'SUBPLAN',
+            'inputStage': {
+                'stage': 'FETCH',
+                'inputStage': {
+                    'stage': 'OR',
+                    'inputStages': [
+                        {'stage': 'IXSCAN', 'indexName': 'beneficiary_currency_id'},
+                        {'stage': 'IXSCAN', 'indexName': 'initiator_currency_id'},
+                    ]
+                }
+            }
+        }
+        self.assertEqual(IndexManager.plan_summary(plan), [
+            'SUBPLAN',
+            'FETCH',
+            'OR',
+            '[IXSCAN(beneficiary_currency_id), IXSCAN(initiator_currency_id)]'
+        ])
+        self.assertEqual(IndexManager.plan_summary({'stage': 'COLLSCAN'}), ['COLLSCAN'])
+
+    def test_explain_queries(self):
+        """
+        Test that all canonical queries are explained
+        """
+        with mock.patch('mongomock.collection.Cursor.explain', create=True) as ce:
+            ce.return_value = {'queryPlanner': {'winningPlan': {
+                'stage': 'FETCH',
+                'inputStage': {'stage': 'IXSCAN', 'indexName': 'uuid'}
+            }}}
+            plans = IndexManager.explain_queries()
+
+        self.assertEqual(len(plans), len(CANONICAL_QUERIES))
+        self.assertEqual(plans[0][0], 'guarantees')
+        self.assertEqual(plans[0][2], ['FETCH', 'IXSCAN(uuid)'])
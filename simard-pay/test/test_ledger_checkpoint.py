@@ -0,0 +1,214 @@
+from unittest import TestCase
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne, UpdateMany
+import mongomock
+from simard.balance import Balance
+from simard.db import db
+from simard.ledger_checkpoint import LedgerCheckpoint
+
+
+class LedgerCheckpointTest(TestCase):
+    def setUp(self):
+        db._database = mongomock.MongoClient().unittest
+        db.settlements.drop()
+        db.guarantees.drop()
+        db.balance_checkpoints.drop()
+
+        self.now = datetime.now(timezone.utc)
+
+    def add_settlement(self, initiator, beneficiary, amount, currency, days_ago):
+        """
+        Insert a settlement created in the past
+        """
+        timestamp = ObjectId.from_datetime(self.now - timedelta(days=days_ago))
+        db.settlements.insert_one({
+            '_id': ObjectId(timestamp.binary[:4] + ObjectId().binary[4:]),
+            'initiator': initiator,
+            'beneficiary': beneficiary,
+            'amount': Decimal128(amount),
+            'currency': currency,
+        })
+
+    def test_run_initial(self):
+        """
+        Test the first run creates the checkpoints of old settlements only
+        """
+        self.add_settlement('faucet', 'did:orgid:ota', '100.00', 'EUR', 10)
+        self.add_settlement('did:orgid:ota', 'did:orgid:supplier', '30.00', 'EUR', 5)
+        self.add_settlement('faucet', 'did:orgid:ota', '50.00', 'EUR', 0)
+
+        self.assertEqual(LedgerCheckpoint.run(), 3)
+
+        checkpoint = LedgerCheckpoint.from_storage('did:orgid:ota', 'EUR')
+        self.assertEqual(checkpoint.credit, Decimal('100.00'))
+        self.assertEqual(checkpoint.debit, Decimal('30.00'))
+        self.assertEqual(checkpoint.received, 1)
+
+        checkpoint = LedgerCheckpoint.from_storage('faucet', 'EUR')
+        self.assertEqual(checkpoint.credit, Decimal('0'))
+        self.assertEqual(checkpoint.debit, Decimal('100.00'))
+        self.assertEqual(checkpoint.received, 0)
+
+        self.assertIsNone(LedgerCheckpoint.from_storage('did:orgid:ota', 'USD'))
+
+        # The checkpoints are already up to date
+        self.assertEqual(LedgerCheckpoint.run(), 0)
+
+    def test_run_incremental(self):
+        """
+        Test a run increments the checkpoints with the settlements since the last run
+        """
+        self.add_settlement('faucet', 'did:orgid:ota', '100.00', 'EUR', 10)
+        LedgerCheckpoint.run(lag=timedelta(days=5))
+        previous = LedgerCheckpoint.from_storage('did:orgid:ota', 'EUR').until
+
+        self.add_settlement('did:orgid:ota', 'did:orgid:supplier', '30.00', 'EUR', 3)
+        with mock.patch('mongomock.collection.Collection.bulk_write') as bw:
+            self.assertEqual(LedgerCheckpoint.run(lag=timedelta(days=1)), 2)
+            (operations,), kwargs = bw.call_args
+
+        self.assertEqual(kwargs, {'ordered': True})
+        self.assertIn(UpdateOne(
+            {'orgid': 'did:orgid:ota', 'currency': 'EUR', 'until': previous},
+            {
+                '$inc': {
+                    'credit': Decimal128('0'),
+                    'debit': Decimal128('30.00'),
+                    'received': 0,
+                },
+                '$set': {'until': operations[-1]._doc['$set']['until']},
+            }
+        ), operations)
+        self.assertEqual(operations[-1], UpdateMany(
+            {'until': {'$in': [previous]}},
+            {'$set': {'until': operations[-1]._doc['$set']['until']}}
+        ))
+
+    def test_run_mixed_positions(self):
+        """
+        Test the checkpoints left at an older position are incremented from it
+        """
+        self.add_settlement('faucet', 'did:orgid:ota', '100.00', 'EUR', 10)
+        self.add_settlement('faucet', 'did:orgid:supplier', '20.00', 'EUR', 10)
+        self.add_settlement('faucet', 'did:orgid:ota', '50.00', 'EUR', 4)
+        self.add_settlement('faucet', 'did:orgid:supplier', '5.00', 'EUR', 4)
+        self.add_settlement('faucet', 'did:orgid:supplier', '1.00', 'EUR', 2)
+
+        # The supplier checkpoint was left behind by an interrupted run
+        older = ObjectId.from_datetime(self.now - timedelta(days=5))
+        newer = ObjectId.from_datetime(self.now - timedelta(days=3))
+        db.balance_checkpoints.insert_many([
+            {'orgid': 'did:orgid:ota', 'currency': 'EUR', 'until': newer,
+             'credit': Decimal128('150.00'), 'debit': Decimal128('0'), 'received': 2},
+            {'orgid': 'faucet', 'currency': 'EUR', 'until': newer,
+             'credit': Decimal128('0'), 'debit': Decimal128('175.00'), 'received': 0},
+            {'orgid': 'did:orgid:supplier', 'currency': 'EUR', 'until': older,
+             'credit': Decimal128('20.00'), 'debit': Decimal128('0'), 'received': 1},
+        ])
+
+        with mock.patch('mongomock.collection.Collection.bulk_write') as bw:
+            self.assertEqual(LedgerCheckpoint.run(lag=timedelta(days=1)), 2)
+            (operations,), _ = bw.call_args
+
+        until = operations[-1]._doc['$set']['until']
+        updates = {op._filter['orgid']: op for op in operations if isinstance(op, UpdateOne)}
+        self.assertEqual(sorted(updates), ['did:orgid:supplier', 'faucet'])
+        self.assertEqual(updates['did:orgid:supplier'], UpdateOne(
+            {'orgid': 'did:orgid:supplier', 'currency': 'EUR', 'until': older},
+            {
+                '$inc': {'credit': Decimal128('6.00'), 'debit': Decimal128('0'), 'received': 2},
+                '$set': {'until': until},
+            }
+        ))
+        self.assertEqual(updates['faucet']._doc['$inc']['debit'], Decimal128('1.00'))
+        self.assertEqual(updates['faucet']._filter['until'], newer)
+        self.assertFalse([op for op in operations if isinstance(op, InsertOne)])
+        self.assertEqual(operations[-1], UpdateMany(
+            {'until': {'$in': [older, newer]}},
+            {'$set': {'until': until}}
+        ))
+
+    def test_run_full_interrupted(self):
+        """
+        Test the checkpoints stay valid when a full run is interrupted
+        """
+        self.add_settlement('faucet', 'did:orgid:ota', '100.00', 'EUR', 10)
+        self.add_settlement('faucet', 'did:orgid:supplier', '20.00', 'EUR', 10)
+        LedgerCheckpoint.run(lag=timedelta(days=5))
+        self.add_settlement('faucet', 'did:orgid:ota', '50.00', 'EUR', 3)
+        self.add_settlement('faucet', 'did:orgid:supplier', '5.00', 'EUR', 3)
+
+        # The full run stops after replacing the first checkpoint
+        bulk_write = mongomock.collection.Collection.bulk_write
+
+        def interrupted_bulk_write(collection, operations, ordered):
+            bulk_write(collection, operations[:1], ordered=ordered)
+            raise Exception('Interrupted')
+
+        with mock.patch('mongomock.collection.Collection.bulk_write', autospec=True) as bw:
+            bw.side_effect = interrupted_bulk_write
+            with self.assertRaises(Exception):
+                LedgerCheckpoint.run(lag=timedelta(days=1), full=True)
+
+        # All the checkpoints are kept, at one position or the other
+        self.assertEqual(db.balance_checkpoints.count_documents({}), 3)
+        self.assertEqual(Balance('did:orgid:ota', 'EUR').credit, Decimal('150.00'))
+        self.assertEqual(Balance('did:orgid:supplier', 'EUR').credit, Decimal('25.00'))
+        self.assertEqual(Balance('faucet', 'EUR').debit, Decimal('175.00'))
+
+        # The next full run completes them
+        self.assertEqual(LedgerCheckpoint.run(lag=timedelta(days=1), full=True), 3)
+        self.assertEqual(LedgerCheckpoint.from_storage('faucet', 'EUR').debit, Decimal('175.00'))
+        self.assertEqual(len(db.balance_checkpoints.distinct('until')), 1)
+
+    def test_run_missing_checkpoint(self):
+        """
+        Test a balance without checkpoint includes the settlements before the previous run
+        """
+        self.add_settlement('faucet', 'did:orgid:ota', '100.00', 'EUR', 10)
+        self.add_settlement('faucet', 'did:orgid:supplier', '20.00', 'EUR', 10)
+        LedgerCheckpoint.run(lag=timedelta(days=5))
+        db.balance_checkpoints.delete_one({'orgid': 'did:orgid:supplier'})
+
+        self.add_settlement('faucet', 'did:orgid:supplier', '5.00', 'EUR', 3)
+        self.add_settlement('faucet', 'did:orgid:agency', '7.00', 'EUR', 3)
+        with mock.patch('mongomock.collection.Collection.bulk_write') as bw:
+            LedgerCheckpoint.run(lag=timedelta(days=1))
+            (operations,), _ = bw.call_args
+
+        inserted = {op._doc['orgid']: op._doc for op in operations if isinstance(op, InsertOne)}
+        self.assertEqual(inserted['did:orgid:supplier']['credit'], Decimal128('25.00'))
+        self.assertEqual(inserted['did:orgid:supplier']['received'], 2)
+        self.assertEqual(inserted['did:orgid:agency']['credit'], Decimal128('7.00'))
+
+    def test_run_unique_index(self):
+        """
+        Test a run provisions the unique index detecting concurrent runs
+        """
+        LedgerCheckpoint.run()
+        index = db.balance_checkpoints.index_information()['orgid_currency']
+        self.assertTrue(index['unique'])
+
+    def test_balance_with_checkpoint(self):
+        """
+        Test the balance only aggregates the settlements after the checkpoint
+        """
+        self.add_settlement('faucet', 'did:orgid:ota', '100.00', 'EUR', 10)
+        self.add_settlement('did:orgid:ota', 'did:orgid:supplier', '30.00', 'EUR', 5)
+        LedgerCheckpoint.run()
+        self.add_settlement('faucet', 'did:orgid:ota', '50.00', 'EUR', 0)
+        self.add_settlement('did:orgid:ota', 'did:orgid:supplier', '5.00', 'EUR', 0)
+
+        balance = Balance('did:orgid:ota', 'EUR')
+        with mock.patch.object(Balance, 'aggregate_with_filters', wraps=Balance.aggregate_with_filters) as af:
+            self.assertEqual(balance.credit, Decimal('150.00'))
+            self.assertEqual(balance.debit, Decimal('35.00'))
+            self.assertEqual(balance.total, Decimal('115.00'))
+
+            # Check the checkpointed settlements are skipped
+            _, kwargs = af.call_args
+            self.assertIn('_id', kwargs['filters'])
@@ -1,8 +1,13 @@
 import unittest
-from simard.oauth_manager import OAuthManager, OAuthManagerInvalidToken
+from simard.oauth_manager import OAuthManager, OAuthManagerInvalidToken, OAuthManagerUnsupportedToken
 from unittest import mock
 import json
+import base64
+import time
+import ecdsa
 from simard.settings import ORGIDVALIDATOR_URL, ORGIDVALIDATOR_V2_URL
+from simard.did_resolver import DidResolverException, DidDocumentException
+from simard.validator_client import validator_client
 
 
 class TestOauthManagerECDSA(unittest.TestCase):
@@ -100,7 +105,7 @@ class TestOauthManagerECDSA(unittest.TestCase):
             print(f"Got request to URL:{args[0]}")
             return Response(None, 404)
 
-        patch=mock.patch('simard.oauth_manager.requests.get', side_effect=mocked_requests_get)
+        patch=mock.patch.object(validator_client._session, 'get', side_effect=mocked_requests_get)
         patch.start()
         #validate JWT without chain code - mock response as ORGiD Validator V1
         self.assertEqual(("0x33300000000000000000000000000000000000000000000000000000000AB121",
@@ -152,3 +157,229 @@ class TestOauthManagerECDSA(unittest.TestCase):
             (validated, orgid),
             (True, self.orgid)
         )
+
+    def test_load_verifying_key_cached(self):
+        OAuthManager._verifying_keys.clear()
+        with open('./test/simard.json', 'r', encoding="utf-8") as fs:
+            public_key = json.load(fs)['publicKey'][1]
+
+        # The key is parsed once
+        with mock.patch('ecdsa.VerifyingKey.from_pem', wraps=ecdsa.VerifyingKey.from_pem) as mock_from_pem:
+            vk = OAuthManager.load_verifying_key(self.orgid, public_key['id'], public_key['publicKeyPem'])
+            self.assertIs(
+                OAuthManager.load_verifying_key(self.orgid, public_key['id'], public_key['publicKeyPem']),
+                vk
+            )
+            self.assertEqual(mock_from_pem.call_count, 1)
+
+            # A changed key in the document is parsed again
+            other_pem = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1).get_verifying_key().to_pem().decode()
+            other_vk = OAuthManager.load_verifying_key(self.orgid, public_key['id'], other_pem)
+            self.assertIsNot(other_vk, vk)
+            self.assertEqual(mock_from_pem.call_count, 2)
+
+        OAuthManager._verifying_keys.clear()
+
+
+class TestOauthManagerValidationCache(unittest.TestCase):
+    def setUp(self):
+        self.issuer = "did:orgid:0x%s#key" % ('1' * 64)
+        self.validated = ("0x%s" % ('1' * 64), self.issuer)
+
+    def make_token(self, claims):
+        """
+        Build an unsigned token with the claims
+        """
+        payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+        return "eyJhbGciOiJFUzI1NksiLCJ0eXAiOiJKV1QifQ.%s.c2lnbmF0dXJl" % payload
+
+    @mock.patch('simard.cache.Cache.store')
+    @mock.patch('simard.cache.Cache.retrieve')
+    @mock.patch('simard.oauth_manager.OAuthManager._validate_token_v1')
+    def test_validate_token_stored(self, mock_validate, mock_retrieve, mock_store):
+        token = self.make_token({'iss': self.issuer, 'exp': time.time() + 60})
+        mock_retrieve.return_value = None
+        mock_validate.return_value = self.validated
+
+        self.assertEqual(OAuthManager.validate_token(token), self.validated)
+
+        # The validation is kept until the token expires
+        key, value = mock_store.call_args[0]
+        self.assertEqual(key, OAuthManager.validation_cache_key(token))
+        self.assertNotIn(token, key)
+        self.assertEqual(value, self.validated)
+        self.assertIn(mock_store.call_args[1]['expiry'], [59, 60])
+        self.assertIs(mock_store.call_args[1]['local'], OAuthManager._validations)
+
+    @mock.patch('simard.cache.Cache.store')
+    @mock.patch('simard.cache.Cache.retrieve')
+    @mock.patch('simard.oauth_manager.OAuthManager._validate_token_v1')
+    def test_validate_token_cached(self, mock_validate, mock_retrieve, mock_store):
+        token = self.make_token({'iss': self.issuer})
+        mock_retrieve.return_value = list(self.validated)
+
+        # The validator is skipped
+        self.assertEqual(OAuthManager.validate_token(token), self.validated)
+        mock_retrieve.assert_called_once_with(
+            OAuthManager.validation_cache_key(token), local=OAuthManager._validations)
+        self.assertFalse(mock_validate.called)
+        self.assertFalse(mock_store.called)
+
+    @mock.patch('simard.cache.Cache.store')
+    @mock.patch('simard.cache.Cache.retrieve')
+    @mock.patch('simard.oauth_manager.OAuthManager._validate_token_v1')
+    def test_validate_token_not_stored(self, mock_validate, mock_retrieve, mock_store):
+        mock_retrieve.return_value = None
+        mock_validate.return_value = self.validated
+
+        # Tokens expiring now are not cached
+        token = self.make_token({'iss': self.issuer, 'exp': time.time()})
+        OAuthManager.validate_token(token)
+        self.assertFalse(mock_store.called)
+
+        # Neither are failed validations
+        mock_validate.side_effect = OAuthManagerInvalidToken("JWT Token not authorized", 403)
+        with self.assertRaises(OAuthManagerInvalidToken):
+            OAuthManager.validate_token(self.make_token({'iss': self.issuer}))
+        self.assertFalse(mock_store.called)
+
+    def test_validation_ttl(self):
+        self.assertEqual(OAuthManager.validation_ttl({}), OAuthManager._VALIDATION_MAX_TTL)
+        self.assertEqual(OAuthManager.validation_ttl({'exp': time.time() + 10 ** 6}), OAuthManager._VALIDATION_MAX_TTL)
+        self.assertLessEqual(OAuthManager.validation_ttl({'exp': time.time() - 10}), 0)
+        self.assertEqual(OAuthManager.validation_ttl({'exp': 'never'}), 0)
+
+
+class TestOauthManagerLocalValidation(unittest.TestCase):
+    def setUp(self):
+        # Signed token issued by the second key of the ORG.ID, see TestOauthManagerECDSA
+        self.orgid = "0x5e6994f76764ceb42c476a2505065a6170178a24c03d81c9f372563830001171"
+        self.jwt_string = "eyJhbGciOiJFUzI1NksiLCJ0eXAiOiJKV1QifQ."
+        self.jwt_string += "eyJpc3MiOiJkaWQ6b3JnaWQ6MHg1ZTY5OTRmNzY3NjRjZWI0MmM0NzZhMjUwNTA2"
+        self.jwt_string += "NWE2MTcwMTc4YTI0YzAzZDgxYzlmMzcyNTYzODMwMDAxMTcxI3NlY29uZGtleSIs"
+        self.jwt_string += "ImF1ZCI6ImRpZDpvcmdpZDoweDVlNjk5NGY3Njc2NGNlYjQyYzQ3NmEyNTA1MDY1"
+        self.jwt_string += "YTYxNzAxNzhhMjRjMDNkODFjOWYzNzI1NjM4MzAwMDExNzEiLCJleHAiOjI1ODM0"
+        self.jwt_string += "NDkwMzksInNjb3BlIjoiIn0."
+        self.jwt_string += "LyL-LjLthNuRXhRqyaeo67O6WO1pK2u72Z8E_TbM48H"
+        self.jwt_string += "LKmzYOfO3DY-XOc7PdN-0UVdN_RJOYITX1JsjM3OCXA"
+
+        # The DID document lists the keys of the ORG.ID
+        with open('./test/simard.json', 'r', encoding="utf-8") as fs:
+            did_document = json.load(fs)
+        for public_key in did_document['publicKey']:
+            public_key['id'] = "did:orgid:%s#%s" % (self.orgid, public_key['id'].split('#')[1])
+        self.did_result = {
+            'id': self.orgid,
+            'didDocument': did_document,
+        }
+
+        patchers = [
+            mock.patch('simard.oauth_manager.SIMARD_ORGID', self.orgid),
+            mock.patch('simard.oauth_manager.ORGID_CHAINID', '3'),
+            mock.patch('simard.cache.Cache.retrieve', return_value=None),
+            mock.patch('simard.cache.Cache.store'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_token(self, header, claims):
+        """
+        Build an unsigned token with the header and claims
+        """
+        return "%s.%s.c2lnbmF0dXJl" % tuple(
+            base64.urlsafe_b64encode(json.dumps(field).encode()).decode().rstrip('=')
+            for field in [header, claims]
+        )
+
+    @mock.patch('simard.did_resolver.DidResolver.resolve')
+    def test_validate_token_local(self, mock_resolve):
+        mock_resolve.return_value = self.did_result
+
+        self.assertEqual(
+            OAuthManager.validate_token_local(self.jwt_string),
+            (self.orgid, "did:orgid:%s#secondkey" % self.orgid)
+        )
+        mock_resolve.assert_called_once_with(self.orgid)
+
+    @mock.patch('simard.did_resolver.DidResolver.resolve')
+    def test_validate_token_local_chain(self, mock_resolve):
+        mock_resolve.return_value = self.did_result
+        claims = {'aud': "did:orgid:%s" % self.orgid, 'exp': time.time() + 60}
+
+        # The chain identifier must be the one of the resolver
+        claims['iss'] = "did:orgid:1:%s#secondkey" % self.orgid
+        with self.assertRaises(OAuthManagerUnsupportedToken):
+            OAuthManager.validate_token_local(self.make_token({'alg': 'ES256K'}, claims))
+
+        # The signature is verified against the key of the document
+        claims['iss'] = "did:orgid:3:%s#secondkey" % self.orgid
+        with self.assertRaises(OAuthManagerInvalidToken) as context:
+            OAuthManager.validate_token_local(self.make_token({'alg': 'ES256K'}, claims))
+        self.assertNotIsInstance(context.exception, OAuthManagerUnsupportedToken)
+        mock_resolve.assert_called_once_with(self.orgid)
+
+    @mock.patch('simard.did_resolver.DidResolver.resolve')
+    def test_validate_token_local_no_expiration(self, mock_resolve):
+        claims = {'aud': "did:orgid:%s" % self.orgid, 'iss': "did:orgid:%s#secondkey" % self.orgid}
+
+        # Tokens without expiration are rejected before the resolution
+        with self.assertRaises(OAuthManagerInvalidToken) as context:
+            OAuthManager.validate_token_local(self.make_token({'alg': 'ES256K'}, claims))
+        self.assertNotIsInstance(context.exception, OAuthManagerUnsupportedToken)
+        self.assertEqual(context.exception.description, "JWT Token has no expiration")
+        self.assertFalse(mock_resolve.called)
+
+    @mock.patch('simard.did_resolver.DidResolver.resolve')
+    def test_validate_token_local_rejected(self, mock_resolve):
+        # Tokens for another audience are rejected
+        with mock.patch('simard.oauth_manager.SIMARD_ORGID', "0x%s" % ('2' * 64)):
+            with self.assertRaises(OAuthManagerInvalidToken):
+                OAuthManager.validate_token_local(self.jwt_string)
+        self.assertFalse(mock_resolve.called)
+
+        # Invalid organizations are not sent to the validator
+        mock_resolve.side_effect = DidDocumentException("Organization does not exist", 404)
+        with self.assertRaises(DidDocumentException):
+            OAuthManager.validate_token_local(self.jwt_string)
+
+        # Neither are they when the resolver fails
+        mock_resolve.side_effect = DidResolverException("Error Retrieving Offchain Document", 500)
+        with self.assertRaises(OAuthManagerUnsupportedToken):
+            OAuthManager.validate_token_local(self.jwt_string)
+
+    @mock.patch('simard.oauth_manager.OAuthManager._validate_token_v1')
+    @mock.patch('simard.did_resolver.DidResolver.resolve')
+    def test_validate_token_local_mode(self, mock_resolve, mock_validate):
+        mock_resolve.return_value = self.did_result
+
+        with mock.patch('simard.oauth_manager.OAuthManager._VALIDATION_MODE', 'local'):
+            self.assertEqual(
+                OAuthManager.validate_token(self.jwt_string),
+                (self.orgid, "did:orgid:%s#secondkey" % self.orgid)
+            )
+        self.assertFalse(mock_validate.called)
+
+    @mock.patch('simard.oauth_manager.OAuthManager._validate_token_v1')
+    @mock.patch('simard.did_resolver.DidResolver.resolve')
+    def test_validate_token_local_fallback(self, mock_resolve, mock_validate):
+        mock_validate.return_value = (self.orgid, "did:orgid:%s#key" % self.orgid)
+        token = self.make_token(
+            {'alg': 'EdDSA'},
+            {'iss': "did:orgid:%s#key" % self.orgid, 'aud': self.orgid, 'exp': time.time() + 60}
+        )
+
+        # Unsupported tokens are sent to the validator
+        with mock.patch('simard.oauth_manager.OAuthManager._VALIDATION_MODE', 'local'), \
+             mock.patch('simard.oauth_manager.OAuthManager._REMOTE_FALLBACK', True):
+            self.assertEqual(OAuthManager.validate_token(token), mock_validate.return_value)
+        mock_validate.assert_called_once_with(token)
+
+        # Or rejected when the fallback is disabled
+        mock_validate.reset_mock()
+        with mock.patch('simard.oauth_manager.OAuthManager._VALIDATION_MODE', 'local'), \
+             mock.patch('simard.oauth_manager.OAuthManager._REMOTE_FALLBACK', False):
+            with self.assertRaises(OAuthManagerUnsupportedToken):
+                OAuthManager.validate_token(token)
+        self.assertFalse(mock_validate.called)
+        self.assertFalse(mock_resolve.called)
@@ -0,0 +1,121 @@
+import unittest
+from unittest import mock
+from web3 import Web3
+from simard.orgid_watcher import OrgIdWatcher, OrgIdWatcherException
+
+
+class TestOrgIdWatcher(unittest.TestCase):
+    def setUp(self):
+        self.watcher = OrgIdWatcher(interval=1)
+        self.orgid = '0x' + '1' * 64
+        self.unit_orgid = '0x' + '2' * 64
+
+        # Recorded logs of the ORG.ID contract
+        self.json_changed_log = {
+            'blockNumber': 10,
+            'topics': [
+                Web3.keccak(text='OrgJsonChanged(bytes32,bytes32,string,string,string,bytes32,string,string,string)').hex(),
+                self.orgid,
+                '0x' + 'a' * 64,
+                '0x' + 'b' * 64,
+            ],
+        }
+        self.unit_created_log = {
+            'blockNumber': 11,
+            'topics': [
+                Web3.keccak(text='UnitCreated(bytes32,bytes32,address)').hex(),
+                self.orgid,
+                self.unit_orgid,
+                '0x' + '0' * 64,
+            ],
+        }
+        self.other_log = {
+            'blockNumber': 12,
+            'topics': [Web3.keccak(text='Transfer(address,address,uint256)').hex()],
+        }
+
+    @mock.patch('simard.cache.Cache.delete')
+    def test_process_logs(self, mock_delete):
+        orgids = self.watcher.process_logs([self.json_changed_log, self.unit_created_log, self.other_log])
+        self.assertEqual(orgids, {self.orgid, self.unit_orgid})
+
+        mock_delete.assert_has_calls([
+            mock.call('didResultSimardV2_did:orgid:%s' % self.orgid),
+            mock.call('didResultSimardV2_did:orgid:%s' % self.unit_orgid),
+        ], any_order=True)
+        self.assertEqual(mock_delete.call_count, 2)
+
+    @mock.patch('simard.cache.Cache.delete')
+    @mock.patch('simard.orgid_watcher.w3')
+    def test_poll(self, mock_w3, mock_delete):
+        # The first poll verifies the contract and starts from the latest block
+        mock_w3.eth.get_code.return_value = b'\x7f'.join(self.watcher._topics)
+        mock_w3.eth.get_storage_at.return_value = bytes(32)
+        mock_w3.eth.block_number = 9
+        self.assertEqual(self.watcher.poll(), set())
+        self.assertFalse(mock_w3.eth.get_logs.called)
+
+        # The next poll reads the new blocks
+        mock_w3.eth.block_number = 12
+        mock_w3.eth.get_logs.return_value = [self.json_changed_log]
+        self.assertEqual(self.watcher.poll(), {self.orgid})
+        filters = mock_w3.eth.get_logs.call_args[0][0]
+        self.assertEqual((filters['fromBlock'], filters['toBlock']), (10, 12))
+        self.assertEqual(len(filters['topics'][0]), len(OrgIdWatcher._EVENTS))
+
+        # Nothing is read without new blocks
+        mock_w3.eth.get_logs.reset_mock()
+        self.assertEqual(self.watcher.poll(), set())
+        self.assertFalse(mock_w3.eth.get_logs.called)
+
+    @mock.patch('simard.orgid_watcher.w3')
+    def test_verify_events(self, mock_w3):
+        implementation = '0x' + '3' * 40
+        slots = {OrgIdWatcher._IMPLEMENTATION_SLOTS[0]: bytes(12) + bytes.fromhex(implementation[2:])}
+        mock_w3.eth.get_storage_at.side_effect = lambda address, slot: slots.get(slot, bytes(32))
+
+        # The events are emitted by the implementation behind the proxy
+        codes = {Web3.toChecksumAddress(implementation): b'\x7f'.join(self.watcher._topics)}
+        mock_w3.eth.get_code.side_effect = lambda address: codes.get(address, b'\x60\x80')
+        self.watcher.verify_events()
+
+        # An event missing from the contract is reported
+        codes[Web3.toChecksumAddress(implementation)] = b'\x7f'.join(list(self.watcher._topics)[1:])
+        with self.assertRaises(OrgIdWatcherException) as context:
+            self.watcher.verify_events()
+        self.assertIn(Web3.toHex(list(self.watcher._topics)[0]), context.exception.description)
+
+    @mock.patch('simard.orgid_watcher.OrgIdWatcher.poll')
+    def test_watch_unverified(self, mock_poll):
+        mock_poll.side_effect = OrgIdWatcherException('The ORG.ID contract does not emit the events: 0x00', 500)
+
+        # The watcher stops
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.watcher.watch(), set())
+        self.assertTrue(self.watcher._stopped)
+        self.assertIsNone(self.watcher._timer)
+
+    @mock.patch('simard.orgid_watcher.w3')
+    def test_read_logs_range(self, mock_w3):
+        mock_w3.eth.get_logs.return_value = []
+        with mock.patch.object(OrgIdWatcher, '_MAX_BLOCK_RANGE', 10):
+            self.watcher.read_logs(1, 25)
+
+        ranges = [(c[0][0]['fromBlock'], c[0][0]['toBlock']) for c in mock_w3.eth.get_logs.call_args_list]
+        self.assertEqual(ranges, [(1, 10), (11, 20), (21, 25)])
+
+    @mock.patch('simard.orgid_watcher.OrgIdWatcher._schedule_watch')
+    @mock.patch('simard.orgid_watcher.OrgIdWatcher.poll')
+    def test_watch_error(self, mock_poll, mock_schedule):
+        mock_poll.side_effect = Exception('Connection lost')
+
+        # The error is logged and the next poll is scheduled
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.watcher.watch(), set())
+        mock_schedule.assert_called_once_with()
+
+    def test_start_stop(self):
+        self.watcher.start()
+        self.assertIsNotNone(self.watcher._timer)
+        self.watcher.stop()
+        self.assertIsNone(self.watcher._timer)
@@ -2,6 +2,8 @@ import unittest
 from decimal import Decimal
 from simard.parser import Parser, ParserException
 import dateutil.parser
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
 
 
 class TestParser(unittest.TestCase):
@@ -147,6 +149,32 @@ class TestParser(unittest.TestCase):
             Parser.parse_expiration(d2)
         )
 
+    def test_parse_date(self):
+        """
+        Test parsing dates in UTC
+        """
+        self.assertEqual(
+            Parser.parse_date('2021-03-01T12:00:00+01:00'),
+            datetime(2021, 3, 1, 11, tzinfo=timezone.utc)
+        )
+        self.assertEqual(
+            Parser.parse_date('2021-03-01'),
+            datetime(2021, 3, 1, tzinfo=timezone.utc)
+        )
+        with self.assertRaises(ParserException):
+            Parser.parse_date('yesterday')
+
+    def test_parse_cursor(self):
+        """
+        Test parsing pagination cursors
+        """
+        self.assertEqual(
+            Parser.parse_cursor('5e5910b71aa85b667b20e4d6'),
+            ObjectId('5e5910b71aa85b667b20e4d6')
+        )
+        with self.assertRaises(ParserException):
+            Parser.parse_cursor('5e5910b71aa85b667b20e4d')
+
     def test_parse_iban(self):
         """
         Test parsing IBANs
@@ -6,6 +6,12 @@ from simard.db import db
 import mongomock
 from bson.decimal128 import Decimal128
 import uuid
+from datetime import datetime, timezone
+from bson.objectid import ObjectId
+from simard.settlement import Settlement
+import json
+import csv
+import io
 from model.exception import SimardException
 from simard.settings import VIRTUAL_CARD_ORGID, GLIDER_B2B_ORGID
 from simard.guarantee import Guarantee
@@ -233,7 +239,7 @@ class BalanceRouteTest(TestCase):
         self.assertEqual(g1['amount'], Decimal128('300.00'))
         self.assertEqual(g1['currency'], 'EUR')
         self.assertEqual(g1['agent'], self.agent)
-        self.assertEqual(g1['expiration'], "2052-03-30T13:37:38+00:00")
+        self.assertEqual(g1['expiration'], datetime(2052, 3, 30, 13, 37, 38))
 
         # Retrieve the guarantee
         response = self.client.get(
@@ -273,6 +279,292 @@ class BalanceRouteTest(TestCase):
             'message': 'Missing mandatory key in parameters: expiration'
         })
 
+    def test_create_guarantees(self):
+        """
+        Test to create several guarantees at once
+        """
+        beneficiary = \
+            "0x0000000000000000000000000000000000000000000000000000000000005121"
+
+        with mock.patch(
+            'simard.balance.Balance.available',
+            new_callable=mock.PropertyMock
+        ) as ma:
+            # Redefine the return value
+            ma.return_value = Decimal('500.00')
+
+            response = self.client.post(
+                path='/api/v1/balances/guarantees/batch',
+                json={"guarantees": [
+                    {
+                        "currency": "EUR",
+                        "amount": "300.00",
+                        "creditorOrgId": beneficiary,
+                        "expiration": "2052-03-30T13:37:38Z"
+                    },
+                    {
+                        "currency": "USD",
+                        "amount": "100.00",
+                        "creditorOrgId": beneficiary,
+                        "expiration": "2052-03-30T13:37:38Z"
+                    },
+                    {
+                        "currency": "EUR",
+                        "amount": "200.00",
+                        "creditorOrgId": beneficiary,
+                        "expiration": "2052-03-30T13:37:38Z"
+                    },
+                ]},
+                headers=self.headers
+            )
+
+            # A single balance check is made per currency
+            self.assertEqual(ma.call_count, 2)
+
+        # Check the response
+        self.assert200(response)
+        guarantees = response.json['guarantees']
+        self.assertEqual(len(guarantees), 3)
+
+        # Check the guarantees are created in DB in the request order
+        for guarantee, (currency, amount) in zip(guarantees, [('EUR', '300.00'), ('USD', '100.00'), ('EUR', '200.00')]):
+            g1 = db._database.guarantees.find_one({'uuid': guarantee['guaranteeId']})
+            self.assertEqual(g1['initiator'], self.orgid)
+            self.assertEqual(g1['beneficiary'], beneficiary)
+            self.assertEqual(g1['amount'], Decimal128(amount))
+            self.assertEqual(g1['currency'], currency)
+            self.assertEqual(g1['agent'], self.agent)
+            self.assertEqual(g1['expiration'], datetime(2052, 3, 30, 13, 37, 38))
+
+    def test_create_guarantees_invalid(self):
+        """
+        Test that no guarantee is created if one of them is invalid
+        """
+        beneficiary = \
+            "0x0000000000000000000000000000000000000000000000000000000000005121"
+
+        response = self.client.post(
+            path='/api/v1/balances/guarantees/batch',
+            json={"guarantees": [
+                {
+                    "currency": "EUR",
+                    "amount": "300.00",
+                    "creditorOrgId": beneficiary,
+                    "expiration": "2052-03-30T13:37:38Z"
+                },
+                {
+                    "currency": "EUR",
+                    "amount": "300.00",
+                    "creditorOrgId": beneficiary,
+                },
+            ]},
+            headers=self.headers
+        )
+
+        # Check the response
+        self.assert400(response)
+        self.assertEqual(response.json, {
+            'message': 'Guarantee 1: Missing mandatory key in parameters: expiration'
+        })
+        self.assertEqual(db._database.guarantees.count_documents({}), 0)
+
+    def test_create_guarantees_insufficient_balance(self):
+        """
+        Test that the guarantees are reverted if a balance is insufficient
+        """
+        beneficiary = \
+            "0x0000000000000000000000000000000000000000000000000000000000005121"
+
+        with mock.patch(
+            'simard.balance.Balance.available',
+            new_callable=mock.PropertyMock
+        ) as ma:
+            # Redefine the return value
+            ma.return_value = Decimal('500.00')
+
+            response = self.client.post(
+                path='/api/v1/balances/guarantees/batch',
+                json={"guarantees": [
+                    {
+                        "currency": "USD",
+                        "amount": "100.00",
+                        "creditorOrgId": beneficiary,
+                        "expiration": "2052-03-30T13:37:38Z"
+                    },
+                    {
+                        "currency": "EUR",
+                        "amount": "300.00",
+                        "creditorOrgId": beneficiary,
+                        "expiration": "2052-03-30T13:37:38Z"
+                    },
+                    {
+                        "currency": "EUR",
+                        "amount": "300.00",
+                        "creditorOrgId": beneficiary,
+                        "expiration": "2052-03-30T13:37:38Z"
+                    },
+                ]},
+                headers=self.headers
+            )
+
+        # Check the response
+        self.assert400(response)
+        self.assertEqual(response.json, {
+            'message': 'Insufficient balance to create guarantees: EUR'
+        })
+        self.assertEqual(db._database.guarantees.count_documents({}), 0)
+
+    def add_statement_settlements(self):
+        """
+        Store settlements at different dates for the statements
+        """
+        counterparty = \
+            "0x0000000000000000000000000000000000000000000000000000000000005121"
+        settlements = []
+        for day, currency, credited in [(1, 'EUR', True), (2, 'USD', False), (3, 'EUR', False), (4, 'EUR', True)]:
+            settlement = Settlement(
+                initiator=counterparty if credited else self.orgid,
+                beneficiary=self.orgid if credited else counterparty,
+                amount=Decimal('10.00') * day,
+                currency=currency,
+                agent=self.agent,
+                source='test',
+            )
+            settlement._id = ObjectId.from_datetime(datetime(2021, 3, day, tzinfo=timezone.utc))
+            db.settlements.insert_one({
+                '_id': settlement._id,
+                'uuid': settlement.uuid,
+                'initiator': settlement.initiator,
+                'beneficiary': settlement.beneficiary,
+                'amount': Decimal128(settlement.amount),
+                'currency': settlement.currency,
+                'agent': settlement.agent,
+                'source': settlement.source,
+            })
+            settlements.append(settlement)
+
+        # A settlement between other parties
+        db.settlements.insert_one({
+            'uuid': str(uuid.uuid4()),
+            'initiator': counterparty,
+            'beneficiary': VIRTUAL_CARD_ORGID,
+            'amount': Decimal128('1.00'),
+            'currency': 'EUR',
+            'agent': self.agent,
+        })
+
+        return settlements
+
+    def test_statement_pages(self):
+        """
+        Test to retrieve a statement by pages
+        """
+        settlements = self.add_statement_settlements()
+
+        response = self.client.get(
+            path='/api/v1/balances/statement?limit=2',
+            headers=self.headers
+        )
+        self.assert200(response)
+        self.assertEqual(response.json['settlements'], [
+            {
+                'id': settlements[0].uuid,
+                'date': '2021-03-01T00:00:00Z',
+                'currency': 'EUR',
+                'amount': '10.00',
+                'direction': 'credit',
+                'counterpartyOrgId': settlements[0].initiator,
+                'source': 'test',
+                'guaranteeId': None,
+                'transactionHash': None,
+                'quoteId': None,
+            },
+            {
+                'id': settlements[1].uuid,
+                'date': '2021-03-02T00:00:00Z',
+                'currency': 'USD',
+                'amount': '20.00',
+                'direction': 'debit',
+                'counterpartyOrgId': settlements[1].beneficiary,
+                'source': 'test',
+                'guaranteeId': None,
+                'transactionHash': None,
+                'quoteId': None,
+            },
+        ])
+        self.assertEqual(response.json['nextCursor'], str(settlements[1]._id))
+
+        # Retrieve the last page
+        response = self.client.get(
+            path='/api/v1/balances/statement?limit=2&cursor=%s' % response.json['nextCursor'],
+            headers=self.headers
+        )
+        self.assert200(response)
+        self.assertEqual(
+            [entry['id'] for entry in response.json['settlements']],
+            [settlements[2].uuid, settlements[3].uuid]
+        )
+        self.assertIsNone(response.json['nextCursor'])
+
+        # Filter on currency and dates
+        response = self.client.get(
+            path='/api/v1/balances/statement?currency=EUR&from=2021-03-02&to=2021-03-04',
+            headers=self.headers
+        )
+        self.assert200(response)
+        self.assertEqual(
+            [entry['id'] for entry in response.json['settlements']],
+            [settlements[2].uuid]
+        )
+
+    def test_statement_invalid(self):
+        """
+        Test to retrieve a statement with invalid parameters
+        """
+        for query, message in [
+            ('cursor=abc', 'Cursor format is incorrect'),
+            ('limit=1001', 'Limit must not be greater than 1000'),
+            ('from=yesterday', 'Unsupported datetime'),
+            ('format=xml', 'Unsupported statement format: xml'),
+        ]:
+            response = self.client.get(
+                path='/api/v1/balances/statement?%s' % query,
+                headers=self.headers
+            )
+            self.assert400(response)
+            self.assertEqual(response.json, {'message': message})
+
+    def test_statement_streams(self):
+        """
+        Test to stream a statement as NDJSON and CSV
+        """
+        settlements = self.add_statement_settlements()
+
+        response = self.client.get(
+            path='/api/v1/balances/statement?format=ndjson&currency=EUR',
+            headers=self.headers
+        )
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(
+            [json.loads(line)['id'] for line in lines],
+            [settlements[0].uuid, settlements[2].uuid, settlements[3].uuid]
+        )
+
+        response = self.client.get(
+            path='/api/v1/balances/statement?format=csv&cursor=%s' % settlements[2]._id,
+            headers=self.headers
+        )
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['id'], settlements[3].uuid)
+        self.assertEqual(rows[0]['amount'], '40.00')
+        self.assertEqual(rows[0]['direction'], 'credit')
+        self.assertEqual(rows[0]['guaranteeId'], '')
+
     def test_get_guarantee_random(self):
         """
         Test to retrieve a guarantee that does not exist
@@ -471,7 +763,7 @@ class BalanceRouteTest(TestCase):
         self.assertEqual(g1['amount'], Decimal128('300.00'))
         self.assertEqual(g1['currency'], 'EUR')
         self.assertEqual(g1['agent'], self.agent + "BENEF")
-        self.assertEqual(g1['expiration'], "2059-03-06T14:19:05.678000+00:00")
+        self.assertEqual(g1['expiration'], datetime(2059, 3, 6, 14, 19, 5, 678000))
 
         # Check the card details
         self.assertEqual(response.json['card'], {
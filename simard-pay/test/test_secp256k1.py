@@ -0,0 +1,70 @@
+import unittest
+import hashlib
+from unittest import mock
+import ecdsa
+from eth_account import Account
+from eth_account.messages import encode_defunct
+from simard.secp256k1 import Secp256k1, Secp256k1Exception, coincurve
+
+
+class TestSecp256k1(unittest.TestCase):
+    def setUp(self):
+        self.message = b'eyJhbGciOiJFUzI1NksifQ.eyJpc3MiOiJkaWQ6b3JnaWQ6MHgwIn0'
+        self.signing_key = ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1, hashfunc=hashlib.sha256)
+        self.public_key_pem = self.signing_key.get_verifying_key().to_pem().decode()
+        self.signature = self.signing_key.sign(self.message)
+
+        self.account = Account.create()
+        self.eth_signature = bytes(self.account.sign_message(
+            encode_defunct(text=self.message.decode())).signature)
+
+    def check_backend(self, name):
+        verifier = Secp256k1(name)
+        self.assertEqual(verifier.name, name)
+        public_key = verifier.load_public_key(self.public_key_pem)
+
+        # Signatures are verified
+        self.assertTrue(verifier.verify(public_key, self.signature, self.message))
+        self.assertFalse(verifier.verify(public_key, self.signature, self.message + b'x'))
+        self.assertFalse(verifier.verify(public_key, bytes(64), self.message))
+        with self.assertRaises(ValueError):
+            verifier.verify(public_key, self.signature[:32], self.message)
+
+        # Both forms of s are accepted
+        order = ecdsa.SECP256k1.order
+        r, s = ecdsa.util.sigdecode_string(self.signature, order)
+        other_signature = ecdsa.util.sigencode_string(r, order - s, order)
+        self.assertTrue(verifier.verify(public_key, other_signature, self.message))
+
+        # Addresses are recovered
+        self.assertEqual(
+            verifier.recover_address(self.message.decode(), self.eth_signature),
+            self.account.address
+        )
+        self.assertNotEqual(
+            verifier.recover_address(self.message.decode() + 'x', self.eth_signature),
+            self.account.address
+        )
+
+    def test_ecdsa(self):
+        self.check_backend('ecdsa')
+
+    @unittest.skipIf(coincurve is None, 'coincurve is not installed')
+    def test_coincurve(self):
+        self.check_backend('coincurve')
+
+    def test_coincurve_missing(self):
+        with mock.patch('simard.secp256k1.coincurve', None):
+            self.assertEqual(Secp256k1('coincurve').name, 'ecdsa')
+            self.assertEqual(Secp256k1.available_backends(), ['ecdsa'])
+
+    def test_unsupported_backend(self):
+        with self.assertRaises(Secp256k1Exception):
+            Secp256k1('openssl')
+
+    def test_benchmark(self):
+        results = Secp256k1.benchmark(iterations=2)
+        self.assertEqual([name for name, _, _ in results], Secp256k1.available_backends())
+        for name, verify_rate, recover_rate in results:
+            self.assertGreater(verify_rate, 0)
+            self.assertGreater(recover_rate, 0)
@@ -0,0 +1,45 @@
+import unittest
+from unittest import mock
+import requests
+from simard.validator_client import ValidatorClient, ValidatorClientException
+
+
+class TestValidatorClient(unittest.TestCase):
+    def setUp(self):
+        self.client = ValidatorClient(connect_timeout=1, read_timeout=2, retries=3, pool_size=10)
+        self.addCleanup(self.client.close)
+
+    def test_init(self):
+        adapter = self.client._session.get_adapter('https://validator')
+        self.assertEqual(adapter._pool_maxsize, 10)
+        self.assertEqual(adapter.max_retries.total, 3)
+        self.assertEqual(adapter.max_retries.status_forcelist, (502, 503, 504))
+        self.assertIs(self.client._session.get_adapter('http://validator'), adapter)
+
+    def test_get(self):
+        with mock.patch.object(self.client._session, 'get') as g:
+            g.return_value = mock.Mock(status_code=200)
+            self.assertIs(self.client.get('https://validator/jwt', {'jwt': 'token'}), g.return_value)
+
+        g.assert_called_once_with('https://validator/jwt', params={'jwt': 'token'}, timeout=(1, 2))
+        stats = self.client.stats()
+        self.assertEqual((stats['requests'], stats['errors']), (1, 0))
+        self.assertGreaterEqual(stats['maxLatency'], stats['averageLatency'])
+
+    def test_get_error(self):
+        with mock.patch.object(self.client._session, 'get') as g:
+            g.side_effect = requests.exceptions.ReadTimeout('Stuck')
+            with self.assertRaises(ValidatorClientException) as context:
+                self.client.get('https://validator/jwt', {'jwt': 'token'})
+
+        self.assertEqual(context.exception.code, 502)
+        stats = self.client.stats()
+        self.assertEqual((stats['requests'], stats['errors']), (1, 1))
+
+    def test_stats_empty(self):
+        self.assertEqual(self.client.stats(), {
+            'requests': 0,
+            'errors': 0,
+            'averageLatency': 0.0,
+            'maxLatency': 0.0,
+        })